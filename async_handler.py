@@ -0,0 +1,270 @@
+import asyncio
+import copy
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from cache import AsyncSingleFlight
+from main import Handler
+from transport import Transport
+
+
+class AsyncHandler:
+    """
+    Asyncio-версия Handler.
+
+    Повторяет API Handler, но методы являются корутинами.
+    Это обёртка над пулом потоков, а не асинхронный HTTP клиент: блокирующие
+    вызовы Handler выполняются в пуле из max_workers потоков поверх общего пула
+    соединений. Одновременно выполняется не больше max_workers запросов к API,
+    остальные триггеры ожидают свободный поток в event loop.
+    Отмена корутины не прерывает уже начатый вызов: он выполняется в потоке
+    до конца. Поэтому поиск оператора не запускается заранее с отменой,
+    а начинается только после проверки тега клиента.
+    """
+
+    def __init__(self, handler: Handler = None, max_workers: int = 64):
+        """
+        Создаёт асинхронный обработчик.
+
+        :param handler: синхронный Handler, методы которого выполняют запросы.
+         По умолчанию создаётся Handler с пулом соединений размера max_workers.
+        :param max_workers: максимальное кол-во одновременных запросов к API.
+        """
+        self.handler = handler or Handler(Transport(pool_maxsize=max_workers))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.flights = AsyncSingleFlight()
+
+    def _for_handler_(self, handler: Handler) -> "AsyncHandler":
+        """
+        Создаёт копию с другим синхронным обработчиком и общим пулом потоков.
+
+        :param handler: обработчик другого токена API.
+        :return: копия AsyncHandler.
+        """
+        view = copy.copy(self)
+        view.handler = handler
+        return view
+
+    async def _call_(self, method, *args, **kwargs):
+        """
+        Выполняет блокирующий метод Handler в пуле потоков.
+
+        :param method: метод Handler.
+        :param args: позиционные аргументы метода.
+        :param kwargs: именованные аргументы метода.
+        :return: результат метода.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(method, *args, **kwargs)
+        )
+
+    async def get_client_by_id(self, client_id: int) -> dict | None:
+        """Асинхронная версия Handler.get_client_by_id."""
+        return await self.flights.do(
+            ("client", self.handler.headers["Authorization"], client_id),
+            lambda: self._call_(self.handler.get_client_by_id, client_id),
+        )
+
+    async def get_client_tags(self, client_id: int) -> frozenset | None:
+        """Асинхронная версия Handler.get_client_tags."""
+        if self.handler.client_profiles is not None:
+            return await self._call_(self.handler.get_client_tags, client_id)
+
+        client_data = await self.get_client_by_id(client_id)
+        if not client_data:
+            return None
+        return frozenset(tag["id"] for tag in client_data["data"]["tags"])
+
+    async def set_operator_to_dialog(
+        self,
+        dialog_id: int,
+        operator_id: int,
+        state: str = None,
+        initiator_id: int = None,
+    ) -> None:
+        """Асинхронная версия Handler.set_operator_to_dialog."""
+        await self._call_(
+            self.handler.set_operator_to_dialog, dialog_id, operator_id, state, initiator_id
+        )
+
+    async def get_client_id_by_dialog_id(self, dialog_id: int) -> int | None:
+        """Асинхронная версия Handler.get_client_id_by_dialog_id."""
+        return await self._call_(self.handler.get_client_id_by_dialog_id, dialog_id)
+
+    async def get_request_by_id(self, request_id: int) -> dict | None:
+        """Асинхронная версия Handler.get_request_by_id."""
+        return await self._call_(self.handler.get_request_by_id, request_id)
+
+    async def get_available_operator(self) -> int | None:
+        """Асинхронная версия Handler.get_available_operator."""
+        return await self._call_(self.handler.get_available_operator)
+
+    async def assign_tag_to_client(self, client_id: int, tag_id: int) -> None:
+        """Асинхронная версия Handler.assign_tag_to_client."""
+        await self._call_(self.handler.assign_tag_to_client, client_id, tag_id)
+
+    async def get_user_id_by_username(self, username: str) -> int | None:
+        """Асинхронная версия Handler.get_user_id_by_username."""
+        return await self.flights.do(
+            ("username", self.handler.headers["Authorization"], username),
+            lambda: self._call_(self.handler.get_user_id_by_username, username),
+        )
+
+    async def get_tag_id_by_label(self, label: str) -> int | None:
+        """Асинхронная версия Handler.get_tag_id_by_label."""
+        return await self.flights.do(
+            ("tag", self.handler.headers["Authorization"], label),
+            lambda: self._call_(self.handler.get_tag_id_by_label, label),
+        )
+
+    async def send_message_to_user(
+        self, client_id: int, text: str, open_dialog: bool, type: str
+    ) -> None:
+        """Асинхронная версия Handler.send_message_to_user."""
+        await self._call_(
+            self.handler.send_message_to_user, client_id, text, open_dialog, type
+        )
+
+    async def process_new_request(
+        self, tag_label: str, client_id: int, dialog_id: int
+    ) -> int:
+        """
+        Асинхронная версия Handler.process_new_request.
+
+        Клиент и тег запрашиваются одновременно. Оператор ищется только после
+        проверки тега, чтобы триггеры без тега не перебирали операторов.
+        :param tag_label: Название необходимого клиенту тега.
+        :param client_id: id клиента у запроса
+        :param dialog_id: id диалога у запроса
+        :return: id оператора если он найден, в противном случае -1.
+        """
+        tags, tag_id = await asyncio.gather(
+            self.get_client_tags(client_id), self.get_tag_id_by_label(tag_label)
+        )
+        if not (tags is not None and tag_id and tag_id in tags):
+            return -1
+
+        operator_id = await self.get_available_operator()
+        if operator_id:
+            try:
+                await self.send_message_to_user(client_id, "Оператор найден", False, "system")
+            except requests.exceptions.RequestException:
+                self.handler.release_operator(operator_id)
+                raise
+            await self.set_operator_to_dialog(dialog_id, operator_id, "OPEN")
+            return operator_id
+
+        await self.send_message_to_user(client_id, "Оператор не найден", False, "comment")
+        return -1
+
+    async def process_external_post_request(self, username: str, tag_label: str) -> bool:
+        """
+        Асинхронная версия Handler.process_external_post_request.
+
+        Клиент и тег ищутся одновременно. Как и в Handler, тег присваивается
+        только после успешной отправки приветственного сообщения.
+        :param username: имя искомого клиентами.
+        :param tag_label: название тега, который необходимо присвоить.
+        :return: True, если клиент найден,
+         сообщение отправлено и присвоен тег. В противном случае False.
+        """
+        client_id, tag_id = await asyncio.gather(
+            self.get_user_id_by_username(username), self.get_tag_id_by_label(tag_label)
+        )
+
+        if not client_id:
+            return False
+
+        await self.send_message_to_user(
+            client_id, f"Привет,{username}. Хорошего дня!", False, "to_client"
+        )
+        if tag_id:
+            await self.assign_tag_to_client(client_id, tag_id)
+
+        return bool(tag_id)
+
+    async def manually_handler(self, input_data, c2d):
+        """
+        Асинхронная версия Handler.manually_handler.
+
+        :param input_data: Входные данные.
+        :param c2d: Объект c2d.
+        :return: Результат обработки.
+        """
+        if c2d.token != self.handler.headers["Authorization"]:
+            with self.handler.tenants.lease(c2d.token) as tenant:
+                return await self._for_handler_(tenant).manually_handler(input_data, c2d)
+        if self.handler.trigger_timeout is not None and self.handler.deadline is None:
+            view = self._for_handler_(self.handler.with_deadline(self.handler.trigger_timeout))
+            return await view.manually_handler(input_data, c2d)
+
+        started = time.perf_counter()
+        if self.handler.recorder is not None:
+            self.handler.recorder.record("manually_handler", input_data)
+        client_name = input_data.get("name", "")
+
+        succeeded = False
+        result = f"Failed assign VIP tag for client with name {client_name}"
+        try:
+            if await self.process_external_post_request(client_name, "VIP"):
+                result = f"Assigned VIP tag for client with name {client_name}"
+                succeeded = True
+        except requests.exceptions.Timeout:
+            print("Request timed out")
+        except requests.exceptions.RequestException as e:
+            print(f"Exception raised by request method: {e}")
+
+        if self.handler.instrumentation is not None:
+            self.handler.instrumentation.on_handler(
+                "manually_handler", time.perf_counter() - started, succeeded
+            )
+        return result
+
+    async def new_request_handler(self, input_data, c2d):
+        """
+        Асинхронная версия Handler.new_request_handler.
+
+        :param input_data: Входные данные.
+        :param c2d: Объект c2d.
+        :return: Результат обработки.
+        """
+        if c2d.token != self.handler.headers["Authorization"]:
+            with self.handler.tenants.lease(c2d.token) as tenant:
+                return await self._for_handler_(tenant).new_request_handler(input_data, c2d)
+        if self.handler.trigger_timeout is not None and self.handler.deadline is None:
+            view = self._for_handler_(self.handler.with_deadline(self.handler.trigger_timeout))
+            return await view.new_request_handler(input_data, c2d)
+
+        started = time.perf_counter()
+        if self.handler.recorder is not None:
+            self.handler.recorder.record("new_request_handler", input_data)
+        client_id = input_data.get("client_id", "")
+        dialog_id = input_data.get("dialog_id", "")
+
+        succeeded = False
+        result = f"Failed to attach operator for client with id {client_id}"
+
+        try:
+            operator_id = await self.process_new_request("VIP", client_id, dialog_id)
+            if operator_id != -1:
+                result = f"Attached operator with {operator_id} for client with id {client_id}"
+                succeeded = True
+        except requests.exceptions.Timeout:
+            print("Request timed out")
+        except requests.exceptions.RequestException as e:
+            print(f"Exception raised by request method: {e}")
+
+        if self.handler.instrumentation is not None:
+            self.handler.instrumentation.on_handler(
+                "new_request_handler", time.perf_counter() - started, succeeded
+            )
+        return result
+
+    def close(self) -> None:
+        """Останавливает пул потоков и закрывает соединения."""
+        self.executor.shutdown(wait=True)
+        self.handler.close()
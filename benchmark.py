@@ -0,0 +1,285 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from c2d import C2D
+from main import Handler
+from metrics import percentile
+from pages import PageStore
+from stub_api import StubAPI
+
+
+def summarize(latencies: list, elapsed: float, errors: int, calls: int,
+              api_errors: int = 0) -> dict:
+    """
+    Формирует отчёт по серии вызовов.
+
+    :param latencies: задержки вызовов в секундах.
+    :param elapsed: общее время серии в секундах.
+    :param errors: кол-во вызовов, завершившихся ошибкой.
+    :param calls: кол-во запросов к API за серию.
+    :param api_errors: кол-во ответов API с ошибкой 5xx за серию.
+    :return: словарь с пропускной способностью, перцентилями задержки в мс,
+     долей ошибок, кол-вом запросов к API и ответов 5xx на вызов.
+    """
+    count = len(latencies)
+    return {
+        "operations": count,
+        "throughput": count / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "error_rate": errors / count if count else 0.0,
+        "api_calls_per_op": calls / count if count else 0.0,
+        "api_errors_per_op": api_errors / count if count else 0.0,
+    }
+
+
+def scenarios(clients: int, seed: int) -> dict:
+    """
+    Возвращает измеряемые сценарии.
+
+    Каждый сценарий - функция (handler, номер вызова), выполняющая один вызов.
+    :param clients: кол-во клиентов в заглушке API.
+    :param seed: seed генератора клиентов для сценариев.
+    :return: словарь название -> функция.
+    """
+    rnd = random.Random(seed)
+    client_ids = [rnd.randint(1, clients) for _ in range(1024)]
+    c2d = C2D()
+
+    def client_id(i: int) -> int:
+        return client_ids[i % len(client_ids)]
+
+    return {
+        "manually_handler": lambda h, i: h.manually_handler(
+            {"name": f"client{client_id(i)}"}, c2d
+        ),
+        "new_request_handler": lambda h, i: h.new_request_handler(
+            {"client_id": client_id(i), "dialog_id": i + 1}, c2d
+        ),
+        "get_client_by_id": lambda h, i: h.get_client_by_id(client_id(i)),
+        "get_tag_id_by_label": lambda h, i: h.get_tag_id_by_label("VIP"),
+        "get_user_id_by_username": lambda h, i: h.get_user_id_by_username(
+            f"client{client_id(i)}"
+        ),
+        "get_available_operator": lambda h, i: h.get_available_operator(),
+        "get_client_id_by_dialog_id": lambda h, i: h.get_client_id_by_dialog_id(i + 1),
+        "get_request_by_id": lambda h, i: h.get_request_by_id(i + 1),
+    }
+
+
+def run_scenario(stub: StubAPI, call, iterations: int, concurrency: int,
+                 page_store: bool = False) -> dict:
+    """
+    Выполняет сценарий на новом Handler и измеряет его.
+
+    Ошибкой считается вызов, который выбросил исключение, вернул None
+    или результат обработчика "Failed ...". Ответы 5xx заглушки считаются
+    отдельно, так как повторы запросов могут скрыть их от вызова.
+    :param stub: запущенная заглушка API.
+    :param call: функция сценария.
+    :param iterations: кол-во вызовов.
+    :param concurrency: кол-во одновременных вызовов.
+    :param page_store: True, если страницы коллекций запрашиваются условно через PageStore.
+    :return: отчёт, см. summarize.
+    """
+    handler = Handler(api_url=stub.url, page_store=PageStore() if page_store else None)
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(i: int) -> float:
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            result = call(handler, i)
+            failed = result is None or str(result).startswith("Failed")
+        except Exception:
+            failed = True
+        latency = time.perf_counter() - started
+        if failed:
+            with lock:
+                errors += 1
+        return latency
+
+    calls_before = stub.total_calls()
+    api_errors_before = stub.total_server_errors()
+    started = time.perf_counter()
+    # Обработчики печатают ошибки запросов, при внесённых ошибках это только шум
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(timed, range(iterations)))
+    elapsed = time.perf_counter() - started
+    calls = stub.total_calls() - calls_before
+    api_errors = stub.total_server_errors() - api_errors_before
+
+    handler.close()
+    return summarize(latencies, elapsed, errors, calls, api_errors)
+
+
+# Обработка одного триггера в новом процессе через warmstart.run_trigger.
+# Аргументы: путь к снимку, url API, название обработчика, входные данные в JSON.
+STARTUP_SCRIPT = """
+import json, sys
+from c2d import C2D
+from directory import ClientDirectory
+from operators import OperatorPool
+from warmstart import run_trigger
+
+path, api_url, method, input_data = sys.argv[1:5]
+print(run_trigger(path, method, json.loads(input_data), C2D(), api_url=api_url,
+                  operator_pool=OperatorPool(), client_directory=ClientDirectory()))
+"""
+
+
+def run_startup(stub: StubAPI, iterations: int, warm: bool, seed: int) -> dict:
+    """
+    Измеряет обработку триггеров, каждый из которых выполняется в новом процессе.
+
+    Задержка включает запуск интерпретатора, импорт модулей, создание Handler
+    и обработку. Триггеры чередуются между manually_handler и new_request_handler.
+    :param stub: запущенная заглушка API.
+    :param iterations: кол-во процессов.
+    :param warm: True, если процессы используют снимок warmstart.WarmState,
+     сохранённый предыдущим процессом. False - каждый процесс начинает без снимка.
+    :param seed: seed генератора клиентов.
+    :return: отчёт, см. summarize.
+    """
+    rnd = random.Random(seed)
+    root = os.path.dirname(os.path.abspath(__file__))
+    latencies = []
+    errors = 0
+
+    calls_before = stub.total_calls()
+    api_errors_before = stub.total_server_errors()
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "warm.json")
+        for i in range(iterations):
+            if not warm and os.path.exists(path):
+                os.remove(path)
+            client_id = rnd.randint(1, stub.clients_count)
+            if i % 2:
+                method, input_data = "manually_handler", {"name": f"client{client_id}"}
+            else:
+                method, input_data = "new_request_handler", {
+                    "client_id": client_id, "dialog_id": i + 1
+                }
+
+            invocation_started = time.perf_counter()
+            process = subprocess.run(
+                [sys.executable, "-c", STARTUP_SCRIPT, path, stub.url, method,
+                 json.dumps(input_data)],
+                cwd=root, capture_output=True, text=True,
+            )
+            latencies.append(time.perf_counter() - invocation_started)
+            errors += process.returncode != 0
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, elapsed, errors, stub.total_calls() - calls_before,
+                     stub.total_server_errors() - api_errors_before)
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Сравнивает результаты с базовыми и находит регрессии.
+
+    :param current: текущие результаты.
+    :param baseline: базовые результаты.
+    :param tolerance: допустимое относительное ухудшение.
+    :return: список описаний регрессий.
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "api_calls_per_op", "error_rate",
+                       "api_errors_per_op"):
+            if metric not in base:  # Базовые результаты из версии без этой метрики
+                continue
+            if result[metric] > base[metric] * (1 + tolerance) + 1e-9:
+                regressions.append(f"{name}.{metric}: {base[metric]:.3f} -> {result[metric]:.3f}")
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}.throughput: {base['throughput']:.1f} -> {result['throughput']:.1f}"
+            )
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    """
+    Запускает бенчмарк из командной строки.
+
+    :param argv: аргументы командной строки.
+    :return: код завершения. 1, если найдены регрессии относительно --baseline.
+    """
+    parser = argparse.ArgumentParser(description="Бенчмарк Handler на локальной заглушке API")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--operators", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.002,
+                        help="задержка ответа заглушки в секундах")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--scenario", action="append",
+                        help="измерить только указанные сценарии")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--page-store", action="store_true",
+                        help="запрашивать страницы коллекций условно через PageStore")
+    parser.add_argument("--startup", action="store_true",
+                        help="вместо сценариев измерить запуск нового процесса на каждый триггер"
+                             " без снимка и со снимком warmstart.WarmState")
+    parser.add_argument("--output", help="файл для результатов в JSON")
+    parser.add_argument("--baseline", help="файл с базовыми результатами для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    config = {
+        key: getattr(args, key)
+        for key in ("clients", "tags", "operators", "latency", "error_rate",
+                    "iterations", "concurrency", "seed", "page_store")
+    }
+    report = {"config": config, "results": {}}
+
+    selected = scenarios(args.clients, args.seed)
+    if args.scenario:
+        selected = {name: selected[name] for name in args.scenario}
+
+    with StubAPI(args.clients, args.tags, args.operators, latency=args.latency,
+                 error_rate=args.error_rate, seed=args.seed) as stub:
+        if args.startup:
+            for name, warm in (("startup_cold", False), ("startup_warm", True)):
+                report["results"][name] = run_startup(stub, args.iterations, warm, args.seed)
+        else:
+            for name, call in selected.items():
+                report["results"][name] = run_scenario(
+                    stub, call, args.iterations, args.concurrency, args.page_store
+                )
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,10 @@
+class C2D:
+    """Минимальная замена объекта c2d, передаваемого в обработчики триггеров."""
+
+    def __init__(self, token: str = ""):
+        """
+        Создаёт объект c2d.
+
+        :param token: токен API.
+        """
+        self.token = token
@@ -0,0 +1,328 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Flight:
+    """Загрузка значения, ожидаемая несколькими потоками."""
+
+    def __init__(self):
+        """Создаёт незавершённую загрузку."""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Объединение одновременных одинаковых запросов из разных потоков.
+
+    Пока выполняется функция для ключа, остальные вызовы с тем же ключом
+    не выполняют её повторно, а ожидают и получают её результат или исключение.
+    """
+
+    def __init__(self):
+        """Создаёт объединитель без выполняющихся запросов."""
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """
+        Выполняет fn или присоединяется к уже выполняющемуся вызову с тем же ключом.
+
+        :param key: ключ запроса.
+        :param fn: функция без аргументов.
+        :return: результат fn.
+        """
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику объединения.
+
+        :return: словарь с общим кол-вом вызовов и кол-вом объединённых вызовов.
+        """
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced}
+
+
+class AsyncSingleFlight:
+    """
+    Объединение одновременных одинаковых запросов из корутин одного event loop.
+
+    Отмена одного из ожидающих не отменяет общий запрос для остальных.
+    """
+
+    def __init__(self):
+        """Создаёт объединитель без выполняющихся запросов."""
+        self._futures = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, coroutine_fn):
+        """
+        Выполняет корутину или присоединяется к уже выполняющейся с тем же ключом.
+
+        :param key: ключ запроса.
+        :param coroutine_fn: функция без аргументов, возвращающая корутину.
+        :return: результат корутины.
+        """
+        import asyncio  # Не импортируется вместе с модулем, чтобы не замедлять запуск Handler
+
+        self.calls += 1
+        future = self._futures.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            future = self._futures[key] = asyncio.ensure_future(coroutine_fn())
+            future.add_done_callback(
+                lambda f: self._futures.pop(key) if self._futures.get(key) is f else None
+            )
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику объединения.
+
+        :return: словарь с общим кол-вом вызовов и кол-вом объединённых вызовов.
+        """
+        return {"calls": self.calls, "coalesced": self.coalesced}
+
+
+class TTLCache:
+    """
+    Ограниченный по размеру кэш с временем жизни записей и LRU вытеснением.
+
+    Кэширует в том числе отсутствие значения (None) с отдельным временем жизни.
+    Одновременные промахи по одному ключу приводят только к одной загрузке.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 128,
+        ttl: float = 300.0,
+        negative_ttl: float = 30.0,
+        clock=time.monotonic,
+    ):
+        """
+        Создаёт кэш.
+
+        :param maxsize: максимальное кол-во записей.
+        :param ttl: время жизни найденного значения в секундах.
+        :param negative_ttl: время жизни отсутствующего значения (None) в секундах.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.flights = SingleFlight()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def for_token(self, token: str) -> "TTLCache":
+        """
+        Создаёт пустой кэш с теми же настройками для другого токена API.
+
+        :param token: токен API.
+        :return: новый кэш.
+        """
+        return TTLCache(self.maxsize, self.ttl, self.negative_ttl, self.clock)
+
+    def _lookup_(self, key) -> tuple[bool, object]:
+        """
+        Ищет живую запись. Вызывается под блокировкой.
+
+        :param key: ключ.
+        :return: (True, значение), если запись есть и не устарела. Иначе (False, None).
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+
+        value, expires_at = entry
+        if expires_at <= self.clock():
+            del self._data[key]
+            return False, None
+
+        self._data.move_to_end(key)
+        return True, value
+
+    def _store_(self, key, value) -> None:
+        """
+        Сохраняет запись и вытесняет самые давно использованные. Вызывается под блокировкой.
+
+        :param key: ключ.
+        :param value: значение.
+        :return: None.
+        """
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self._data[key] = (value, self.clock() + ttl)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        """
+        Возвращает значение из кэша без загрузки.
+
+        :param key: ключ.
+        :param default: значение, возвращаемое при отсутствии записи.
+        :return: значение или default.
+        """
+        with self._lock:
+            found, value = self._lookup_(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value) -> None:
+        """
+        Записывает значение в кэш.
+
+        :param key: ключ.
+        :param value: значение.
+        :return: None.
+        """
+        with self._lock:
+            self._store_(key, value)
+
+    def get_or_load(self, key, loader):
+        """
+        Возвращает значение из кэша, при промахе загружает его.
+
+        Если значение по ключу уже загружается другим потоком, ожидает результат этой загрузки.
+        Исключение загрузки пробрасывается всем ожидающим и не кэшируется.
+        :param key: ключ.
+        :param loader: функция без аргументов, возвращающая значение.
+        :return: значение.
+        """
+        with self._lock:
+            found, value = self._lookup_(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        def load():
+            with self._lock:  # Значение могла сохранить только что завершившаяся загрузка
+                found, value = self._lookup_(key)
+            if found:
+                return value
+
+            value = loader()
+            with self._lock:
+                self._store_(key, value)
+            return value
+
+        return self.flights.do(key, load)
+
+    def update(self, key, fn) -> bool:
+        """
+        Заменяет живое значение результатом fn, не меняя время жизни записи.
+
+        :param key: ключ.
+        :param fn: функция (старое значение), возвращающая новое значение.
+        :return: True, если запись была в кэше и обновлена.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= self.clock():
+                return False
+            self._data[key] = (fn(entry[0]), entry[1])
+            return True
+
+    def dump(self) -> list:
+        """
+        Возвращает живые записи для сохранения в снимок.
+
+        :return: список [ключ, значение, оставшееся время жизни в секундах].
+        """
+        with self._lock:
+            now = self.clock()
+            return [
+                [key, value, expires_at - now]
+                for key, (value, expires_at) in self._data.items()
+                if expires_at > now
+            ]
+
+    def restore(self, entries: list, elapsed: float = 0.0) -> None:
+        """
+        Загружает записи из снимка, уменьшая их время жизни на время, прошедшее с его создания.
+
+        :param entries: записи, см. dump.
+        :param elapsed: время в секундах, прошедшее с создания снимка.
+        :return: None.
+        """
+        with self._lock:
+            now = self.clock()
+            for key, value, remaining in entries:
+                if remaining > elapsed:
+                    self._data[key] = (value, now + remaining - elapsed)
+                    self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None) -> None:
+        """
+        Удаляет запись из кэша.
+
+        :param key: ключ. Если не указан, кэш очищается полностью.
+        :return: None.
+        """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику кэша.
+
+        :return: словарь с кол-вом попаданий, промахов, вытеснений,
+         объединённых одновременных загрузок и текущим размером.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self.flights.coalesced,
+                "size": len(self._data),
+            }
@@ -0,0 +1,236 @@
+import sqlite3
+import threading
+import time
+
+
+def normalize_name(name: str) -> str:
+    """
+    Приводит имя к виду без учёта регистра и лишних пробелов.
+
+    :param name: имя клиента. None, если у клиента нет имени.
+    :return: нормализованное имя.
+    """
+    return " ".join((name or "").split()).casefold()
+
+
+class ClientDirectory:
+    """
+    Локальный справочник клиентов с хэш-индексом по имени.
+
+    Хранится в памяти, при указании path дополнительно сохраняется в SQLite
+    и загружается оттуда при следующем запуске.
+    Клиенты в API добавляются в конец коллекции, поэтому обновление
+    запрашивает только клиентов после уже известных.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        max_age: float = 3600.0,
+        normalized_index: bool = False,
+        clock=time.time,
+    ):
+        """
+        Создаёт справочник.
+
+        :param path: путь к файлу SQLite. Если не указан, справочник хранится только в памяти.
+        :param max_age: время в секундах, после которого справочник
+         полностью синхронизируется с API при следующем поиске.
+        :param normalized_index: True, если нужно искать также без учёта регистра и пробелов.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.max_age = max_age
+        self.normalized_index = normalized_index
+        self.clock = clock
+
+        self.by_name = {}
+        self.by_normalized_name = {}
+        self.count = 0
+        self.synced_at = None  # Время последней полной синхронизации
+
+        self._lock = threading.RLock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS clients (
+                    position INTEGER PRIMARY KEY, id INTEGER, name TEXT
+                );
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+                """
+            )
+            self._load_()
+
+    def for_token(self, token: str) -> "ClientDirectory":
+        """
+        Создаёт пустой справочник в памяти с теми же настройками для другого токена API.
+
+        :param token: токен API.
+        :return: новый справочник.
+        """
+        return ClientDirectory(
+            max_age=self.max_age, normalized_index=self.normalized_index, clock=self.clock
+        )
+
+    def _load_(self) -> None:
+        """
+        Загружает справочник из SQLite.
+
+        :return: None.
+        """
+        rows = self._db.execute("SELECT id, name FROM clients ORDER BY position")
+        self._index_(list(rows))
+        synced_at = self._db.execute(
+            "SELECT value FROM meta WHERE key = 'synced_at'"
+        ).fetchone()
+        self.synced_at = synced_at[0] if synced_at else None
+
+    def _index_(self, clients: list[tuple[int, str]]) -> None:
+        """
+        Добавляет клиентов в индексы. Первый клиент с именем имеет приоритет.
+
+        :param clients: список пар (id, имя) в порядке коллекции.
+        :return: None.
+        """
+        for client_id, name in clients:
+            self.by_name.setdefault(name, client_id)
+            if self.normalized_index:
+                self.by_normalized_name.setdefault(normalize_name(name), client_id)
+        self.count += len(clients)
+
+    def _save_(self, clients: list[tuple[int, str]], start: int) -> None:
+        """
+        Сохраняет клиентов в SQLite.
+
+        :param clients: список пар (id, имя) в порядке коллекции.
+        :param start: позиция первого клиента в коллекции.
+        :return: None.
+        """
+        if self._db is None:
+            return
+        with self._db:
+            if start == 0:
+                self._db.execute("DELETE FROM clients")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO clients (position, id, name) VALUES (?, ?, ?)",
+                [(start + i, client_id, name) for i, (client_id, name) in enumerate(clients)],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('synced_at', ?)",
+                (self.synced_at,),
+            )
+
+    def _fetch_(self, handler, start: int) -> list[tuple[int, str]]:
+        """
+        Запрашивает по API клиентов начиная с указанной позиции.
+
+        :param handler: Handler, через который выполняются запросы.
+        :param start: смещение первого запрашиваемого клиента.
+        :return: список пар (id, имя) в порядке коллекции.
+        """
+        return [
+            (client["id"], client["name"])
+            for client in handler.iter_clients(start_offset=start)
+        ]
+
+    def sync(self, handler) -> None:
+        """
+        Полностью загружает справочник из API.
+
+        :param handler: Handler, через который выполняются запросы.
+        :return: None.
+        """
+        with self._lock:
+            clients = self._fetch_(handler, 0)
+            self.by_name = {}
+            self.by_normalized_name = {}
+            self.count = 0
+            self._index_(clients)
+            self.synced_at = self.clock()
+            self._save_(clients, 0)
+
+    def refresh(self, handler) -> None:
+        """
+        Загружает из API только клиентов, добавленных после последней синхронизации.
+
+        Не откладывает следующую полную синхронизацию.
+        :param handler: Handler, через который выполняются запросы.
+        :return: None.
+        """
+        with self._lock:
+            start = self.count
+            clients = self._fetch_(handler, start)
+            self._index_(clients)
+            # synced_at не меняется: переименованные и удалённые клиенты
+            # подхватываются только полной синхронизацией через max_age
+            self._save_(clients, start)
+
+    def dump(self) -> dict:
+        """
+        Возвращает индекс по имени для сохранения в снимок.
+
+        :return: словарь с индексом, кол-вом известных клиентов и временем синхронизации.
+        """
+        with self._lock:
+            return {"by_name": dict(self.by_name), "count": self.count,
+                    "synced_at": self.synced_at}
+
+    def restore(self, snapshot: dict) -> None:
+        """
+        Загружает индекс, сохранённый dump.
+
+        :param snapshot: снимок, см. dump.
+        :return: None.
+        """
+        with self._lock:
+            self.by_name = {}
+            self.by_normalized_name = {}
+            self._index_([(client_id, name) for name, client_id in snapshot["by_name"].items()])
+            self.count = snapshot["count"]
+            self.synced_at = snapshot["synced_at"]
+
+    def is_stale(self) -> bool:
+        """
+        Проверяет, превышено ли допустимое время с последней полной синхронизации.
+
+        :return: True, если справочник нужно синхронизировать.
+        """
+        return self.synced_at is None or self.clock() - self.synced_at > self.max_age
+
+    def find(self, username: str) -> int | None:
+        """
+        Ищет id клиента по имени только в локальных индексах.
+
+        :param username: имя клиента.
+        :return: id клиента или None.
+        """
+        client_id = self.by_name.get(username)
+        if client_id is None and self.normalized_index:
+            client_id = self.by_normalized_name.get(normalize_name(username))
+        return client_id
+
+    def get_user_id(self, username: str, handler) -> int | None:
+        """
+        Ищет id клиента по имени.
+
+        Если справочник устарел, он полностью синхронизируется.
+        При промахе один раз запрашиваются новые клиенты из API.
+        :param username: имя клиента.
+        :param handler: Handler, через который выполняются запросы.
+        :return: id клиента или None, если клиент не найден.
+        """
+        if self.is_stale():
+            self.sync(handler)
+            return self.find(username)
+
+        client_id = self.find(username)
+        if client_id is None:
+            self.refresh(handler)
+            client_id = self.find(username)
+        return client_id
+
+    def close(self) -> None:
+        """Закрывает соединение с SQLite."""
+        if self._db is not None:
+            self._db.close()
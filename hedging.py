@@ -0,0 +1,94 @@
+import threading
+from collections import deque
+
+from metrics import endpoint_of, percentile
+
+
+class HedgePolicy:
+    """
+    Правило дублирования медленных идемпотентных запросов.
+
+    Для каждого эндпоинта хранит задержки последних успешных запросов.
+    Если запрос выполняется дольше заданного перцентиля этих задержек,
+    Transport отправляет дубликат и возвращает первый полученный ответ.
+    Доля дубликатов ограничена, чтобы при общей деградации API не удваивать нагрузку.
+    Подключается через Transport(hedging=...).
+    """
+
+    def __init__(self, percentile: float = 95.0, min_samples: int = 20,
+                 window: int = 1000, max_ratio: float = 0.1):
+        """
+        Создаёт правило.
+
+        :param percentile: перцентиль задержки, после которого отправляется дубликат.
+        :param min_samples: кол-во наблюдений эндпоинта, до которого дубликаты не отправляются.
+        :param window: кол-во последних задержек эндпоинта, по которым считается перцентиль.
+        :param max_ratio: максимальная доля дубликатов от всех запросов.
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.max_ratio = max_ratio
+
+        self._latencies = {}  # эндпоинт -> deque задержек
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def threshold(self, url: str) -> float | None:
+        """
+        Возвращает задержку, после которой нужно отправить дубликат, и учитывает запрос.
+
+        :param url: url запроса.
+        :return: задержка в секундах или None, если дубликат отправлять не нужно.
+        """
+        with self._lock:
+            self.requests += 1
+            latencies = self._latencies.get(endpoint_of(url))
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            if self.hedged >= self.requests * self.max_ratio:
+                return None
+            return percentile(list(latencies), self.percentile)
+
+    def observe(self, url: str, seconds: float) -> None:
+        """
+        Учитывает задержку успешного запроса.
+
+        :param url: url запроса.
+        :param seconds: задержка в секундах.
+        :return: None.
+        """
+        with self._lock:
+            key = endpoint_of(url)
+            latencies = self._latencies.get(key)
+            if latencies is None:
+                latencies = self._latencies[key] = deque(maxlen=self.window)
+            latencies.append(seconds)
+
+    def on_hedge(self, won: bool) -> None:
+        """
+        Учитывает отправленный дубликат.
+
+        :param won: True, если ответ на дубликат пришёл раньше.
+        :return: None.
+        """
+        with self._lock:
+            self.hedged += 1
+            self.hedge_wins += won
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику дублирования.
+
+        :return: словарь с кол-вом запросов, отправленных дубликатов и дубликатов,
+         ответ на которые пришёл раньше.
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+            }
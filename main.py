@@ -1,52 +1,388 @@
+import copy
+import functools
+import json
+import time
+from collections.abc import Iterator
+from contextlib import closing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import requests
 
+try:
+    import orjson
+except ImportError:  # Необязательная зависимость для быстрого разбора JSON
+    orjson = None
+
+from cache import SingleFlight, TTLCache
+from directory import ClientDirectory
+from mirror import LocalMirror
+from operators import OperatorPool
+from outbox import Outbox
+from pages import PageStore
+from profiles import ClientProfiles
+from tenants import TenantPool
+from transport import DeadlineTransport, Transport
+
+
+def _decode_json_(content: bytes) -> object:
+    """
+    Разбирает JSON ответа API, используя orjson, если он установлен.
+
+    :param content: тело ответа.
+    :return: разобранный JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
 
 class Handler:
-    headers = {"Authorization": ""}
+    api_url = "https://api.chat2desk.com/v1"
 
-    def _retrieve_until_meets_condition_(self, url: str,
-                                         condition, **kwargs) -> object | None:
+    def __init__(
+        self,
+        transport: Transport = None,
+        tag_cache: TTLCache = None,
+        client_directory: ClientDirectory = None,
+        page_workers: int = 1,
+        page_prefetch: int = None,
+        operator_pool: OperatorPool = None,
+        api_url: str = None,
+        instrumentation=None,
+        scheduler=None,
+        outbox: Outbox = None,
+        token: str = "",
+        max_tenants: int = 32,
+        client_profiles: ClientProfiles = None,
+        recorder=None,
+        mirror: LocalMirror = None,
+        trigger_timeout: float = None,
+        page_store: PageStore = None,
+    ):
+        """
+        Создаёт обработчик.
+
+        :param transport: HTTP-транспорт для запросов к API.
+         По умолчанию создаётся новый транспорт с пулом соединений.
+        :param tag_cache: кэш id тегов по названию.
+         По умолчанию создаётся кэш на 128 тегов с временем жизни 5 минут.
+        :param client_directory: локальный справочник клиентов для поиска по имени.
+         Если не указан, клиенты ищутся перебором коллекции по API.
+        :param page_workers: кол-во страниц коллекции, запрашиваемых одновременно.
+         1 - страницы запрашиваются последовательно.
+        :param page_prefetch: максимальное кол-во запрошенных, но ещё не проверенных страниц.
+         По умолчанию вдвое больше page_workers.
+        :param operator_pool: локальный пул операторов для выбора наименее загруженного.
+         Если не указан, выбирается первый оператор из коллекции API.
+        :param api_url: базовый url API. По умолчанию https://api.chat2desk.com/v1.
+        :param instrumentation: объект, получающий события о запросах и обработчиках
+         (см. metrics.Metrics). None - события не собираются.
+        :param scheduler: планировщик запросов с ограничением частоты и повторами
+         (см. scheduler.RequestScheduler). None - запросы выполняются сразу и без повторов.
+        :param outbox: очередь, через которую в фоне отправляются сообщения,
+         назначения тегов и операторов. None - они отправляются сразу.
+        :param token: токен API, с которым работает этот обработчик.
+         Триггеры с другим токеном передаются обработчикам из пула Handler.tenants.
+        :param max_tenants: максимальное кол-во хранимых обработчиков других токенов.
+        :param client_profiles: кэш тегов клиентов по id.
+         Если не указан, клиент запрашивается по API при каждой проверке тега.
+        :param recorder: объект, записывающий входные данные триггеров
+         (см. recorder.TriggerRecorder). None - триггеры не записываются.
+        :param mirror: локальное зеркало диалогов, обращений и загрузки операторов.
+         Если не указано, они запрашиваются по API при каждом обращении.
+        :param trigger_timeout: время в секундах на обработку одного триггера,
+         общее для всех его запросов к API. None - время не ограничено.
+        :param page_store: хранилище страниц коллекций для условных запросов.
+         Если не указано, страницы каждый раз загружаются и разбираются полностью.
+        """
+        self.headers = {"Authorization": token}
+        if api_url:
+            self.api_url = api_url.rstrip("/")
+        self.transport = transport or Transport()
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            self.transport.instrumentation = instrumentation
+        if scheduler is not None:
+            self.transport.scheduler = scheduler
+        self.tag_cache = tag_cache or TTLCache()
+        self.client_directory = client_directory
+        self.flights = SingleFlight()
+
+        self.page_workers = page_workers
+        self.page_prefetch = page_prefetch or page_workers * 2
+        self._page_executor = self._new_page_executor_()
+
+        self.operator_pool = operator_pool
+        self.client_profiles = client_profiles
+        self.recorder = recorder
+        self.mirror = mirror
+        self.trigger_timeout = trigger_timeout
+        self.deadline = None
+        self.page_store = page_store
+        self.tenants = TenantPool(self.for_token, max_tenants, close=Handler.release_connections)
+
+        self.outbox = outbox
+        if outbox is not None:
+            outbox.start(self)
+
+    def coalescing_stats(self) -> dict:
+        """
+        Возвращает статистику объединения одновременных одинаковых запросов.
+
+        :return: словарь с кол-вом вызовов и объединённых вызовов поиска
+         клиентов и пользователей, а также кол-вом объединённых загрузок тегов.
+        """
+        return {**self.flights.stats(), "tags_coalesced": self.tag_cache.flights.coalesced}
+
+    def for_token(self, token: str) -> "Handler":
+        """
+        Создаёт обработчик для другого токена API с теми же настройками.
+
+        У нового обработчика свои заголовки, транспорт и объединение запросов.
+        Кэш тегов, справочник клиентов, кэш профилей, пул операторов, зеркало
+        и хранилище страниц берутся из их метода for_token, так как их данные
+        относятся к одному аккаунту.
+        Метрики, планировщик и очередь записей общие: они разделяют данные по токену сами.
+        :param token: токен API.
+        :return: новый обработчик.
+        """
+        tenant = copy.copy(self)
+        tenant.headers = {"Authorization": token}
+        tenant.transport = self.transport.clone()
+        tenant.flights = SingleFlight()
+        tenant._page_executor = self._new_page_executor_()
+        tenant.tag_cache = self.tag_cache.for_token(token)
+        for name in ("client_directory", "client_profiles", "operator_pool", "mirror",
+                     "page_store"):
+            component = getattr(self, name)
+            if component is not None:
+                setattr(tenant, name, component.for_token(token))
+        return tenant
+
+    def _new_page_executor_(self) -> ThreadPoolExecutor | None:
+        """
+        Создаёт пул потоков для параллельного запроса страниц.
+
+        Пул создаётся вместе с обработчиком, а не при первом переборе, чтобы
+        одновременные переборы и копии обработчика использовали один пул.
+        Потоки пула запускаются только при отправке первых задач.
+        :return: пул потоков или None, если page_workers равен 1.
+        """
+        if self.page_workers > 1:
+            return ThreadPoolExecutor(max_workers=self.page_workers)
+        return None
+
+    def with_deadline(self, seconds: float) -> "Handler":
         """
-        Запрашивает объекты по API до тех пор, пока необходимый объект не будет найден.
+        Создаёт копию обработчика, все запросы которой должны завершиться за указанное время.
+
+        Копия использует тот же транспорт, кэши и пул потоков страниц.
+        Запрос, на который не осталось времени, не выполняется,
+        а таймауты остальных уменьшаются до оставшегося времени.
+        :param seconds: время в секундах, начиная с текущего момента.
+        :return: копия Handler.
+        """
+        view = copy.copy(self)
+        view.deadline = time.monotonic() + seconds
+        view.transport = DeadlineTransport(self.transport, view.deadline)
+        return view
+
+    def release_connections(self) -> None:
+        """Останавливает пул потоков страниц и закрывает соединения транспорта."""
+        if self._page_executor is not None:
+            self._page_executor.shutdown(wait=True, cancel_futures=True)
+            self._page_executor = None
+        self.transport.close()
+
+    def close(self) -> None:
+        """
+        Освобождает ресурсы обработчика.
+
+        Дожидается отправки записей из очереди, освобождает обработчики других токенов,
+        останавливает пул потоков страниц и закрывает соединения транспорта.
+        """
+        if self.outbox is not None:
+            self.outbox.close()
+        self.tenants.clear()
+        self.release_connections()
+
+    def _fetch_page_(self, url: str, limit: int, offset: int) -> dict:
+        """
+        Запрашивает одну страницу коллекции.
 
         :param url: url для API запроса
-        :param condition: метод, который будет проверять,
-         есть ли искомый объект среди полученных
-        :param kwargs: аргументы, передаваемые в метод condition
-        :return: Искомый объект или None
+        :param limit: кол-во объектов на странице
+        :param offset: смещение первого объекта страницы
+        :return: json страницы
+        """
+        params = {"limit": limit, "offset": offset}
+        if self.page_store is None:
+            response = self.transport.get(url, params=params, headers=self.headers)
+            response.raise_for_status()
+            return _decode_json_(response.content)
+
+        key = (self.headers["Authorization"], url, limit, offset)
+        page = self.page_store.get(key)
+        response = self.transport.get(
+            url, params=params,
+            headers={**self.headers, **self.page_store.conditional_headers(page)},
+        )
+        response.raise_for_status()
+        return self.page_store.resolve(key, page, response, _decode_json_)
+
+    def _iter_pages_(self, url: str, start_offset: int = 0, parallel: bool = False,
+                     ordered: bool = True) -> Iterator[dict]:
+        """
+        Перебирает страницы коллекции API.
+
+        Без parallel следующая страница запрашивается только когда перебрана предыдущая,
+        поэтому прекращение перебора не порождает лишних запросов.
+        Если parallel и Handler.page_workers больше 1, страницы после первой
+        запрашиваются параллельно, не более Handler.page_prefetch одновременно.
+        При закрытии итератора ещё не начатые запросы отменяются.
+        :param url: url для API запроса
+        :param start_offset: смещение, с которого начинается перебор
+        :param parallel: True, если страницы после первой нужно запрашивать параллельно
+        :param ordered: True, если страницы отдаются в порядке коллекции.
+         False - в порядке получения. Используется только с parallel.
+        :return: итератор json страниц
         """
-        offset = 0
-        offset_step = 200
         limit = 200
-        remaining = None
+        pages = 0
+        in_flight = []  # Запросы в порядке коллекции
 
-        params = {"limit": limit, "offset": offset}
+        try:
+            resp_json = self._fetch_page_(url, limit, start_offset)
+            pages += 1
+            offsets = range(start_offset + limit, resp_json["meta"]["total"], limit)
+            yield resp_json
+
+            if not (parallel and self.page_workers > 1):
+                for offset in offsets:
+                    resp_json = self._fetch_page_(url, limit, offset)
+                    pages += 1
+                    yield resp_json
+                return
+
+            pending_offsets = iter(offsets)
+
+            def submit_next() -> None:
+                offset = next(pending_offsets, None)
+                if offset is not None:
+                    in_flight.append(
+                        self._page_executor.submit(self._fetch_page_, url, limit, offset)
+                    )
+
+            for _ in range(self.page_prefetch):
+                submit_next()
+
+            while in_flight:
+                if ordered:
+                    future = in_flight.pop(0)
+                else:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    future = done.pop()
+                    in_flight.remove(future)
+
+                resp_json = future.result()
+                pages += 1
+                yield resp_json
+                submit_next()
+        finally:
+            for future in in_flight:
+                future.cancel()
+            if self.instrumentation is not None:
+                self.instrumentation.on_pages(url, pages)
+
+    def _iter_collection_(self, url: str, fields: tuple = None,
+                          start_offset: int = 0) -> Iterator[dict]:
+        """
+        Лениво перебирает объекты коллекции API по страницам.
+
+        Следующая страница запрашивается только когда объекты предыдущей перебраны,
+        поэтому прекращение перебора не порождает лишних запросов.
+        Страница разбирается целиком, поэтому fields уменьшает только объём данных,
+        который остаётся у вызывающего кода, а не пиковое потребление памяти.
+        Объекты отдаются новыми словарями: с fields это сама проекция, без fields
+        при заданном Handler.page_store - поверхностная копия, так как сохранённые
+        страницы общие для всех вызовов. Вложенные значения общие, их изменять нельзя.
+        :param url: url для API запроса
+        :param fields: поля, которые нужно оставить у объектов. None - все поля.
+        :param start_offset: смещение, с которого начинается перебор
+        :return: итератор объектов коллекции
+        """
+        with closing(self._iter_pages_(url, start_offset)) as pages:
+            for resp_json in pages:
+                for record in resp_json["data"]:
+                    if fields is not None:
+                        record = {field: record.get(field) for field in fields}
+                    elif self.page_store is not None:
+                        record = dict(record)
+                    yield record
+
+    def iter_operators(self, fields: tuple = ("id", "opened_dialogs"),
+                       start_offset: int = 0) -> Iterator[dict]:
+        """
+        Лениво перебирает операторов.
+
+        :param fields: поля, которые нужно оставить у операторов. None - все поля.
+        :param start_offset: смещение, с которого начинается перебор.
+        :return: итератор операторов.
+        """
+        return self._iter_collection_(
+            f"{self.api_url}/operators/", fields, start_offset
+        )
+
+    def iter_clients(self, fields: tuple = ("id", "name"),
+                     start_offset: int = 0) -> Iterator[dict]:
+        """
+        Лениво перебирает клиентов.
+
+        :param fields: поля, которые нужно оставить у клиентов. None - все поля.
+        :param start_offset: смещение, с которого начинается перебор.
+        :return: итератор клиентов.
+        """
+        return self._iter_collection_(
+            f"{self.api_url}/clients/", fields, start_offset
+        )
 
-        with requests.Session() as ses:
-            ses.headers = self.headers.copy()
-            while True:
-                params["limit"] = limit
-                params["offset"] = offset
+    def iter_tags(self, fields: tuple = ("id", "label"),
+                  start_offset: int = 0) -> Iterator[dict]:
+        """
+        Лениво перебирает теги.
 
-                response = ses.get(url, params=params)
-                response.raise_for_status()
+        :param fields: поля, которые нужно оставить у тегов. None - все поля.
+        :param start_offset: смещение, с которого начинается перебор.
+        :return: итератор тегов.
+        """
+        return self._iter_collection_(
+            f"{self.api_url}/tags/", fields, start_offset
+        )
 
-                resp_json = response.json()
+    def _retrieve_until_meets_condition_(self, url: str,
+                                         condition, start_offset: int = 0,
+                                         ordered: bool = True,
+                                         **kwargs) -> object | None:
+        """
+        Запрашивает объекты по API до тех пор, пока необходимый объект не будет найден.
 
+        Если Handler.page_workers больше 1, страницы после первой запрашиваются параллельно.
+        :param url: url для API запроса
+        :param condition: метод, который будет проверять,
+         есть ли искомый объект среди полученных
+        :param start_offset: смещение, с которого начинается запрос объектов
+        :param ordered: True, если condition должен получать страницы в порядке коллекции
+         и возвращаться должен первый по порядку подходящий объект.
+         False - страницы проверяются в порядке получения.
+        :param kwargs: аргументы, передаваемые в метод condition
+        :return: Искомый объект или None
+        """
+        with closing(self._iter_pages_(url, start_offset, True, ordered)) as pages:
+            for resp_json in pages:
                 result = condition(resp_json, **kwargs)
                 if result:
                     return result
-
-                if remaining is None:
-                    remaining = resp_json["meta"]["total"]
-
-                remaining -= (
-                    limit  # Вычитаем из общего числа объектов кол-во полученных
-                )
-                offset += offset_step  # Для запроса следующей пачку
-
-                if remaining <= 0:  # Если объектов не осталось
-                    return None
+        return None
 
     def available_operator_condition(self, resp_json: dict) -> int | None:
         """
@@ -103,13 +439,17 @@ class Handler:
         :param dialog_id: id диалога у запроса
         :return: id оператора если он найден, в противном случае -1.
         """
-        client_data = self.get_client_by_id(client_id)
+        tags = self.get_client_tags(client_id)
         tag_id = self.get_tag_id_by_label(tag_label)
 
-        if client_data and tag_id and self.client_has_tag(client_data["data"], tag_id):
+        if tags is not None and tag_id and tag_id in tags:
             operator_id = self.get_available_operator()
             if operator_id:
-                self.send_message_to_user(client_id, "Оператор найден", False, "system")
+                try:
+                    self.send_message_to_user(client_id, "Оператор найден", False, "system")
+                except requests.exceptions.RequestException:
+                    self.release_operator(operator_id)
+                    raise
                 self.set_operator_to_dialog(dialog_id, operator_id, "OPEN")
                 return operator_id
             else:
@@ -156,6 +496,22 @@ class Handler:
                 return True
         return False
 
+    def get_client_tags(self, client_id: int) -> frozenset | None:
+        """
+        Получает id тегов клиента.
+
+        Если задан Handler.client_profiles, теги берутся из кэша профилей.
+        :param client_id: id клиента.
+        :return: множество id тегов. None, если клиент не найден или запрос не успешен.
+        """
+        if self.client_profiles is not None:
+            return self.client_profiles.get_tags(client_id, self)
+
+        client_data = self.get_client_by_id(client_id)
+        if not client_data:
+            return None
+        return frozenset(tag["id"] for tag in client_data["data"]["tags"])
+
     def get_client_by_id(self, client_id: int) -> dict | None:
         """
         Запрашивает по API данные клиента с указанным id.
@@ -164,14 +520,17 @@ class Handler:
         :return: json-данные клиента если он найден.
          None, если не найден или ответ вернулся с ошибкой.
         """
-        response = requests.get(
-            f"https://api.chat2desk.com/v1/clients/{client_id}", headers=self.headers
-        )
+        def fetch() -> dict | None:
+            response = self.transport.get(
+                f"{self.api_url}/clients/{client_id}", headers=self.headers
+            )
 
-        if response.ok:
-            return response.json()
+            if response.ok:
+                return response.json()
 
-        return None
+            return None
+
+        return self.flights.do(("client", self.headers["Authorization"], client_id), fetch)
 
     def set_operator_to_dialog(
         self,
@@ -184,6 +543,47 @@ class Handler:
         Присваивает оператора диалогу.
 
         Выбрасывает исключение, если результат запроса не успешен.
+        Если задана Handler.outbox, запрос ставится в очередь и метод сразу завершается.
+        Резервирование оператора в этом случае снимается, только если запись
+        становится неотправляемой.
+        :param dialog_id: id диалога.
+        :param operator_id: id оператора.
+        :param state: "OPEN" для того, чтобы открыть диалог. "CLOSE", чтобы не открывать.
+        :param initiator_id: id инициатора диалога. По умолчанию будет установлен id оператора.
+        :return: None.
+        """
+        if self.outbox is not None:
+            self.outbox.put(
+                f"dialog:{dialog_id}",
+                "_assign_operator_",
+                self.headers["Authorization"],
+                on_dead=("release_operator", {"operator_id": operator_id}),
+                method="PUT",
+                dialog_id=dialog_id,
+                operator_id=operator_id,
+                state=state,
+                initiator_id=initiator_id,
+            )
+            return
+
+        try:
+            self._assign_operator_(dialog_id, operator_id, state, initiator_id)
+        except requests.exceptions.RequestException:
+            self.release_operator(operator_id)
+            raise
+
+    def _assign_operator_(
+        self,
+        dialog_id: int,
+        operator_id: int,
+        state: str = None,
+        initiator_id: int = None,
+    ) -> None:
+        """
+        Отправляет запрос присвоения оператора диалогу и подтверждает резервирование.
+
+        В отличие от set_operator_to_dialog не снимает резервирование при ошибке,
+        поэтому используется очередью записей для повторов.
         :param dialog_id: id диалога.
         :param operator_id: id оператора.
         :param state: "OPEN" для того, чтобы открыть диалог. "CLOSE", чтобы не открывать.
@@ -201,28 +601,44 @@ class Handler:
             "initiator_id": initiator_id,
         }
 
-        response = requests.put(
-            f" https://api.chat2desk.com/v1/dialogs/{dialog_id}",
+        response = self.transport.put(
+            f"{self.api_url}/dialogs/{dialog_id}",
             headers=self.headers,
             data=body,
         )
         response.raise_for_status()
 
+        if self.operator_pool is not None:
+            self.operator_pool.assigned(operator_id)
+        if self.mirror is not None:
+            if state.lower() == "open":
+                self.mirror.assigned(dialog_id, operator_id)
+            else:  # Закрытый диалог не увеличивает загрузку
+                self.mirror.release(operator_id)
+
     def get_client_id_by_dialog_id(self, dialog_id: int) -> int | None:
         """
         Запрашивает по API id клиента у диалога с  указанным id.
 
+        Если задано Handler.mirror, id берётся из зеркала, пока оно не устарело.
         :param dialog_id: id диалога.
         :return: id клиента, если запрос успешен. None, если нет.
         """
-        response = requests.get(
-            f" https://api.chat2desk.com/v1/dialogs/{dialog_id}", headers=self.headers
+        if self.mirror is not None:
+            client_id = self.mirror.client_id_by_dialog(dialog_id)
+            if client_id is not None:
+                return client_id
+
+        response = self.transport.get(
+            f"{self.api_url}/dialogs/{dialog_id}", headers=self.headers
         )
 
         if response.ok:
             json = response.json()
             last_msg = json["data"]["last_message"]
             client_id = last_msg["client_id"]
+            if self.mirror is not None:
+                self.mirror.store_dialog(dialog_id, client_id)
             return client_id
 
         return None
@@ -231,16 +647,25 @@ class Handler:
         """
         Получает данные обращения по id.
 
+        Если задано Handler.mirror, данные берутся из зеркала, пока оно не устарело.
         :param request_id: id обращения.
         :return: json-данные обращения, если оно найдено.
         None, если не найдено или запрос не успешен.
         """
-        response = requests.get(
-            f"https://api.chat2desk.com/v1/requests/{request_id}", headers=self.headers
+        if self.mirror is not None:
+            request = self.mirror.request(request_id)
+            if request is not None:
+                return request
+
+        response = self.transport.get(
+            f"{self.api_url}/requests/{request_id}", headers=self.headers
         )
 
         if response.ok:
-            return response.json()
+            request = response.json()
+            if self.mirror is not None:
+                self.mirror.store_request(request_id, request)
+            return request
 
         return None
 
@@ -248,33 +673,68 @@ class Handler:
         """
         Получает первого доступного оператора.
 
+        Если задан Handler.operator_pool, выбирает наименее загруженного оператора
+        и резервирует за ним диалог до вызова set_operator_to_dialog или release_operator.
+        Иначе, если задано Handler.mirror, оператор выбирается по загрузке из зеркала
+        и так же резервируется в нём.
         :return: id оператора, если он найден. None, если нет.
         """
+        if self.operator_pool is not None:
+            return self.operator_pool.reserve(self)
+        if self.mirror is not None:
+            return self.mirror.available_operator(self)
+
         return self._retrieve_until_meets_condition_(
-            "https://api.chat2desk.com/v1/operators/", self.available_operator_condition
+            f"{self.api_url}/operators/", self.available_operator_condition
         )
 
+    def release_operator(self, operator_id: int) -> None:
+        """
+        Снимает резервирование оператора, полученного из get_available_operator.
+
+        :param operator_id: id оператора.
+        :return: None.
+        """
+        if self.operator_pool is not None:
+            self.operator_pool.release(operator_id)
+        elif self.mirror is not None:
+            self.mirror.release(operator_id)
+
     def assign_tag_to_client(self, client_id: int, tag_id: int) -> None:
         """
         Присваивает тег клиенту.
 
         Выбрасывает исключение, если результат запроса не успешен.
+        Если задана Handler.outbox, запрос ставится в очередь и метод сразу завершается.
+        Если задан Handler.client_profiles, тег сразу добавляется в профиль клиента.
         :param client_id: id клиента.
         :param tag_id: id тега.
         :return: None.
         """
-        body = {
-            "assignee_id": client_id,
-            "tag_ids": [tag_id],
-            "assignee_type": "client",
-        }
+        if self.outbox is not None:
+            self.outbox.put(
+                f"client:{client_id}",
+                "assign_tag_to_client",
+                self.headers["Authorization"],
+                client_id=client_id,
+                tag_id=tag_id,
+            )
+        else:
+            body = {
+                "assignee_id": client_id,
+                "tag_ids": [tag_id],
+                "assignee_type": "client",
+            }
+
+            response = self.transport.post(
+                f"{self.api_url}/tags/assign_to",
+                headers=self.headers,
+                data=body,
+            )
+            response.raise_for_status()
 
-        response = requests.post(
-            "https://api.chat2desk.com/v1/tags/assign_to",
-            headers=self.headers,
-            data=body,
-        )
-        response.raise_for_status()
+        if self.client_profiles is not None:
+            self.client_profiles.add_tag(client_id, tag_id)
 
     def get_user_id_by_username(self, username: str) -> int | None:
         """
@@ -283,23 +743,33 @@ class Handler:
         :param username: искомое имя пользователя.
         :return: id пользователя, если найден пользователь с указанным именем. None, если нет.
         """
-        return self._retrieve_until_meets_condition_(
-            "https://api.chat2desk.com/v1/clients/",
-            self.user_id_by_name_condition,
-            username=username,
-        )
+        def find() -> int | None:
+            if self.client_directory is not None:
+                return self.client_directory.get_user_id(username, self)
+
+            return self._retrieve_until_meets_condition_(
+                f"{self.api_url}/clients/",
+                self.user_id_by_name_condition,
+                username=username,
+            )
+
+        return self.flights.do(("username", self.headers["Authorization"], username), find)
 
     def get_tag_id_by_label(self, label: str) -> int | None:
         """
         Ищет тег по его названию.
 
+        Результат, в том числе отсутствие тега, кэшируется в Handler.tag_cache.
         :param label: название тега.
         :return: id тега, если найден тег с таким названием. None, если нет.
         """
-        return self._retrieve_until_meets_condition_(
-            "https://api.chat2desk.com/v1/tags/",
-            self.tag_id_by_label_condition,
-            label=label,
+        return self.tag_cache.get_or_load(
+            label,
+            lambda: self._retrieve_until_meets_condition_(
+                f"{self.api_url}/tags/",
+                self.tag_id_by_label_condition,
+                label=label,
+            ),
         )
 
     def send_message_to_user(
@@ -309,12 +779,25 @@ class Handler:
         Отправляет клиенту сообщение.
 
         Выбрасывает исключение, если результат запроса не успешен.
+        Если задана Handler.outbox, запрос ставится в очередь и метод сразу завершается.
         :param client_id: id клиента.
         :param text: Текст сообщения.
         :param open_dialog: Флаг, True, если диалог необходимо открыть. False, если нет.
         :param type: Тип сообщения.
         :return: None.
         """
+        if self.outbox is not None:
+            self.outbox.put(
+                f"client:{client_id}",
+                "send_message_to_user",
+                self.headers["Authorization"],
+                client_id=client_id,
+                text=text,
+                open_dialog=open_dialog,
+                type=type,
+            )
+            return
+
         params = {
             "client_id": client_id,
             "text": text,
@@ -322,8 +805,8 @@ class Handler:
             "type": type,
         }
 
-        response = requests.post(
-            "https://api.chat2desk.com/v1/messages", headers=self.headers, params=params
+        response = self.transport.post(
+            f"{self.api_url}/messages", headers=self.headers, params=params
         )
         response.raise_for_status()
 
@@ -335,18 +818,32 @@ class Handler:
         :param c2d: Объект c2d.
         :return: Результат обработки.
         """
-        self.headers["Authorization"] = c2d.token
+        if c2d.token != self.headers["Authorization"]:
+            with self.tenants.lease(c2d.token) as tenant:
+                return tenant.manually_handler(input_data, c2d)
+        if self.trigger_timeout is not None and self.deadline is None:
+            return self.with_deadline(self.trigger_timeout).manually_handler(input_data, c2d)
+
+        started = time.perf_counter()
+        if self.recorder is not None:
+            self.recorder.record("manually_handler", input_data)
         client_name = input_data.get("name", "")
 
+        succeeded = False
         result = f"Failed assign VIP tag for client with name {client_name}"
         try:
             if self.process_external_post_request(client_name, "VIP"):
                 result = f"Assigned VIP tag for client with name {client_name}"
+                succeeded = True
         except requests.exceptions.Timeout:
             print("Request timed out")
         except requests.exceptions.RequestException as e:
             print(f"Exception raised by request method: {e}")
 
+        if self.instrumentation is not None:
+            self.instrumentation.on_handler(
+                "manually_handler", time.perf_counter() - started, succeeded
+            )
         return result
 
     def new_request_handler(self, input_data, c2d):
@@ -357,19 +854,104 @@ class Handler:
         :param c2d: Объект c2d.
         :return: Результат обработки.
         """
-        self.headers["Authorization"] = c2d.token
+        if c2d.token != self.headers["Authorization"]:
+            with self.tenants.lease(c2d.token) as tenant:
+                return tenant.new_request_handler(input_data, c2d)
+        if self.trigger_timeout is not None and self.deadline is None:
+            return self.with_deadline(self.trigger_timeout).new_request_handler(input_data, c2d)
+
+        started = time.perf_counter()
+        if self.recorder is not None:
+            self.recorder.record("new_request_handler", input_data)
         client_id = input_data.get("client_id", "")
         dialog_id = input_data.get("dialog_id", "")
 
+        succeeded = False
         result = f"Failed to attach operator for client with id {client_id}"
 
         try:
             operator_id = self.process_new_request("VIP", client_id, dialog_id)
             if operator_id != -1:
                 result = f"Attached operator with {operator_id} for client with id {client_id}"
+                succeeded = True
         except requests.exceptions.Timeout:
             print("Request timed out")
         except requests.exceptions.RequestException as e:
             print(f"Exception raised by request method: {e}")
 
+        if self.instrumentation is not None:
+            self.instrumentation.on_handler(
+                "new_request_handler", time.perf_counter() - started, succeeded
+            )
         return result
+
+    def _batch_view_(self) -> "Handler":
+        """
+        Создаёт копию обработчика для одной пачки триггеров.
+
+        Копия использует тот же транспорт и кэши, но запоминает результаты
+        запросов клиентов на время пачки и распределяет операторов через общий
+        для пачки снимок загрузки.
+        :return: копия Handler.
+        """
+        batch = copy.copy(self)
+        batch.get_client_by_id = functools.lru_cache(maxsize=None)(self.get_client_by_id)
+        batch.get_user_id_by_username = functools.lru_cache(maxsize=None)(
+            self.get_user_id_by_username
+        )
+        if batch.operator_pool is None:
+            batch.operator_pool = OperatorPool()
+        return batch
+
+    def manually_batch_handler(self, inputs: list, c2d) -> list:
+        """
+        Обработчик пачки триггеров из внешних систем.
+
+        Одинаковые запросы тегов и клиентов выполняются один раз на пачку.
+        Ошибка обработки одного триггера не влияет на остальные.
+        :param inputs: Список входных данных триггеров.
+        :param c2d: Объект c2d.
+        :return: Список результатов обработки в порядке входных данных.
+        """
+        if c2d.token != self.headers["Authorization"]:
+            with self.tenants.lease(c2d.token) as tenant:
+                return tenant.manually_batch_handler(inputs, c2d)
+
+        batch = self._batch_view_()
+        results = []
+        for input_data in inputs:
+            try:
+                results.append(batch.manually_handler(input_data, c2d))
+            except Exception as e:
+                print(f"Exception raised while processing trigger: {e}")
+                name = input_data.get("name", "") if isinstance(input_data, dict) else ""
+                results.append(f"Failed assign VIP tag for client with name {name}")
+        return results
+
+    def new_request_batch_handler(self, inputs: list, c2d) -> list:
+        """
+        Обработчик пачки новых обращений.
+
+        Одинаковые запросы тегов и клиентов выполняются один раз на пачку,
+        операторы распределяются по наименьшей загрузке за один снимок.
+        Ошибка обработки одного обращения не влияет на остальные.
+        :param inputs: Список входных данных обращений.
+        :param c2d: Объект c2d.
+        :return: Список результатов обработки в порядке входных данных.
+        """
+        if c2d.token != self.headers["Authorization"]:
+            with self.tenants.lease(c2d.token) as tenant:
+                return tenant.new_request_batch_handler(inputs, c2d)
+
+        batch = self._batch_view_()
+        results = []
+        for input_data in inputs:
+            try:
+                results.append(batch.new_request_handler(input_data, c2d))
+            except Exception as e:
+                print(f"Exception raised while processing trigger: {e}")
+                client_id = (
+                    input_data.get("client_id", "") if isinstance(input_data, dict) else ""
+                )
+                results.append(f"Failed to attach operator for client with id {client_id}")
+        return results
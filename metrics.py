@@ -0,0 +1,261 @@
+import math
+import re
+import threading
+from urllib.parse import urlsplit
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PAGES_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def endpoint_of(url: str) -> str:
+    """
+    Возвращает эндпоинт API без id объектов, пригодный для метки метрики.
+
+    :param url: url запроса.
+    :return: путь запроса, в котором числовые id заменены на {id}.
+    """
+    path = urlsplit(url.strip()).path
+    if path.startswith("/v1/"):
+        path = path[3:]
+    return re.sub(r"/\d+", "/{id}", path)
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    Считает перцентиль методом ближайшего ранга.
+
+    :param values: значения.
+    :param q: перцентиль от 0 до 100.
+    :return: значение перцентиля или 0, если значений нет.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(q / 100 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+class Histogram:
+    """Гистограмма наблюдений с фиксированными границами корзин."""
+
+    def __init__(self, buckets: tuple):
+        """
+        Создаёт пустую гистограмму.
+
+        :param buckets: верхние границы корзин по возрастанию.
+        """
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """
+        Добавляет наблюдение.
+
+        :param value: значение.
+        :return: None.
+        """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """
+        Возвращает накопленные значения корзин в формате Prometheus.
+
+        :return: список пар (граница le, кол-во наблюдений не больше границы).
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((f"{bound:g}", total))
+        result.append(("+Inf", self.count))
+        return result
+
+    def snapshot(self) -> dict:
+        """Возвращает состояние гистограммы в виде словаря."""
+        return {"buckets": dict(self.cumulative()), "sum": self.sum, "count": self.count}
+
+
+def _labels_(names: tuple, values: tuple, extra: str = "") -> str:
+    """
+    Формирует набор меток Prometheus.
+
+    :param names: названия меток.
+    :param values: значения меток.
+    :param extra: дополнительные метки в готовом виде.
+    :return: строка вида {a="1",b="2"}.
+    """
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metrics:
+    """
+    Сборщик метрик запросов к API и обработчиков триггеров.
+
+    Передаётся в Handler(instrumentation=...) и получает события от Transport и Handler.
+    Метрики доступны словарём через snapshot() и в текстовом формате Prometheus
+    через to_prometheus().
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS, prefix: str = "chat2desk"):
+        """
+        Создаёт сборщик метрик.
+
+        :param buckets: границы корзин гистограмм длительности в секундах.
+        :param prefix: префикс названий метрик Prometheus.
+        """
+        self.buckets = buckets
+        self.prefix = prefix
+        self._lock = threading.Lock()
+
+        self.request_duration = {}  # (method, endpoint) -> Histogram
+        self.requests = {}  # (method, endpoint, status) -> кол-во
+        self.retries = {}  # (method, endpoint) -> кол-во
+        self.bytes = {}  # (method, endpoint, direction) -> кол-во байт
+        self.pages = {}  # (endpoint,) -> Histogram
+        self.handler_duration = {}  # (handler,) -> Histogram
+        self.handler_calls = {}  # (handler, outcome) -> кол-во
+
+    def _histogram_(self, histograms: dict, key: tuple, buckets: tuple) -> Histogram:
+        """Возвращает гистограмму по ключу, создавая её при необходимости."""
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        return histogram
+
+    def on_request(self, method: str, url: str, status: int | str, seconds: float,
+                   sent: int, received: int) -> None:
+        """
+        Учитывает выполненный запрос к API.
+
+        :param method: HTTP метод.
+        :param url: url запроса.
+        :param status: код ответа или "error", если ответ не получен.
+        :param seconds: длительность запроса.
+        :param sent: размер тела запроса в байтах.
+        :param received: размер тела ответа в байтах.
+        :return: None.
+        """
+        endpoint = endpoint_of(url)
+        with self._lock:
+            self._histogram_(
+                self.request_duration, (method, endpoint), self.buckets
+            ).observe(seconds)
+            key = (method, endpoint, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for direction, size in (("sent", sent), ("received", received)):
+                key = (method, endpoint, direction)
+                self.bytes[key] = self.bytes.get(key, 0) + size
+
+    def on_retry(self, method: str, url: str) -> None:
+        """
+        Учитывает повтор запроса к API.
+
+        :param method: HTTP метод.
+        :param url: url запроса.
+        :return: None.
+        """
+        key = (method, endpoint_of(url))
+        with self._lock:
+            self.retries[key] = self.retries.get(key, 0) + 1
+
+    def on_pages(self, url: str, pages: int) -> None:
+        """
+        Учитывает кол-во страниц, запрошенных при переборе коллекции.
+
+        :param url: url коллекции.
+        :param pages: кол-во запрошенных страниц.
+        :return: None.
+        """
+        with self._lock:
+            self._histogram_(self.pages, (endpoint_of(url),), PAGES_BUCKETS).observe(pages)
+
+    def on_handler(self, name: str, seconds: float, succeeded: bool) -> None:
+        """
+        Учитывает вызов обработчика триггера.
+
+        :param name: название обработчика.
+        :param seconds: длительность обработки.
+        :param succeeded: True, если обработка завершилась успешным результатом.
+        :return: None.
+        """
+        outcome = "success" if succeeded else "failure"
+        with self._lock:
+            self._histogram_(self.handler_duration, (name,), self.buckets).observe(seconds)
+            key = (name, outcome)
+            self.handler_calls[key] = self.handler_calls.get(key, 0) + 1
+
+    def snapshot(self) -> dict:
+        """
+        Возвращает текущие значения метрик.
+
+        :return: словарь, ключи вложенных словарей - значения меток через пробел.
+        """
+        def flat(values: dict) -> dict:
+            return {
+                " ".join(key): value.snapshot() if isinstance(value, Histogram) else value
+                for key, value in values.items()
+            }
+
+        with self._lock:
+            return {
+                "request_duration_seconds": flat(self.request_duration),
+                "requests_total": flat(self.requests),
+                "retries_total": flat(self.retries),
+                "bytes_total": flat(self.bytes),
+                "pages_per_scan": flat(self.pages),
+                "handler_duration_seconds": flat(self.handler_duration),
+                "handler_calls_total": flat(self.handler_calls),
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Возвращает метрики в текстовом формате Prometheus.
+
+        :return: текст для отдачи по /metrics.
+        """
+        lines = []
+
+        def histogram(name: str, help_text: str, label_names: tuple, values: dict) -> None:
+            lines.append(f"# HELP {self.prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {self.prefix}_{name} histogram")
+            for key, hist in sorted(values.items()):
+                for le, count in hist.cumulative():
+                    labels = _labels_(label_names, key, f'le="{le}"')
+                    lines.append(f"{self.prefix}_{name}_bucket{labels} {count}")
+                labels = _labels_(label_names, key)
+                lines.append(f"{self.prefix}_{name}_sum{labels} {hist.sum}")
+                lines.append(f"{self.prefix}_{name}_count{labels} {hist.count}")
+
+        def counter(name: str, help_text: str, label_names: tuple, values: dict) -> None:
+            lines.append(f"# HELP {self.prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {self.prefix}_{name} counter")
+            for key, value in sorted(values.items()):
+                lines.append(f"{self.prefix}_{name}{_labels_(label_names, key)} {value}")
+
+        with self._lock:
+            histogram("api_request_duration_seconds", "Duration of Chat2Desk API requests.",
+                      ("method", "endpoint"), self.request_duration)
+            counter("api_requests_total", "Chat2Desk API requests by status code.",
+                    ("method", "endpoint", "status"), self.requests)
+            counter("api_retries_total", "Retried Chat2Desk API requests.",
+                    ("method", "endpoint"), self.retries)
+            counter("api_bytes_total", "Bytes sent and received from Chat2Desk API.",
+                    ("method", "endpoint", "direction"), self.bytes)
+            histogram("api_pages_per_scan", "Pages fetched per collection scan.",
+                      ("endpoint",), self.pages)
+            histogram("handler_duration_seconds", "Duration of trigger handlers.",
+                      ("handler",), self.handler_duration)
+            counter("handler_calls_total", "Trigger handler calls by outcome.",
+                    ("handler", "outcome"), self.handler_calls)
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,350 @@
+import json
+import os
+import threading
+import time
+
+# Типы событий вебхуков Chat2Desk, меняющие оператора и состояние диалога.
+# Из остальных событий (inbox, outbox, new_request) берутся id клиента и обращения.
+CLOSE_EVENTS = frozenset({"close_dialog"})
+ASSIGN_EVENTS = frozenset({"dialog_transferred", "dialog_assigned"})
+
+
+class LocalMirror:
+    """
+    Локальное зеркало диалогов, обращений и загрузки операторов.
+
+    Обновляется событиями вебхуков Chat2Desk (сообщения, новые обращения,
+    назначение и закрытие диалогов) и периодической синхронизацией с API.
+    Чтение обслуживается из памяти, пока данные не старше max_staleness,
+    иначе Handler запрашивает API и обновляет зеркало.
+    Состояние можно сохранять в файл и загружать из него при запуске.
+    Подключается через Handler(mirror=...). Копии Handler.for_token получают
+    отдельные зеркала, события для них передаются через обработчики
+    Handler.tenants.
+    """
+
+    def __init__(
+        self,
+        max_staleness: float = 60.0,
+        max_dialogs: int = 5,
+        snapshot_path: str = None,
+        clock=time.time,
+    ):
+        """
+        Создаёт зеркало и загружает снимок, если он есть.
+
+        :param max_staleness: время в секундах, в течение которого данные отдаются без API.
+        :param max_dialogs: кол-во открытых диалогов, при котором оператор считается занятым.
+        :param snapshot_path: путь к файлу снимка. None - снимок не используется.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.max_staleness = max_staleness
+        self.max_dialogs = max_dialogs
+        self.snapshot_path = snapshot_path
+        self.clock = clock
+
+        self.dialogs = {}  # id диалога -> [id клиента, id оператора, открыт ли, обновлён в]
+        self.requests = {}  # id обращения -> (json-данные обращения, обновлено в)
+        self.operators = {}  # id оператора -> кол-во открытых диалогов, в порядке коллекции
+        self.reserved = {}  # id оператора -> кол-во неподтверждённых резервирований
+        self.operators_synced_at = None
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.events = 0
+
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.load_snapshot()
+
+    def for_token(self, token: str) -> "LocalMirror":
+        """
+        Создаёт пустое зеркало без снимка с теми же настройками для другого токена API.
+
+        :param token: токен API.
+        :return: новое зеркало.
+        """
+        return LocalMirror(self.max_staleness, self.max_dialogs, clock=self.clock)
+
+    def _fresh_(self, updated_at: float | None) -> bool:
+        """Проверяет, не устарели ли данные, обновлённые в указанный момент."""
+        return updated_at is not None and self.clock() - updated_at <= self.max_staleness
+
+    def _move_dialog_(self, dialog: list, operator_id: int | None, opened: bool) -> None:
+        """
+        Меняет оператора и состояние диалога и пересчитывает загрузку операторов.
+
+        Вызывается под блокировкой.
+        :param dialog: запись диалога.
+        :param operator_id: новый id оператора.
+        :param opened: новое состояние диалога.
+        :return: None.
+        """
+        _, old_operator_id, was_opened, _ = dialog
+        if was_opened and old_operator_id in self.operators:
+            self.operators[old_operator_id] = max(self.operators[old_operator_id] - 1, 0)
+        if opened and operator_id in self.operators:
+            self.operators[operator_id] += 1
+        dialog[1], dialog[2], dialog[3] = operator_id, opened, self.clock()
+
+    def _dialog_(self, dialog_id: int) -> list:
+        """Возвращает запись диалога, создавая её. Вызывается под блокировкой."""
+        dialog = self.dialogs.get(dialog_id)
+        if dialog is None:
+            dialog = self.dialogs[dialog_id] = [None, None, False, self.clock()]
+        return dialog
+
+    def apply(self, event: dict) -> None:
+        """
+        Применяет событие вебхука.
+
+        :param event: json события с полем hook_type и полями dialog_id, client_id,
+         operator_id, request_id в зависимости от типа.
+        :return: None.
+        """
+        hook_type = event.get("hook_type")
+        dialog_id = event.get("dialog_id")
+        now = self.clock()
+        with self._lock:
+            self.events += 1
+            if hook_type == "new_request" and event.get("request_id") is not None:
+                data = {
+                    key: event[key]
+                    for key in ("client_id", "dialog_id")
+                    if event.get(key) is not None
+                }
+                data["id"] = event["request_id"]
+                self.requests[event["request_id"]] = ({"data": data}, now)
+
+            if dialog_id is None:
+                return
+            dialog = self._dialog_(dialog_id)
+            if event.get("client_id") is not None:
+                dialog[0] = event["client_id"]
+                dialog[3] = now
+
+            if hook_type in ASSIGN_EVENTS:
+                self._move_dialog_(dialog, event.get("operator_id"), True)
+            elif hook_type in CLOSE_EVENTS:
+                self._move_dialog_(dialog, dialog[1], False)
+
+    def client_id_by_dialog(self, dialog_id: int) -> int | None:
+        """
+        Возвращает id клиента диалога из зеркала.
+
+        :param dialog_id: id диалога.
+        :return: id клиента или None, если диалога нет или данные устарели.
+        """
+        with self._lock:
+            dialog = self.dialogs.get(dialog_id)
+            if dialog is not None and dialog[0] is not None and self._fresh_(dialog[3]):
+                self.hits += 1
+                return dialog[0]
+            self.misses += 1
+            return None
+
+    def store_dialog(self, dialog_id: int, client_id: int) -> None:
+        """
+        Сохраняет id клиента диалога, полученный из API.
+
+        :param dialog_id: id диалога.
+        :param client_id: id клиента.
+        :return: None.
+        """
+        with self._lock:
+            dialog = self._dialog_(dialog_id)
+            dialog[0], dialog[3] = client_id, self.clock()
+
+    def request(self, request_id: int) -> dict | None:
+        """
+        Возвращает данные обращения из зеркала.
+
+        :param request_id: id обращения.
+        :return: json-данные обращения или None, если его нет или данные устарели.
+        """
+        with self._lock:
+            entry = self.requests.get(request_id)
+            if entry is not None and self._fresh_(entry[1]):
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def store_request(self, request_id: int, request: dict) -> None:
+        """
+        Сохраняет данные обращения, полученные из API.
+
+        :param request_id: id обращения.
+        :param request: json-данные обращения.
+        :return: None.
+        """
+        with self._lock:
+            self.requests[request_id] = (request, self.clock())
+
+    def sync_operators(self, handler) -> None:
+        """
+        Загружает загрузку всех операторов из API.
+
+        :param handler: Handler, через который выполняются запросы.
+        :return: None.
+        """
+        operators = {
+            operator["id"]: operator["opened_dialogs"] for operator in handler.iter_operators()
+        }
+        with self._lock:
+            self.operators = operators
+            self.reserved = {
+                operator_id: count for operator_id, count in self.reserved.items()
+                if count > 0 and operator_id in operators
+            }
+            self.operators_synced_at = self.clock()
+
+    def available_operator(self, handler) -> int | None:
+        """
+        Резервирует диалог за первым в порядке коллекции оператором с загрузкой меньше лимита.
+
+        Резервирование учитывается в загрузке оператора до вызова assigned или release,
+        поэтому одновременные триггеры не превышают лимит.
+        Если загрузка операторов устарела, она предварительно синхронизируется с API.
+        :param handler: Handler, через который выполняется синхронизация.
+        :return: id оператора или None, если все операторы заняты.
+        """
+        fresh = self._fresh_(self.operators_synced_at)
+        if not fresh:
+            self.sync_operators(handler)
+
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            for operator_id, load in self.operators.items():
+                reserved = self.reserved.get(operator_id, 0)
+                if load + reserved < self.max_dialogs:
+                    self.reserved[operator_id] = reserved + 1
+                    return operator_id
+        return None
+
+    def release(self, operator_id: int) -> None:
+        """
+        Снимает резервирование, если диалог не был назначен оператору.
+
+        :param operator_id: id оператора.
+        :return: None.
+        """
+        with self._lock:
+            if self.reserved.get(operator_id, 0) > 0:
+                self.reserved[operator_id] -= 1
+
+    def assigned(self, dialog_id: int, operator_id: int) -> None:
+        """
+        Учитывает назначение оператора диалогу, выполненное через API.
+
+        Если за оператором было резервирование, оно подтверждается.
+        :param dialog_id: id диалога.
+        :param operator_id: id оператора.
+        :return: None.
+        """
+        with self._lock:
+            if self.reserved.get(operator_id, 0) > 0:
+                self.reserved[operator_id] -= 1
+            self._move_dialog_(self._dialog_(dialog_id), operator_id, True)
+
+    def sync(self, handler) -> None:
+        """
+        Сверяет зеркало с API.
+
+        Загрузка операторов запрашивается заново, устаревшие диалоги и обращения
+        удаляются, чтобы следующее чтение получило их из API.
+        :param handler: Handler, через который выполняются запросы.
+        :return: None.
+        """
+        self.sync_operators(handler)
+        with self._lock:
+            self.dialogs = {
+                dialog_id: dialog for dialog_id, dialog in self.dialogs.items()
+                if self._fresh_(dialog[3])
+            }
+            self.requests = {
+                request_id: entry for request_id, entry in self.requests.items()
+                if self._fresh_(entry[1])
+            }
+        if self.snapshot_path:
+            self.save_snapshot()
+
+    def start(self, handler, interval: float = None) -> None:
+        """
+        Запускает фоновую периодическую синхронизацию.
+
+        :param handler: Handler, через который выполняются запросы.
+        :param interval: период в секундах. По умолчанию половина max_staleness.
+        :return: None.
+        """
+        interval = self.max_staleness / 2 if interval is None else interval
+        self._stop.clear()
+
+        def run() -> None:
+            while not self._stop.wait(interval):
+                try:
+                    self.sync(handler)
+                except Exception as e:
+                    print(f"Exception raised while syncing mirror: {e}")
+
+        self._thread = threading.Thread(target=run, name="mirror-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Останавливает фоновую синхронизацию и сохраняет снимок."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.snapshot_path:
+            self.save_snapshot()
+
+    def save_snapshot(self) -> None:
+        """Атомарно сохраняет состояние зеркала в snapshot_path."""
+        with self._lock:
+            snapshot = {
+                "dialogs": [[dialog_id, *dialog] for dialog_id, dialog in self.dialogs.items()],
+                "requests": [
+                    [request_id, request, updated_at]
+                    for request_id, (request, updated_at) in self.requests.items()
+                ],
+                "operators": list(self.operators.items()),
+                "operators_synced_at": self.operators_synced_at,
+            }
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(tmp_path, self.snapshot_path)
+
+    def load_snapshot(self) -> None:
+        """Загружает состояние зеркала из snapshot_path."""
+        with open(self.snapshot_path) as f:
+            snapshot = json.load(f)
+        with self._lock:
+            self.dialogs = {row[0]: row[1:] for row in snapshot["dialogs"]}
+            self.requests = {row[0]: (row[1], row[2]) for row in snapshot["requests"]}
+            self.operators = {operator_id: load for operator_id, load in snapshot["operators"]}
+            self.operators_synced_at = snapshot["operators_synced_at"]
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику зеркала.
+
+        :return: словарь с кол-вом чтений из зеркала, промахов, применённых событий
+         и размерами.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "events": self.events,
+                "dialogs": len(self.dialogs),
+                "requests": len(self.requests),
+                "operators": len(self.operators),
+            }
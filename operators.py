@@ -0,0 +1,200 @@
+import heapq
+import threading
+import time
+
+
+class OperatorPool:
+    """
+    Локальный снимок загрузки операторов для выбора наименее загруженного.
+
+    Операторы хранятся в куче, упорядоченной по кол-ву открытых диалогов.
+    Выбор оператора резервирует за ним диалог под блокировкой, поэтому
+    одновременные триггеры не превышают лимит диалогов оператора.
+    Снимок периодически синхронизируется с API.
+    """
+
+    def __init__(
+        self,
+        max_dialogs: int = 5,
+        resync_interval: float = 60.0,
+        clock=time.monotonic,
+    ):
+        """
+        Создаёт пул операторов.
+
+        :param max_dialogs: кол-во открытых диалогов, при котором оператор считается занятым.
+        :param resync_interval: время в секундах, после которого снимок синхронизируется с API.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.max_dialogs = max_dialogs
+        self.resync_interval = resync_interval
+        self.clock = clock
+
+        self.loads = {}
+        self.synced_at = None
+        self._heap = []
+        self._positions = {}
+        self._reserved = {}
+
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def for_token(self, token: str) -> "OperatorPool":
+        """
+        Создаёт пустой пул с теми же настройками для другого токена API.
+
+        :param token: токен API.
+        :return: новый пул.
+        """
+        return OperatorPool(self.max_dialogs, self.resync_interval, self.clock)
+
+    def _push_(self, operator_id: int) -> None:
+        """
+        Добавляет в кучу актуальную запись оператора. Вызывается под блокировкой.
+
+        Устаревшие записи оператора остаются в куче и пропускаются при выборе.
+        :param operator_id: id оператора.
+        :return: None.
+        """
+        heapq.heappush(
+            self._heap,
+            (self.loads[operator_id], self._positions[operator_id], operator_id),
+        )
+
+    def load(self, operators: list[tuple[int, int]]) -> None:
+        """
+        Заменяет снимок загрузки операторов.
+
+        Неподтверждённые резервирования переносятся в новый снимок: назначения,
+        которые ещё выполняются, не видны в API, и без них оператор мог бы
+        получить диалоги сверх лимита. Резервирования операторов, которых нет
+        в снимке, отбрасываются.
+        :param operators: список пар (id оператора, кол-во открытых диалогов) в порядке коллекции.
+        :return: None.
+        """
+        with self._lock:
+            loads = {operator_id: load for operator_id, load in operators}
+            self._reserved = {
+                operator_id: count
+                for operator_id, count in self._reserved.items()
+                if count > 0 and operator_id in loads
+            }
+            for operator_id, count in self._reserved.items():
+                loads[operator_id] += count
+            self.loads = loads
+            self._positions = {
+                operator_id: position for position, (operator_id, _) in enumerate(operators)
+            }
+            self._heap = [
+                (load, self._positions[operator_id], operator_id)
+                for operator_id, load in self.loads.items()
+            ]
+            heapq.heapify(self._heap)
+            self.synced_at = self.clock()
+
+    def sync(self, handler) -> None:
+        """
+        Загружает загрузку всех операторов из API.
+
+        :param handler: Handler, через который выполняются запросы.
+        :return: None.
+        """
+        self.load(
+            [(operator["id"], operator["opened_dialogs"]) for operator in handler.iter_operators()]
+        )
+
+    def dump(self) -> dict:
+        """
+        Возвращает снимок загрузки операторов для сохранения на диск.
+
+        :return: словарь со списком пар (id оператора, кол-во открытых диалогов)
+         в порядке коллекции и временем в секундах с последней синхронизации.
+        """
+        with self._lock:
+            operators = sorted(self.loads.items(), key=lambda item: self._positions[item[0]])
+            age = None if self.synced_at is None else self.clock() - self.synced_at
+            return {"operators": operators, "age": age}
+
+    def restore(self, snapshot: dict, elapsed: float = 0.0) -> None:
+        """
+        Загружает снимок, сохранённый dump.
+
+        Снимок считается синхронизированным тогда же, когда исходный пул,
+        поэтому устаревает через то же время.
+        :param snapshot: снимок, см. dump.
+        :param elapsed: время в секундах, прошедшее с создания снимка.
+        :return: None.
+        """
+        if snapshot["age"] is None:
+            return
+        self.load(snapshot["operators"])
+        with self._lock:
+            self.synced_at -= snapshot["age"] + elapsed
+
+    def is_stale(self) -> bool:
+        """
+        Проверяет, нужно ли синхронизировать снимок с API.
+
+        :return: True, если снимок не загружен или устарел.
+        """
+        return self.synced_at is None or self.clock() - self.synced_at > self.resync_interval
+
+    def reserve(self, handler) -> int | None:
+        """
+        Выбирает наименее загруженного оператора и резервирует за ним диалог.
+
+        При равной загрузке выбирается оператор, идущий раньше в коллекции.
+        :param handler: Handler, через который выполняется синхронизация при устаревании снимка.
+        :return: id оператора или None, если все операторы заняты.
+        """
+        if self.is_stale():
+            with self._sync_lock:
+                if self.is_stale():
+                    self.sync(handler)
+
+        with self._lock:
+            while self._heap:
+                load, _, operator_id = self._heap[0]
+                if self.loads.get(operator_id) != load:  # Устаревшая запись
+                    heapq.heappop(self._heap)
+                    continue
+
+                if load >= self.max_dialogs:
+                    return None
+
+                self.loads[operator_id] = load + 1
+                self._reserved[operator_id] = self._reserved.get(operator_id, 0) + 1
+                heapq.heapreplace(
+                    self._heap, (load + 1, self._positions[operator_id], operator_id)
+                )
+                return operator_id
+        return None
+
+    def release(self, operator_id: int) -> None:
+        """
+        Снимает резервирование, если диалог не был назначен оператору.
+
+        :param operator_id: id оператора.
+        :return: None.
+        """
+        with self._lock:
+            if self._reserved.get(operator_id, 0) > 0:
+                self._reserved[operator_id] -= 1
+                self.loads[operator_id] -= 1
+                self._push_(operator_id)
+
+    def assigned(self, operator_id: int) -> None:
+        """
+        Учитывает назначение диалога оператору.
+
+        Если за оператором было резервирование, оно подтверждается.
+        Иначе загрузка оператора увеличивается.
+        :param operator_id: id оператора.
+        :return: None.
+        """
+        with self._lock:
+            if self._reserved.get(operator_id, 0) > 0:
+                self._reserved[operator_id] -= 1
+            elif operator_id in self.loads:
+                self.loads[operator_id] += 1
+                self._push_(operator_id)
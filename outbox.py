@@ -0,0 +1,320 @@
+import collections
+import copy
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+import requests
+
+from scheduler import IDEMPOTENT_METHODS, is_connect_error, is_retryable_status
+
+
+class Outbox:
+    """
+    Надёжная локальная очередь изменяющих запросов к API.
+
+    Сообщения, назначения тегов и операторов сохраняются в SQLite
+    и отправляются пулом фоновых потоков. Записи с одинаковым ключом
+    (клиент или диалог) всегда обрабатываются одним потоком по порядку,
+    неудачные попытки повторяются с экспоненциальной задержкой. Пока запись
+    ждёт повтора, записи других ключей того же потока отправляются.
+    Повторяются только попытки, которые по правилам RequestScheduler
+    можно повторить этим методом: ошибки соединения, 429, 503, а для
+    идемпотентных запросов также таймауты и 5xx. Остальные записи сразу
+    помечаются неотправляемыми, чтобы не отправить сообщение или тег дважды.
+    Подключается через Handler(outbox=...).
+    """
+
+    def __init__(
+        self,
+        path: str = "outbox.sqlite3",
+        workers: int = 4,
+        max_attempts: int = 5,
+        backoff: float = 1.0,
+        rate_window: float = 60.0,
+        clock=time.time,
+    ):
+        """
+        Создаёт очередь.
+
+        :param path: путь к файлу SQLite. ":memory:" - очередь без сохранения на диск.
+        :param workers: кол-во фоновых потоков отправки.
+        :param max_attempts: кол-во попыток, после которого запись помечается неотправляемой.
+        :param backoff: задержка перед первым повтором в секундах, далее удваивается.
+        :param rate_window: окно в секундах для подсчёта скорости отправки.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.rate_window = rate_window
+        self.clock = clock
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL,
+                shard INTEGER NOT NULL,
+                operation TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                dead INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS outbox_shard ON outbox (dead, shard, id);
+            CREATE INDEX IF NOT EXISTS outbox_key ON outbox (dead, shard, key, id);
+            """
+        )
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopping = False
+
+        self.delivered = 0
+        self.failed_attempts = 0
+        self._deliveries = collections.deque()
+
+    def _shard_(self, key: str) -> int:
+        """Возвращает номер потока, обрабатывающего записи с ключом."""
+        return zlib.crc32(key.encode()) % self.workers
+
+    def start(self, handler) -> None:
+        """
+        Запускает фоновые потоки отправки.
+
+        Каждый поток отправляет записи через свою копию handler без очереди,
+        а записи других токенов API - через копию обработчика токена из handler.tenants.
+        :param handler: Handler, методы которого выполняют запросы.
+        :return: None.
+        """
+        with self._condition:
+            # Число потоков могло измениться с прошлого запуска
+            rows = self._db.execute("SELECT id, key FROM outbox WHERE dead = 0").fetchall()
+            with self._db:
+                self._db.executemany(
+                    "UPDATE outbox SET shard = ? WHERE id = ?",
+                    [(self._shard_(key), row_id) for row_id, key in rows],
+                )
+            self._stopping = False
+
+        for shard in range(self.workers):
+            thread = threading.Thread(
+                target=self._work_, args=(shard, self._direct_(handler)),
+                name=f"outbox-{shard}", daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _direct_(self, handler):
+        """
+        Создаёт копию обработчика, выполняющую запросы без очереди.
+
+        :param handler: Handler.
+        :return: копия Handler.
+        """
+        direct = copy.copy(handler)
+        direct.outbox = None
+        # Профили и зеркало уже обновлены при постановке в очередь
+        direct.client_profiles = None
+        direct.mirror = None
+        return direct
+
+    def put(self, key: str, operation: str, token: str, on_dead: tuple = None,
+            method: str = "POST", **kwargs) -> None:
+        """
+        Добавляет запрос в очередь.
+
+        :param key: ключ упорядочивания, например "client:1" или "dialog:2".
+        :param operation: название метода Handler, выполняющего запрос.
+        :param token: токен API, от имени которого выполняется запрос.
+        :param method: HTTP метод запроса, по нему решается, можно ли повторить попытку.
+        :param on_dead: пара (название метода Handler, аргументы), вызываемая,
+         когда запись помечается неотправляемой. None - ничего не вызывать.
+        :param kwargs: аргументы метода.
+        :return: None.
+        """
+        payload = json.dumps(
+            {"token": token, "method": method, "kwargs": kwargs, "on_dead": on_dead}
+        )
+        with self._condition:
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO outbox (key, shard, operation, payload) VALUES (?, ?, ?, ?)",
+                    (key, self._shard_(key), operation, payload),
+                )
+            self._condition.notify_all()
+
+    def _work_(self, shard: int, handler) -> None:
+        """
+        Цикл фонового потока: по порядку отправляет записи своего номера.
+
+        Для каждого ключа отправляется только самая ранняя запись, из них
+        выбирается первая, время повтора которой наступило.
+
+        :param shard: номер потока.
+        :param handler: копия Handler без очереди.
+        :return: None.
+        """
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                now = self.clock()
+                row = self._db.execute(
+                    "SELECT id, operation, payload, attempts, next_attempt_at FROM outbox "
+                    "WHERE id IN (SELECT MIN(id) FROM outbox WHERE dead = 0 AND shard = ? "
+                    "GROUP BY key) ORDER BY MAX(next_attempt_at, ?), id LIMIT 1",
+                    (shard, now),
+                ).fetchone()
+                if row is None:
+                    self._condition.wait()
+                    continue
+                row_id, operation, payload, attempts, next_attempt_at = row
+                wait = next_attempt_at - now
+                if wait > 0:  # Ни одна запись потока ещё не готова к повтору
+                    self._condition.wait(timeout=wait)
+                    continue
+
+            payload = json.loads(payload)
+            if payload["token"] == handler.headers["Authorization"]:
+                self._send_(row_id, operation, payload, attempts, handler)
+            else:
+                with handler.tenants.lease(payload["token"]) as tenant:
+                    self._send_(row_id, operation, payload, attempts, self._direct_(tenant))
+
+    def _send_(self, row_id: int, operation: str, payload: dict, attempts: int,
+               handler) -> None:
+        """
+        Выполняет одну попытку отправки записи.
+
+        :param row_id: id записи.
+        :param operation: название метода Handler.
+        :param payload: токен, аргументы метода и действие для неотправляемой записи.
+        :param attempts: кол-во предыдущих попыток.
+        :param handler: копия обработчика токена записи без очереди.
+        :return: None.
+        """
+        try:
+            getattr(handler, operation)(**payload["kwargs"])
+        except Exception as e:
+            attempts += 1
+            dead = attempts >= self.max_attempts or not self._is_retryable_(
+                payload.get("method", "POST"), e
+            )
+            if dead and payload.get("on_dead"):  # До пометки, чтобы flush дождался вызова
+                name, kwargs = payload["on_dead"]
+                getattr(handler, name)(**kwargs)
+            self._fail_(row_id, attempts, str(e), dead)
+        else:
+            self._done_(row_id)
+
+    def _is_retryable_(self, method: str, error: Exception) -> bool:
+        """
+        Проверяет, можно ли повторить неудачную попытку отправки.
+
+        Запрос, который мог дойти до API, повторяется только для идемпотентного
+        метода: иначе клиент может получить сообщение или тег дважды.
+        :param method: HTTP метод запроса записи.
+        :param error: ошибка попытки отправки.
+        :return: True, если попытку можно повторить.
+        """
+        if isinstance(error, requests.exceptions.HTTPError):
+            return error.response is not None and is_retryable_status(
+                method, error.response.status_code
+            )
+        if isinstance(error, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout)):
+            return method in IDEMPOTENT_METHODS or is_connect_error(error)
+        return False
+
+    def _done_(self, row_id: int) -> None:
+        """Удаляет отправленную запись."""
+        with self._condition:
+            with self._db:
+                self._db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            self.delivered += 1
+            self._deliveries.append(self.clock())
+            self._condition.notify_all()
+
+    def _fail_(self, row_id: int, attempts: int, error: str, dead: bool) -> None:
+        """Откладывает повтор записи или помечает её неотправляемой."""
+        with self._condition:
+            self.failed_attempts += 1
+            with self._db:
+                self._db.execute(
+                    "UPDATE outbox SET attempts = ?, next_attempt_at = ?, dead = ?, error = ? "
+                    "WHERE id = ?",
+                    (
+                        attempts,
+                        self.clock() + self.backoff * 2 ** (attempts - 1),
+                        int(dead),
+                        error,
+                        row_id,
+                    ),
+                )
+            self._condition.notify_all()
+
+    def depth(self) -> int:
+        """Возвращает кол-во записей, ожидающих отправки."""
+        with self._condition:
+            return self._db.execute("SELECT COUNT(*) FROM outbox WHERE dead = 0").fetchone()[0]
+
+    def stats(self) -> dict:
+        """
+        Возвращает состояние очереди.
+
+        :return: словарь с кол-вом ожидающих и неотправляемых записей, отправленных записей,
+         неудачных попыток и скоростью отправки в записях в секунду за последнее окно.
+        """
+        with self._condition:
+            border = self.clock() - self.rate_window
+            while self._deliveries and self._deliveries[0] < border:
+                self._deliveries.popleft()
+            depth, dead = self._db.execute(
+                "SELECT COUNT(*) - COALESCE(SUM(dead), 0), COALESCE(SUM(dead), 0) FROM outbox"
+            ).fetchone()
+            return {
+                "depth": depth,
+                "dead": dead,
+                "delivered": self.delivered,
+                "failed_attempts": self.failed_attempts,
+                "drain_rate": len(self._deliveries) / self.rate_window,
+            }
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Ожидает отправки всех записей.
+
+        :param timeout: максимальное время ожидания в секундах. None - без ограничения.
+        :return: True, если очередь опустела.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._db.execute("SELECT 1 FROM outbox WHERE dead = 0 LIMIT 1").fetchone():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(timeout=remaining)
+        return True
+
+    def close(self, timeout: float = 30.0) -> bool:
+        """
+        Отправляет оставшиеся записи и останавливает фоновые потоки.
+
+        Записи, не отправленные за timeout, остаются в SQLite до следующего запуска.
+        :param timeout: максимальное время ожидания отправки в секундах.
+        :return: True, если все записи отправлены.
+        """
+        flushed = self.flush(timeout) if self._threads else self.depth() == 0
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._db.close()
+        return flushed
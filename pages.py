@@ -0,0 +1,138 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class _Page:
+    """Разобранная страница коллекции и её валидаторы."""
+
+    __slots__ = ("etag", "last_modified", "digest", "data")
+
+    def __init__(self, etag: str | None, last_modified: str | None, digest: bytes, data: dict):
+        """Создаёт запись хранилища страниц."""
+        self.etag = etag
+        self.last_modified = last_modified
+        self.digest = digest
+        self.data = data
+
+
+class PageStore:
+    """
+    Ограниченное LRU хранилище страниц коллекций API для условных запросов.
+
+    Для каждой страницы хранит разобранный JSON, ETag и Last-Modified ответа
+    и хэш тела. Повторный запрос страницы отправляется с If-None-Match
+    и If-Modified-Since. Если API отвечает 304, используется сохранённая страница.
+    Если API не поддерживает валидаторы, но тело совпадает по хэшу
+    с сохранённым, JSON не разбирается повторно.
+    Сохранённые страницы общие для всех вызовов и не должны изменяться.
+    Подключается через Handler(page_store=PageStore()).
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        """
+        Создаёт пустое хранилище.
+
+        :param maxsize: максимальное кол-во хранимых страниц.
+        """
+        self.maxsize = maxsize
+
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.not_modified = 0
+        self.unchanged = 0
+        self.changed = 0
+
+    def for_token(self, token: str) -> "PageStore":
+        """
+        Создаёт пустое хранилище с теми же настройками для другого токена API.
+
+        :param token: токен API.
+        :return: новое хранилище.
+        """
+        return PageStore(self.maxsize)
+
+    def get(self, key) -> _Page | None:
+        """
+        Возвращает сохранённую страницу.
+
+        :param key: ключ страницы, например (токен, url, limit, offset).
+        :return: запись страницы или None.
+        """
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def conditional_headers(self, page: _Page | None) -> dict:
+        """
+        Возвращает заголовки условного запроса для сохранённой страницы.
+
+        :param page: запись страницы или None.
+        :return: словарь заголовков. Пустой, если страницы нет или у неё нет валидаторов.
+        """
+        headers = {}
+        if page is not None:
+            if page.etag is not None:
+                headers["If-None-Match"] = page.etag
+            if page.last_modified is not None:
+                headers["If-Modified-Since"] = page.last_modified
+        return headers
+
+    def resolve(self, key, page: _Page | None, response, decode) -> dict:
+        """
+        Возвращает JSON страницы по ответу на условный запрос и обновляет хранилище.
+
+        :param key: ключ страницы.
+        :param page: запись страницы, по которой сформирован запрос, или None.
+        :param response: ответ API с кодом 200 или 304.
+        :param decode: функция (тело ответа), разбирающая JSON.
+        :return: json страницы.
+        """
+        if response.status_code == 304 and page is not None:
+            with self._lock:
+                self.not_modified += 1
+            return page.data
+
+        content = response.content
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        if page is not None and page.digest == digest:
+            data = page.data
+            with self._lock:
+                self.unchanged += 1
+        else:
+            data = decode(content)
+            with self._lock:
+                self.changed += 1
+
+        updated = _Page(
+            response.headers.get("ETag"), response.headers.get("Last-Modified"), digest, data
+        )
+        with self._lock:
+            self._pages[key] = updated
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.maxsize:
+                self._pages.popitem(last=False)
+        return data
+
+    def invalidate(self) -> None:
+        """Удаляет все сохранённые страницы."""
+        with self._lock:
+            self._pages.clear()
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику хранилища.
+
+        :return: словарь с кол-вом ответов 304, неизменившихся по хэшу
+         и изменившихся страниц и текущим размером.
+        """
+        with self._lock:
+            return {
+                "not_modified": self.not_modified,
+                "unchanged": self.unchanged,
+                "changed": self.changed,
+                "size": len(self._pages),
+            }
@@ -0,0 +1,108 @@
+import time
+
+from cache import TTLCache
+
+
+class ClientProfiles:
+    """
+    Кэш профилей клиентов по id с тегами в виде множества.
+
+    Хранит для каждого клиента множество id его тегов, поэтому проверка тега
+    не требует запроса к API и перебора списка. Назначение тега через Handler
+    сразу обновляет кэш. Подключается через Handler(client_profiles=...).
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0, clock=time.monotonic):
+        """
+        Создаёт пустой кэш.
+
+        :param maxsize: максимальное кол-во клиентов в кэше.
+        :param ttl: время жизни профиля в секундах.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.cache = TTLCache(maxsize, ttl, clock=clock)
+
+    def for_token(self, token: str) -> "ClientProfiles":
+        """
+        Создаёт пустой кэш с теми же настройками для другого токена API.
+
+        :param token: токен API.
+        :return: новый кэш.
+        """
+        return ClientProfiles(self.cache.maxsize, self.cache.ttl, self.cache.clock)
+
+    def store(self, client: dict) -> frozenset:
+        """
+        Сохраняет профиль клиента из данных API.
+
+        :param client: json-данные клиента с полями id и tags.
+        :return: множество id тегов клиента.
+        """
+        tags = frozenset(tag["id"] for tag in client["tags"] or ())
+        self.cache.set(client["id"], tags)
+        return tags
+
+    def get_tags(self, client_id: int, handler) -> frozenset | None:
+        """
+        Возвращает id тегов клиента, при промахе запрашивает клиента по API.
+
+        :param client_id: id клиента.
+        :param handler: Handler, через который запрашивается клиент.
+        :return: множество id тегов. None, если клиент не найден или запрос не успешен.
+        """
+        tags = self.cache.get(client_id)
+        if tags is not None:
+            return tags
+
+        client_data = handler.get_client_by_id(client_id)
+        if not client_data:  # Ошибки и отсутствие клиента не кэшируются
+            return None
+        return self.store(client_data["data"])
+
+    def add_tag(self, client_id: int, tag_id: int) -> None:
+        """
+        Добавляет тег в профиль клиента, если профиль есть в кэше.
+
+        :param client_id: id клиента.
+        :param tag_id: id тега.
+        :return: None.
+        """
+        self.cache.update(client_id, lambda tags: tags | {tag_id})
+
+    def warm_up(self, handler, limit: int = None) -> int:
+        """
+        Заполняет кэш профилями из коллекции клиентов.
+
+        :param handler: Handler, через который перебирается коллекция.
+        :param limit: максимальное кол-во загружаемых клиентов. По умолчанию размер кэша.
+        :return: кол-во загруженных профилей.
+        """
+        limit = self.cache.maxsize if limit is None else limit
+        loaded = 0
+        for client in handler.iter_clients(fields=("id", "tags")):
+            if loaded >= limit:
+                break
+            self.store(client)
+            loaded += 1
+        return loaded
+
+    def invalidate(self, client_id: int = None) -> None:
+        """
+        Удаляет профиль клиента из кэша.
+
+        :param client_id: id клиента. Если не указан, кэш очищается полностью.
+        :return: None.
+        """
+        self.cache.invalidate(client_id)
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику кэша.
+
+        :return: словарь с кол-вом попаданий, промахов, вытеснений, размером
+         и долей попаданий.
+        """
+        stats = self.cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
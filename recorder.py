@@ -0,0 +1,43 @@
+import json
+import threading
+import time
+
+
+class TriggerRecorder:
+    """
+    Запись входных данных триггеров в JSONL для последующего воспроизведения.
+
+    Каждая строка - {"ts": время, "handler": название обработчика, "input": входные данные}.
+    Токены API не записываются. Подключается через Handler(recorder=...).
+    """
+
+    def __init__(self, path: str, clock=time.time):
+        """
+        Открывает файл записи на дозапись.
+
+        :param path: путь к файлу JSONL.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.clock = clock
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def record(self, handler: str, input_data: dict) -> None:
+        """
+        Записывает триггер.
+
+        :param handler: название обработчика, например "new_request_handler".
+        :param input_data: входные данные триггера.
+        :return: None.
+        """
+        line = json.dumps(
+            {"ts": self.clock(), "handler": handler, "input": input_data}, ensure_ascii=False
+        )
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        """Закрывает файл записи."""
+        with self._lock:
+            self._file.close()
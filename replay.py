@@ -0,0 +1,141 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import summarize
+from c2d import C2D
+from main import Handler
+from stub_api import StubAPI
+
+
+def load(path: str) -> list[dict]:
+    """
+    Читает записанные триггеры.
+
+    :param path: путь к файлу JSONL.
+    :return: список записей по возрастанию времени.
+    """
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record["ts"])
+
+
+def replay(records: list[dict], handler: Handler, speed: float = 1.0,
+           concurrency: int = 8, token: str = "") -> dict:
+    """
+    Воспроизводит записанные триггеры и измеряет обработку.
+
+    Задержка считается от запланированного момента триггера, поэтому
+    включает ожидание свободного потока, если обработка не успевает за записью.
+    :param records: записи триггеров, см. load.
+    :param handler: Handler, обрабатывающий триггеры.
+    :param speed: ускорение относительно записи. 0 - максимальная скорость.
+    :param concurrency: кол-во одновременно обрабатываемых триггеров.
+    :param token: токен API, с которым воспроизводятся триггеры. Запросы к API
+     считаются по транспорту handler, поэтому токен должен совпадать с токеном handler.
+    :return: отчёт, см. benchmark.summarize, с долей неуспешных результатов обработки
+     и отчётами по каждому обработчику.
+    """
+    handler = copy.copy(handler)
+    handler.recorder = None  # Воспроизводимые триггеры не записываются повторно
+    c2d = C2D(token)
+    outcomes = []  # (обработчик, задержка, ошибка, неуспешный результат)
+    lock = threading.Lock()
+
+    def run(record: dict, scheduled: float) -> None:
+        error = failed = False
+        try:
+            result = getattr(handler, record["handler"])(record["input"], c2d)
+            failed = str(result).startswith("Failed")
+        except Exception:
+            error = True
+        with lock:
+            outcomes.append((record["handler"], time.perf_counter() - scheduled, error, failed))
+
+    requests_before = handler.transport.stats()["requests"]
+    started = time.perf_counter()
+    first_ts = records[0]["ts"] if records else 0.0
+    # Обработчики печатают ошибки запросов, при воспроизведении это только шум
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for record in records:
+                scheduled = time.perf_counter()
+                if speed:
+                    scheduled = started + (record["ts"] - first_ts) / speed
+                    delay = scheduled - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                pool.submit(run, record, scheduled)
+    elapsed = time.perf_counter() - started
+    calls = handler.transport.stats()["requests"] - requests_before
+
+    def report(selected: list, calls: int) -> dict:
+        result = summarize(
+            [latency for _, latency, _, _ in selected],
+            elapsed,
+            sum(error for _, _, error, _ in selected),
+            calls,
+        )
+        result["failure_rate"] = (
+            sum(failed for _, _, _, failed in selected) / len(selected) if selected else 0.0
+        )
+        return result
+
+    summary = report(outcomes, calls)
+    summary["handlers"] = {
+        name: report([outcome for outcome in outcomes if outcome[0] == name], 0)
+        for name in sorted({outcome[0] for outcome in outcomes})
+    }
+    for result in summary["handlers"].values():
+        del result["api_calls_per_op"]  # Запросы к API не делятся по обработчикам
+    return summary
+
+
+def main(argv: list = None) -> int:
+    """
+    Воспроизводит запись триггеров из командной строки.
+
+    :param argv: аргументы командной строки.
+    :return: код завершения.
+    """
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных триггеров")
+    parser.add_argument("log", help="файл JSONL, записанный TriggerRecorder")
+    parser.add_argument("--speed", default="1",
+                        help="ускорение относительно записи или max для максимальной скорости")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--api-url", help="адрес API. По умолчанию запускается StubAPI")
+    parser.add_argument("--token", default="")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.002,
+                        help="задержка ответа заглушки в секундах")
+    parser.add_argument("--output", help="файл для отчёта в JSON")
+    args = parser.parse_args(argv)
+
+    records = load(args.log)
+    speed = 0.0 if args.speed == "max" else float(args.speed)
+
+    with contextlib.ExitStack() as stack:
+        api_url = args.api_url
+        if api_url is None:
+            stub = stack.enter_context(StubAPI(args.clients, latency=args.latency))
+            api_url = stub.url
+        handler = Handler(api_url=api_url, token=args.token)
+        stack.callback(handler.close)
+        report = replay(records, handler, speed, args.concurrency, args.token)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,390 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from urllib3.exceptions import ConnectTimeoutError
+
+from transport import DeadlineExceeded
+
+# Ответы, после которых запрос точно не был обработан и его можно повторить любым методом
+SAFE_RETRY_STATUSES = frozenset({429, 503})
+# Ответы, после которых можно повторить только идемпотентный запрос
+IDEMPOTENT_RETRY_STATUSES = frozenset({500, 502, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+
+def is_retryable_status(method: str, status: int) -> bool:
+    """
+    Проверяет, можно ли повторить запрос с таким ответом.
+
+    :param method: HTTP метод.
+    :param status: код ответа.
+    :return: True, если запрос можно повторить.
+    """
+    return status in SAFE_RETRY_STATUSES or (
+        status in IDEMPOTENT_RETRY_STATUSES and method in IDEMPOTENT_METHODS
+    )
+
+
+def is_connect_error(error: requests.exceptions.RequestException) -> bool:
+    """
+    Проверяет, произошла ли ошибка до отправки запроса, при установке соединения.
+
+    Такой запрос не дошёл до API, поэтому его можно повторить любым методом.
+    :param error: ошибка запроса.
+    :return: True, если соединение не было установлено.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, "reason", reason)  # MaxRetryError хранит исходную ошибку
+    # NewConnectionError - подкласс ConnectTimeoutError
+    return isinstance(reason, ConnectTimeoutError)
+
+
+class TokenBucket:
+    """Token bucket, ограничивающий частоту запросов одного токена API."""
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        """
+        Создаёт заполненный bucket.
+
+        :param rate: кол-во запросов в секунду.
+        :param capacity: максимальное кол-во запросов подряд без ожидания.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated_at = clock()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        """
+        Забирает один токен, только если он доступен без ожидания.
+
+        :return: True, если токен забран.
+        """
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens < 1 or self.paused_until > now:
+                return False
+            self.tokens -= 1
+            return True
+
+    def reserve(self) -> float:
+        """
+        Забирает один токен, при необходимости в долг.
+
+        :return: время в секундах, которое нужно подождать перед запросом.
+        """
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def pause_until(self, moment: float) -> None:
+        """
+        Запрещает запросы до указанного момента.
+
+        :param moment: момент времени по clock.
+        :return: None.
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, moment)
+
+
+class AdaptiveLimiter:
+    """
+    Ограничитель одновременных запросов с адаптивным лимитом (AIMD).
+
+    Лимит растёт на единицу за каждый «круг» успешных быстрых запросов
+    и уменьшается вдвое при троттлинге или превышении целевой задержки,
+    но не чаще раза за окно: медленные ответы запросов, отправленных
+    одновременно, вызваны одной перегрузкой и не должны сбрасывать лимит до минимума.
+    """
+
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 64,
+                 target_latency: float = 1.0, window: float = None, clock=time.monotonic):
+        """
+        Создаёт ограничитель.
+
+        :param initial: начальный лимит одновременных запросов.
+        :param minimum: минимальный лимит.
+        :param maximum: максимальный лимит.
+        :param target_latency: задержка в секундах, выше которой лимит уменьшается.
+        :param window: время в секундах после уменьшения лимита, в течение которого
+         он не уменьшается повторно. По умолчанию равно target_latency.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.window = target_latency if window is None else window
+        self.clock = clock
+        self.in_flight = 0
+        self._decreased_at = None
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout: float = None) -> bool:
+        """
+        Ожидает, пока кол-во выполняющихся запросов не станет меньше лимита.
+
+        :param timeout: максимальное время ожидания в секундах. None - без ограничения.
+        :return: True, если место занято. False, если время ожидания истекло.
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self.in_flight < int(self.limit), timeout
+            ):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: float, throttled: bool) -> None:
+        """
+        Освобождает место и корректирует лимит.
+
+        :param latency: задержка завершившегося запроса в секундах.
+        :param throttled: True, если API ответил троттлингом.
+        :return: None.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled or latency > self.target_latency:
+                now = self.clock()
+                if self._decreased_at is None or now - self._decreased_at >= self.window:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._decreased_at = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class RequestScheduler:
+    """
+    Планировщик запросов к API с учётом ограничений частоты.
+
+    Для каждого токена API держит свой token bucket, учитывает заголовки
+    Retry-After и X-RateLimit-*, повторяет запросы после троттлинга и временных
+    ошибок с экспоненциальной задержкой со случайным разбросом и подстраивает
+    кол-во одновременных запросов под задержку ответов.
+    Подключается через Handler(scheduler=...).
+    """
+
+    def __init__(
+        self,
+        rate: float = 10.0,
+        burst: float = 10.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        initial_concurrency: int = 4,
+        max_concurrency: int = 64,
+        target_latency: float = 1.0,
+        clock=time.monotonic,
+        sleep=time.sleep,
+        rand=random.random,
+    ):
+        """
+        Создаёт планировщик.
+
+        :param rate: допустимое кол-во запросов в секунду на один токен API.
+        :param burst: кол-во запросов одного токена подряд без ожидания.
+        :param max_retries: максимальное кол-во повторов одного запроса.
+        :param backoff_base: задержка перед первым повтором в секундах.
+        :param backoff_max: максимальная задержка перед повтором в секундах.
+        :param initial_concurrency: начальный лимит одновременных запросов.
+        :param max_concurrency: максимальный лимит одновременных запросов.
+        :param target_latency: задержка ответа в секундах, выше которой лимит уменьшается.
+        :param clock: функция, возвращающая текущее время в секундах.
+        :param sleep: функция ожидания.
+        :param rand: функция, возвращающая случайное число от 0 до 1.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        self.sleep = sleep
+        self.rand = rand
+
+        self.limiter = AdaptiveLimiter(
+            initial_concurrency, maximum=max_concurrency, target_latency=target_latency,
+            clock=clock,
+        )
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+        self.retries = 0
+        self.throttled = 0
+
+    def bucket(self, token: str) -> TokenBucket:
+        """
+        Возвращает token bucket для токена API.
+
+        :param token: токен API.
+        :return: TokenBucket.
+        """
+        with self._lock:
+            bucket = self._buckets.get(token)
+            if bucket is None:
+                bucket = self._buckets[token] = TokenBucket(self.rate, self.burst, self.clock)
+            return bucket
+
+    def try_acquire(self, token: str) -> bool:
+        """
+        Забирает токен из bucket токена API для дополнительного запроса, если он доступен.
+
+        Используется для дублирующих запросов: они не ждут и не берут токены в долг.
+        :param token: токен API.
+        :return: True, если запрос можно отправить сейчас.
+        """
+        return self.bucket(token).try_acquire()
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Считает задержку перед повтором (full jitter).
+
+        :param attempt: номер неудавшейся попытки, начиная с 0.
+        :return: задержка в секундах.
+        """
+        return self.rand() * min(self.backoff_max, self.backoff_base * 2 ** attempt)
+
+    def _header_delay_(self, value: str) -> float | None:
+        """
+        Разбирает задержку из заголовка Retry-After или X-RateLimit-Reset.
+
+        :param value: значение заголовка: секунды, unix-время или HTTP-дата.
+        :return: задержка в секундах или None, если значение не распознано.
+        """
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                return None
+        if seconds > 1e9:  # unix-время
+            return max(seconds - time.time(), 0.0)
+        return max(seconds, 0.0)
+
+    def _apply_rate_limit_headers_(self, bucket: TokenBucket,
+                                   response: requests.Response) -> float | None:
+        """
+        Приостанавливает bucket по заголовкам ограничения частоты.
+
+        :param bucket: bucket токена, которым выполнен запрос.
+        :param response: ответ API.
+        :return: задержка из заголовков в секундах или None, если заголовков нет.
+        """
+        delay = None
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            delay = self._header_delay_(retry_after)
+        elif response.headers.get("X-RateLimit-Remaining") == "0":
+            reset = response.headers.get("X-RateLimit-Reset")
+            delay = self._header_delay_(reset) if reset is not None else None
+
+        if delay:
+            bucket.pause_until(self.clock() + delay)
+        return delay
+
+    def _past_deadline_(self, deadline: float | None, delay: float) -> bool:
+        """
+        Проверяет, закончится ли ожидание позже deadline.
+
+        :param deadline: момент по time.monotonic или None.
+        :param delay: время ожидания в секундах.
+        :return: True, если ожидание не успеет закончиться до deadline.
+        """
+        return deadline is not None and time.monotonic() + delay >= deadline
+
+    def execute(self, method: str, token: str, send, on_retry=None,
+                deadline: float = None) -> requests.Response:
+        """
+        Выполняет запрос с учётом ограничений частоты и повторами.
+
+        :param method: HTTP метод.
+        :param token: токен API, от имени которого выполняется запрос.
+        :param send: функция без аргументов, выполняющая запрос и возвращающая ответ.
+        :param on_retry: функция без аргументов, вызываемая перед каждым повтором.
+        :param deadline: момент по time.monotonic, после которого запрос не выполняется.
+         Ожидание, которое закончится позже, не начинается: выбрасывается DeadlineExceeded
+         или возвращается последний ответ. None - без ограничения.
+        :return: последний полученный ответ.
+        """
+        bucket = self.bucket(token)
+        attempt = 0
+        while True:
+            wait = bucket.reserve()
+            if wait > 0:
+                if self._past_deadline_(deadline, wait):
+                    raise DeadlineExceeded("Deadline exceeded while waiting for rate limit")
+                self.sleep(wait)
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not self.limiter.acquire(timeout=remaining):
+                raise DeadlineExceeded("Deadline exceeded while waiting for a request slot")
+            started = self.clock()
+            try:
+                response = send()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.limiter.release(self.clock() - started, throttled=False)
+                if (
+                    attempt >= self.max_retries
+                    or not (method in IDEMPOTENT_METHODS or is_connect_error(e))
+                    or isinstance(e, DeadlineExceeded)
+                ):
+                    raise
+                delay = self.backoff(attempt)
+                if self._past_deadline_(deadline, delay):
+                    raise
+            else:
+                throttled = response.status_code == 429
+                self.limiter.release(self.clock() - started, throttled)
+                header_delay = self._apply_rate_limit_headers_(bucket, response)
+
+                if throttled:
+                    with self._lock:
+                        self.throttled += 1
+                if attempt >= self.max_retries or not is_retryable_status(
+                    method, response.status_code
+                ):
+                    return response
+                delay = header_delay if header_delay is not None else self.backoff(attempt)
+                if self._past_deadline_(deadline, delay):
+                    return response
+
+            with self._lock:
+                self.retries += 1
+            if on_retry is not None:
+                on_retry()
+            self.sleep(delay)
+            attempt += 1
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику планировщика.
+
+        :return: словарь с кол-вом повторов, ответов с троттлингом
+         и текущим лимитом одновременных запросов.
+        """
+        return {
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "concurrency_limit": int(self.limiter.limit),
+            "in_flight": self.limiter.in_flight,
+        }
@@ -0,0 +1,375 @@
+import argparse
+import asyncio
+import json
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from c2d import C2D
+from main import Handler
+
+
+def validate_manually(data) -> bool:
+    """Проверяет данные триггера из внешней системы."""
+    return isinstance(data, dict) and isinstance(data.get("name"), str) and bool(data["name"])
+
+
+def validate_new_request(data) -> bool:
+    """Проверяет данные триггера нового обращения."""
+    return (
+        isinstance(data, dict)
+        and isinstance(data.get("client_id"), int)
+        and isinstance(data.get("dialog_id"), int)
+    )
+
+
+# Путь -> (метод Handler, проверка входных данных)
+TRIGGERS = {
+    "/triggers/manually": ("manually_handler", validate_manually),
+    "/triggers/new_request": ("new_request_handler", validate_new_request),
+}
+
+
+class IngestionServer:
+    """
+    HTTP сервер приёма триггеров перед Handler.
+
+    Принимает триггеры в виде JSON, быстро проверяет их и кладёт в ограниченную
+    очередь. Если очередь заполнена, отвечает 429. Очередь разбирается пулом
+    обработчиков, при остановке оставшиеся триггеры дообрабатываются.
+    События вебхуков Chat2Desk по /events сразу применяются к зеркалу Handler.mirror
+    или, для другого токена в заголовке Authorization, к зеркалу его обработчика.
+    Отдаёт состояние по /health и метрики в формате Prometheus по /metrics.
+    """
+
+    def __init__(
+        self,
+        handler: Handler,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        workers: int = 16,
+        queue_size: int = 10000,
+        token: str = "",
+        max_body: int = 65536,
+        on_result=None,
+    ):
+        """
+        Создаёт сервер.
+
+        :param handler: Handler или workers.WorkerPool, обрабатывающий триггеры.
+        :param host: адрес сервера.
+        :param port: порт сервера. 0 - любой свободный.
+        :param workers: кол-во одновременно обрабатываемых триггеров.
+        :param queue_size: максимальное кол-во принятых, но не обработанных триггеров.
+        :param token: токен API по умолчанию, если в запросе нет заголовка Authorization.
+        :param max_body: максимальный размер тела запроса в байтах.
+        :param on_result: функция (путь, данные, результат), вызываемая после обработки триггера.
+        """
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.token = token
+        self.max_body = max_body
+        self.on_result = on_result
+
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._server = None
+        self._worker_tasks = []
+        self._writers = set()  # Потоки записи открытых соединений
+
+        self.accepted = 0
+        self.rejected = 0
+        self.invalid = 0
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def url(self) -> str:
+        """Адрес запущенного сервера."""
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def start(self) -> None:
+        """Начинает принимать соединения и запускает обработчики очереди."""
+        self._server = await asyncio.start_server(self._serve_connection_, self.host, self.port)
+        self._worker_tasks = [
+            asyncio.create_task(self._work_()) for _ in range(self.workers)
+        ]
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """
+        Перестаёт принимать триггеры и дообрабатывает очередь.
+
+        Открытые keep-alive соединения закрываются после дообработки:
+        начиная с Python 3.12.1 Server.wait_closed ждёт закрытия всех соединений,
+        и простаивающий клиент иначе задержал бы остановку без ограничения.
+        :param timeout: максимальное время дообработки в секундах.
+        :return: None.
+        """
+        self._server.close()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+    async def _work_(self) -> None:
+        """Цикл обработчика очереди."""
+        loop = asyncio.get_running_loop()
+        while True:
+            path, data, token = await self.queue.get()
+            method_name = TRIGGERS[path][0]
+            try:
+                result = await loop.run_in_executor(
+                    self.executor, getattr(self.handler, method_name), data, C2D(token)
+                )
+                self.processed += 1
+                if self.on_result is not None:
+                    self.on_result(path, data, result)
+            except Exception as e:
+                self.failed += 1
+                print(f"Exception raised while processing trigger: {e}")
+            finally:
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        """
+        Возвращает счётчики сервера.
+
+        :return: словарь с кол-вом принятых, отклонённых из-за заполненной очереди,
+         некорректных, обработанных и упавших триггеров и текущим размером очереди.
+        """
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "invalid": self.invalid,
+            "processed": self.processed,
+            "failed": self.failed,
+            "queue_depth": self.queue.qsize(),
+        }
+
+    def _metrics_text_(self) -> str:
+        """Возвращает метрики сервера и Handler в формате Prometheus."""
+        lines = []
+        for name, value in self.stats().items():
+            kind = "gauge" if name == "queue_depth" else "counter"
+            suffix = "" if kind == "gauge" else "_total"
+            lines.append(f"# TYPE chat2desk_ingest_{name}{suffix} {kind}")
+            lines.append(f"chat2desk_ingest_{name}{suffix} {value}")
+        text = "\n".join(lines) + "\n"
+
+        instrumentation = self.handler.instrumentation
+        if instrumentation is not None and hasattr(instrumentation, "to_prometheus"):
+            text += instrumentation.to_prometheus()
+        return text
+
+    def _apply_event_(self, body: bytes, token: str) -> tuple:
+        """
+        Применяет событие вебхука Chat2Desk к зеркалу Handler.
+
+        События другого токена применяются к зеркалу его обработчика из Handler.tenants,
+        который обрабатывает и триггеры этого токена.
+        :param body: тело запроса с json события.
+        :param token: токен API, к которому относится событие.
+        :return: (код ответа, тип содержимого, тело ответа).
+        """
+        mirror = getattr(self.handler, "mirror", None)
+        if mirror is None:
+            return HTTPStatus.NOT_FOUND, "application/json", b'{"status": "not found"}'
+        try:
+            event = json.loads(body)
+        except ValueError:
+            event = None
+        if not isinstance(event, dict):
+            self.invalid += 1
+            return HTTPStatus.BAD_REQUEST, "application/json", b'{"status": "invalid"}'
+        if token == self.handler.headers["Authorization"]:
+            mirror.apply(event)
+        else:
+            with self.handler.tenants.lease(token) as tenant:
+                tenant.mirror.apply(event)
+        return HTTPStatus.OK, "application/json", b'{"status": "ok"}'
+
+    def _dispatch_(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        """
+        Обрабатывает HTTP запрос.
+
+        :param method: HTTP метод.
+        :param path: путь запроса.
+        :param headers: заголовки запроса с названиями в нижнем регистре.
+        :param body: тело запроса.
+        :return: (код ответа, тип содержимого, тело ответа).
+        """
+        if method == "GET" and path == "/health":
+            body = json.dumps({"status": "ok", **self.stats()}).encode()
+            return HTTPStatus.OK, "application/json", body
+        if method == "GET" and path == "/metrics":
+            return HTTPStatus.OK, "text/plain; version=0.0.4", self._metrics_text_().encode()
+
+        token = headers.get("authorization", self.token)
+        if method == "POST" and path == "/events":
+            return self._apply_event_(body, token)
+
+        if path not in TRIGGERS:
+            return HTTPStatus.NOT_FOUND, "application/json", b'{"status": "not found"}'
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED, "application/json", b'{"status": "error"}'
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if not TRIGGERS[path][1](data):
+            self.invalid += 1
+            return HTTPStatus.BAD_REQUEST, "application/json", b'{"status": "invalid"}'
+
+        try:
+            self.queue.put_nowait((path, data, token))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return HTTPStatus.TOO_MANY_REQUESTS, "application/json", b'{"status": "busy"}'
+
+        self.accepted += 1
+        return HTTPStatus.ACCEPTED, "application/json", b'{"status": "accepted"}'
+
+    async def _serve_connection_(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter) -> None:
+        """
+        Обслуживает одно keep-alive соединение.
+
+        :param reader: поток чтения.
+        :param writer: поток записи.
+        :return: None.
+        """
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    return
+
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = request_line.split(" ", 2)
+                except ValueError:
+                    return
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:  # Границы тела неизвестны, соединение закрывается
+                    status, content_type, body = (
+                        HTTPStatus.BAD_REQUEST, "application/json", b"{}"
+                    )
+                    keep_alive = False
+                elif length > self.max_body:
+                    status, content_type, body = (
+                        HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "application/json", b"{}"
+                    )
+                    keep_alive = False
+                else:
+                    request_body = await reader.readexactly(length) if length else b""
+                    status, content_type, body = self._dispatch_(
+                        method, target.split("?", 1)[0], headers, request_body
+                    )
+                    keep_alive = (
+                        headers.get("connection", "").lower() != "close"
+                        and version == "HTTP/1.1"
+                    )
+
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                    + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+async def serve(server: IngestionServer, drain_timeout: float) -> None:
+    """
+    Запускает сервер и останавливает его по SIGINT или SIGTERM.
+
+    :param server: сервер.
+    :param drain_timeout: максимальное время дообработки очереди при остановке.
+    :return: None.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await server.start()
+    print(f"Listening on {server.url}")
+    await stop.wait()
+
+    started = time.monotonic()
+    await server.stop(drain_timeout)
+    print(f"Stopped in {time.monotonic() - started:.1f}s, {server.stats()}")
+
+
+def main(argv: list = None) -> None:
+    """
+    Запускает сервер из командной строки.
+
+    :param argv: аргументы командной строки.
+    :return: None.
+    """
+    parser = argparse.ArgumentParser(description="Сервер приёма триггеров Chat2Desk")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--queue-size", type=int, default=10000)
+    parser.add_argument("--token", default="", help="токен API по умолчанию")
+    parser.add_argument("--api-url", help="базовый url API, например адрес StubAPI")
+    parser.add_argument("--drain-timeout", type=float, default=30.0)
+    parser.add_argument("--processes", type=int, default=0,
+                        help="кол-во процессов-обработчиков, 0 - обработка в этом процессе")
+    parser.add_argument("--store", default="shared.sqlite3",
+                        help="файл общих кэшей процессов-обработчиков")
+    args = parser.parse_args(argv)
+
+    if args.processes:
+        from workers import WorkerPool
+
+        handler = WorkerPool(args.store, args.processes, api_url=args.api_url)
+    else:
+        from metrics import Metrics
+        from transport import Transport
+
+        handler = Handler(
+            Transport(pool_maxsize=args.workers), api_url=args.api_url, instrumentation=Metrics()
+        )
+    server = IngestionServer(
+        handler, args.host, args.port, args.workers, args.queue_size, args.token
+    )
+    asyncio.run(serve(server, args.drain_timeout))
+    handler.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,537 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+from cache import SingleFlight
+from directory import normalize_name
+
+
+class SharedStore:
+    """
+    Файл SQLite, через который процессы-обработчики разделяют кэши.
+
+    Каждый поток каждого процесса открывает своё соединение. Файл работает
+    в режиме WAL, поэтому чтение не блокируется записью, а изменения выполняются
+    в транзакциях BEGIN IMMEDIATE и атомарны между процессами.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        """
+        Создаёт хранилище и его таблицы.
+
+        :param path: путь к файлу SQLite.
+        :param timeout: максимальное время ожидания блокировки записи в секундах.
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self.connect().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tags (
+                token TEXT, label TEXT, tag_id INTEGER, expires_at REAL,
+                PRIMARY KEY (token, label)
+            );
+            CREATE TABLE IF NOT EXISTS clients (
+                token TEXT, position INTEGER, id INTEGER, name TEXT, normalized_name TEXT,
+                PRIMARY KEY (token, position)
+            );
+            CREATE INDEX IF NOT EXISTS clients_name ON clients (token, name, position);
+            CREATE INDEX IF NOT EXISTS clients_normalized_name
+                ON clients (token, normalized_name, position);
+            CREATE TABLE IF NOT EXISTS operators (
+                token TEXT, id INTEGER, position INTEGER, load INTEGER, reserved INTEGER,
+                PRIMARY KEY (token, id)
+            );
+            CREATE INDEX IF NOT EXISTS operators_load ON operators (token, load, position);
+            CREATE TABLE IF NOT EXISTS meta (
+                token TEXT, key TEXT, value REAL, PRIMARY KEY (token, key)
+            );
+            """
+        )
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Возвращает соединение текущего потока, открывая его при необходимости.
+
+        :return: соединение SQLite.
+        """
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():  # Соединения не переживают fork
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Выполняет блок with в транзакции с блокировкой записи.
+
+        :return: соединение SQLite.
+        """
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def get_meta(self, token: str, key: str) -> float | None:
+        """
+        Возвращает служебное значение.
+
+        :param token: токен API.
+        :param key: название значения.
+        :return: значение или None.
+        """
+        row = self.connect().execute(
+            "SELECT value FROM meta WHERE token = ? AND key = ?", (token, key)
+        ).fetchone()
+        return row[0] if row else None
+
+    def claim(self, token: str, key: str, max_age: float, now: float) -> bool:
+        """
+        Атомарно обновляет отметку времени, если она старше max_age.
+
+        Используется, чтобы синхронизацию с API выполнял только один процесс.
+        :param token: токен API.
+        :param key: название отметки.
+        :param max_age: допустимый возраст отметки в секундах.
+        :param now: текущее время.
+        :return: True, если отметка была устаревшей и обновлена этим вызовом.
+        """
+        with self.transaction() as db:
+            row = db.execute(
+                "SELECT value FROM meta WHERE token = ? AND key = ?", (token, key)
+            ).fetchone()
+            if row is not None and now - row[0] <= max_age:
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO meta (token, key, value) VALUES (?, ?, ?)",
+                (token, key, now),
+            )
+            return True
+
+    def release(self, token: str, key: str, claimed_at: float) -> None:
+        """
+        Снимает отметку, поставленную claim, если её не обновил другой процесс.
+
+        Вызывается, если синхронизация не удалась, чтобы её повторил следующий триггер.
+        :param token: токен API.
+        :param key: название отметки.
+        :param claimed_at: время, переданное в claim.
+        :return: None.
+        """
+        with self.transaction() as db:
+            db.execute(
+                "DELETE FROM meta WHERE token = ? AND key = ? AND value = ?",
+                (token, key, claimed_at),
+            )
+
+
+class SharedTagCache:
+    """
+    Кэш id тегов по названию в SharedStore.
+
+    Заменяет TTLCache в Handler(tag_cache=...): тег, найденный одним процессом,
+    сразу доступен остальным.
+    """
+
+    def __init__(self, store: SharedStore, token: str = "", ttl: float = 300.0,
+                 negative_ttl: float = 30.0, clock=time.time):
+        """
+        Создаёт кэш.
+
+        :param store: общее хранилище.
+        :param token: токен API, к которому относятся теги.
+        :param ttl: время жизни найденного id в секундах.
+        :param negative_ttl: время жизни отсутствия тега в секундах.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.store = store
+        self.token = token
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.flights = SingleFlight()
+
+        self.hits = 0
+        self.misses = 0
+
+    def for_token(self, token: str) -> "SharedTagCache":
+        """Возвращает кэш тегов другого токена API в том же хранилище."""
+        return SharedTagCache(self.store, token, self.ttl, self.negative_ttl, self.clock)
+
+    def get_or_load(self, label: str, loader) -> int | None:
+        """
+        Возвращает id тега из хранилища, при промахе загружает его.
+
+        :param label: название тега.
+        :param loader: функция без аргументов, возвращающая id тега или None.
+        :return: id тега или None.
+        """
+        row = self.store.connect().execute(
+            "SELECT tag_id, expires_at FROM tags WHERE token = ? AND label = ?",
+            (self.token, label),
+        ).fetchone()
+        if row is not None and row[1] > self.clock():
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+
+        def load() -> int | None:
+            tag_id = loader()
+            ttl = self.ttl if tag_id is not None else self.negative_ttl
+            with self.store.transaction() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO tags (token, label, tag_id, expires_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (self.token, label, tag_id, self.clock() + ttl),
+                )
+            return tag_id
+
+        return self.flights.do(label, load)
+
+    def invalidate(self, key: str = None) -> None:
+        """
+        Удаляет тег из хранилища.
+
+        :param key: название тега. Если не указано, удаляются все теги токена.
+        :return: None.
+        """
+        with self.store.transaction() as db:
+            if key is None:
+                db.execute("DELETE FROM tags WHERE token = ?", (self.token,))
+            else:
+                db.execute("DELETE FROM tags WHERE token = ? AND label = ?", (self.token, key))
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику кэша в этом процессе.
+
+        :return: словарь с кол-вом попаданий, промахов и объединённых загрузок.
+        """
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.flights.coalesced}
+
+
+class SharedClientDirectory:
+    """
+    Справочник клиентов с индексом по имени в SharedStore.
+
+    Заменяет ClientDirectory в Handler(client_directory=...). Полную синхронизацию
+    с API выполняет один процесс, остальные ищут по её результату. Пока первая
+    синхронизация не завершена, остальные процессы ждут её, а не загружают
+    справочник сами.
+    """
+
+    def __init__(self, store: SharedStore, token: str = "", max_age: float = 3600.0,
+                 normalized_index: bool = False, wait_timeout: float = 60.0,
+                 clock=time.time, sleep=time.sleep):
+        """
+        Создаёт справочник.
+
+        :param store: общее хранилище.
+        :param token: токен API, к которому относятся клиенты.
+        :param max_age: время в секундах, после которого справочник
+         полностью синхронизируется с API при следующем поиске.
+        :param normalized_index: True, если нужно искать также без учёта регистра и пробелов.
+        :param wait_timeout: максимальное время в секундах ожидания первой синхронизации,
+         начатой другим процессом. Если она не завершилась, справочник загружается сам.
+        :param clock: функция, возвращающая текущее время в секундах.
+        :param sleep: функция ожидания.
+        """
+        self.store = store
+        self.token = token
+        self.max_age = max_age
+        self.normalized_index = normalized_index
+        self.wait_timeout = wait_timeout
+        self.clock = clock
+        self.sleep = sleep
+
+    def for_token(self, token: str) -> "SharedClientDirectory":
+        """Возвращает справочник другого токена API в том же хранилище."""
+        return SharedClientDirectory(
+            self.store, token, self.max_age, self.normalized_index, self.wait_timeout,
+            self.clock, self.sleep,
+        )
+
+    def _save_(self, clients: list[tuple[int, str]], start: int) -> None:
+        """
+        Сохраняет клиентов, полученных из API.
+
+        :param clients: список пар (id, имя) в порядке коллекции.
+        :param start: позиция первого клиента в коллекции. 0 - справочник заменяется.
+        :return: None.
+        """
+        with self.store.transaction() as db:
+            if start == 0:
+                db.execute("DELETE FROM clients WHERE token = ?", (self.token,))
+                db.execute(
+                    "INSERT OR REPLACE INTO meta (token, key, value) VALUES (?, ?, ?)",
+                    (self.token, "clients_loaded_at", self.clock()),
+                )
+            db.executemany(
+                "INSERT OR REPLACE INTO clients (token, position, id, name, normalized_name) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (self.token, start + i, client_id, name, normalize_name(name))
+                    for i, (client_id, name) in enumerate(clients)
+                ],
+            )
+
+    def _fetch_(self, handler, start: int) -> list[tuple[int, str]]:
+        """
+        Запрашивает по API клиентов начиная с указанной позиции.
+
+        :param handler: Handler, через который выполняются запросы.
+        :param start: смещение первого запрашиваемого клиента.
+        :return: список пар (id, имя) в порядке коллекции.
+        """
+        return [
+            (client["id"], client["name"])
+            for client in handler.iter_clients(start_offset=start)
+        ]
+
+    def sync(self, handler) -> None:
+        """
+        Полностью загружает справочник из API.
+
+        :param handler: Handler, через который выполняются запросы.
+        :return: None.
+        """
+        self._save_(self._fetch_(handler, 0), 0)
+
+    def refresh(self, handler) -> None:
+        """
+        Загружает из API только клиентов после уже сохранённых.
+
+        :param handler: Handler, через который выполняются запросы.
+        :return: None.
+        """
+        start = self.store.connect().execute(
+            "SELECT COUNT(*) FROM clients WHERE token = ?", (self.token,)
+        ).fetchone()[0]
+        self._save_(self._fetch_(handler, start), start)
+
+    def find(self, username: str) -> int | None:
+        """
+        Ищет id клиента по имени в хранилище.
+
+        :param username: имя клиента.
+        :return: id клиента или None.
+        """
+        db = self.store.connect()
+        row = db.execute(
+            "SELECT id FROM clients WHERE token = ? AND name = ? ORDER BY position LIMIT 1",
+            (self.token, username),
+        ).fetchone()
+        if row is None and self.normalized_index:
+            row = db.execute(
+                "SELECT id FROM clients WHERE token = ? AND normalized_name = ? "
+                "ORDER BY position LIMIT 1",
+                (self.token, normalize_name(username)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _wait_loaded_(self) -> None:
+        """Ожидает завершения первой синхронизации, начатой другим процессом."""
+        deadline = time.monotonic() + self.wait_timeout
+        while (
+            self.store.get_meta(self.token, "clients_loaded_at") is None
+            and time.monotonic() < deadline
+        ):
+            self.sleep(0.05)
+
+    def get_user_id(self, username: str, handler) -> int | None:
+        """
+        Ищет id клиента по имени.
+
+        Если справочник устарел, его синхронизирует первый заметивший это процесс.
+        При промахе один раз запрашиваются новые клиенты из API.
+        :param username: имя клиента.
+        :param handler: Handler, через который выполняются запросы.
+        :return: id клиента или None, если клиент не найден.
+        """
+        now = self.clock()
+        if self.store.claim(self.token, "clients_synced_at", self.max_age, now):
+            try:
+                self.sync(handler)
+            except Exception:
+                self.store.release(self.token, "clients_synced_at", now)
+                raise
+            return self.find(username)
+
+        # Иначе при первом запуске промах привёл бы к загрузке всего справочника с начала
+        self._wait_loaded_()
+        client_id = self.find(username)
+        if client_id is None:
+            self.refresh(handler)
+            client_id = self.find(username)
+        return client_id
+
+
+class SharedOperatorPool:
+    """
+    Снимок загрузки операторов в SharedStore.
+
+    Заменяет OperatorPool в Handler(operator_pool=...). Резервирование выполняется
+    одной транзакцией BEGIN IMMEDIATE, поэтому процессы не назначают оператору
+    больше max_dialogs диалогов.
+    """
+
+    def __init__(self, store: SharedStore, token: str = "", max_dialogs: int = 5,
+                 resync_interval: float = 60.0, clock=time.time):
+        """
+        Создаёт пул операторов.
+
+        :param store: общее хранилище.
+        :param token: токен API, к которому относятся операторы.
+        :param max_dialogs: кол-во открытых диалогов, при котором оператор считается занятым.
+        :param resync_interval: время в секундах, после которого снимок синхронизируется с API.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.store = store
+        self.token = token
+        self.max_dialogs = max_dialogs
+        self.resync_interval = resync_interval
+        self.clock = clock
+
+    def for_token(self, token: str) -> "SharedOperatorPool":
+        """Возвращает пул операторов другого токена API в том же хранилище."""
+        return SharedOperatorPool(
+            self.store, token, self.max_dialogs, self.resync_interval, self.clock
+        )
+
+    def load(self, operators: list[tuple[int, int]], replace: bool = True) -> None:
+        """
+        Заменяет снимок загрузки операторов.
+
+        Неподтверждённые резервирования переносятся в новый снимок, так как
+        назначения, которые ещё выполняются, не видны в API.
+        :param operators: список пар (id оператора, кол-во открытых диалогов) в порядке коллекции.
+        :param replace: False, если уже загруженный другим процессом снимок нужно оставить.
+        :return: None.
+        """
+        with self.store.transaction() as db:
+            if not replace and db.execute(
+                "SELECT 1 FROM operators WHERE token = ? LIMIT 1", (self.token,)
+            ).fetchone():
+                return
+            reserved = dict(db.execute(
+                "SELECT id, reserved FROM operators WHERE token = ? AND reserved > 0",
+                (self.token,),
+            ))
+            db.execute("DELETE FROM operators WHERE token = ?", (self.token,))
+            db.executemany(
+                "INSERT INTO operators (token, id, position, load, reserved) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        self.token, operator_id, position,
+                        load + reserved.get(operator_id, 0), reserved.get(operator_id, 0),
+                    )
+                    for position, (operator_id, load) in enumerate(operators)
+                ],
+            )
+
+    def sync(self, handler, replace: bool = True) -> None:
+        """
+        Загружает загрузку всех операторов из API.
+
+        :param handler: Handler, через который выполняются запросы.
+        :param replace: False, если уже загруженный другим процессом снимок нужно оставить.
+        :return: None.
+        """
+        self.load(
+            [(operator["id"], operator["opened_dialogs"]) for operator in handler.iter_operators()],
+            replace,
+        )
+
+    def _loaded_(self) -> bool:
+        """Проверяет, есть ли в хранилище операторы токена."""
+        return self.store.connect().execute(
+            "SELECT 1 FROM operators WHERE token = ? LIMIT 1", (self.token,)
+        ).fetchone() is not None
+
+    def is_stale(self) -> bool:
+        """
+        Проверяет, нужно ли синхронизировать снимок с API.
+
+        :return: True, если снимок не загружен или устарел.
+        """
+        synced_at = self.store.get_meta(self.token, "operators_synced_at")
+        return synced_at is None or self.clock() - synced_at > self.resync_interval
+
+    def reserve(self, handler) -> int | None:
+        """
+        Выбирает наименее загруженного оператора и резервирует за ним диалог.
+
+        При равной загрузке выбирается оператор, идущий раньше в коллекции.
+        :param handler: Handler, через который выполняется синхронизация при устаревании снимка.
+        :return: id оператора или None, если все операторы заняты.
+        """
+        # claim берёт блокировку записи, поэтому выполняется, только когда снимок устарел
+        now = self.clock()
+        claimed = self.is_stale() and self.store.claim(
+            self.token, "operators_synced_at", self.resync_interval, now
+        )
+        loaded = self._loaded_()
+        if claimed or not loaded:  # Первую загрузку другого процесса не ждём и не затираем
+            try:
+                self.sync(handler, replace=loaded)
+            except Exception:
+                if claimed:
+                    self.store.release(self.token, "operators_synced_at", now)
+                raise
+
+        with self.store.transaction() as db:
+            row = db.execute(
+                "SELECT id FROM operators WHERE token = ? AND load < ? "
+                "ORDER BY load, position LIMIT 1",
+                (self.token, self.max_dialogs),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE operators SET load = load + 1, reserved = reserved + 1 "
+                "WHERE token = ? AND id = ?",
+                (self.token, row[0]),
+            )
+            return row[0]
+
+    def release(self, operator_id: int) -> None:
+        """
+        Снимает резервирование, если диалог не был назначен оператору.
+
+        :param operator_id: id оператора.
+        :return: None.
+        """
+        with self.store.transaction() as db:
+            db.execute(
+                "UPDATE operators SET load = load - 1, reserved = reserved - 1 "
+                "WHERE token = ? AND id = ? AND reserved > 0",
+                (self.token, operator_id),
+            )
+
+    def assigned(self, operator_id: int) -> None:
+        """
+        Учитывает назначение диалога оператору.
+
+        Если за оператором было резервирование, оно подтверждается.
+        Иначе загрузка оператора увеличивается.
+        :param operator_id: id оператора.
+        :return: None.
+        """
+        with self.store.transaction() as db:
+            db.execute(
+                "UPDATE operators SET "
+                "load = load + (reserved = 0), reserved = MAX(reserved - 1, 0) "
+                "WHERE token = ? AND id = ?",
+                (self.token, operator_id),
+            )
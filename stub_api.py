@@ -0,0 +1,224 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+VIP_TAG_ID = 1
+
+
+class StubAPI:
+    """
+    Локальная замена API Chat2Desk для бенчмарков и нагрузочных тестов.
+
+    Отдаёт сгенерированные коллекции клиентов, тегов и операторов заданного размера,
+    принимает сообщения, назначения тегов и операторов.
+    Позволяет задать задержку каждого ответа и долю ответов с ошибкой 500.
+    Ответы на GET содержат ETag, при совпадении If-None-Match отдаётся 304 без тела.
+    """
+
+    def __init__(
+        self,
+        clients: int = 1000,
+        tags: int = 50,
+        operators: int = 100,
+        vip_every: int = 2,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        etags: bool = True,
+    ):
+        """
+        Создаёт заглушку API.
+
+        :param clients: кол-во клиентов. Клиент с id N называется clientN.
+        :param tags: кол-во тегов. Тег VIP идёт последним в коллекции.
+        :param operators: кол-во операторов.
+        :param vip_every: у каждого vip_every-го клиента есть тег VIP.
+        :param latency: задержка каждого ответа в секундах.
+        :param error_rate: доля ответов с ошибкой 500, от 0 до 1.
+        :param seed: seed генератора загрузки операторов и ошибок.
+        :param host: адрес, на котором запускается сервер.
+        :param port: порт сервера. 0 - любой свободный.
+        :param etags: True, если ответы на GET содержат ETag и поддерживают If-None-Match.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.vip_every = vip_every
+        self.clients_count = clients
+        self.etags = etags
+
+        rnd = random.Random(seed)
+        self._random = random.Random(seed + 1)
+        self.tags = [{"id": i, "label": f"tag{i}"} for i in range(2, tags + 1)]
+        self.tags.append({"id": VIP_TAG_ID, "label": "VIP"})
+        self.operators = [
+            {"id": i, "opened_dialogs": rnd.randint(0, 9)} for i in range(1, operators + 1)
+        ]
+
+        self.calls = Counter()
+        self.server_errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_request_handler_())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Базовый url API заглушки, передаваемый в Handler(api_url=...)."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def client(self, client_id: int) -> dict | None:
+        """
+        Возвращает данные клиента.
+
+        :param client_id: id клиента.
+        :return: данные клиента или None, если такого нет.
+        """
+        if not 1 <= client_id <= self.clients_count:
+            return None
+        tags = [{"id": VIP_TAG_ID}] if client_id % self.vip_every == 0 else []
+        return {"id": client_id, "name": f"client{client_id}", "tags": tags}
+
+    def clients_page(self, limit: int, offset: int) -> list:
+        """
+        Возвращает страницу коллекции клиентов.
+
+        :param limit: кол-во клиентов на странице.
+        :param offset: смещение первого клиента.
+        :return: список клиентов.
+        """
+        last = min(offset + limit, self.clients_count)
+        return [self.client(client_id) for client_id in range(offset + 1, last + 1)]
+
+    def total_calls(self) -> int:
+        """Возвращает общее кол-во обработанных запросов."""
+        with self._lock:
+            return sum(self.calls.values())
+
+    def total_server_errors(self) -> int:
+        """Возвращает кол-во ответов с ошибкой 500."""
+        with self._lock:
+            return self.server_errors
+
+    def _route_(self, method: str, path: str, query: dict) -> tuple[int, object]:
+        """
+        Формирует ответ на запрос.
+
+        :param method: HTTP метод.
+        :param path: путь запроса.
+        :param query: параметры запроса.
+        :return: (код ответа, json ответа).
+        """
+        limit = int(query.get("limit", ["20"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+
+        def page(data: list, total: int) -> tuple[int, dict]:
+            return 200, {"data": data, "meta": {"total": total, "limit": limit, "offset": offset}}
+
+        if method == "GET" and path == "/v1/clients/":
+            return page(self.clients_page(limit, offset), self.clients_count)
+        if method == "GET" and path == "/v1/tags/":
+            return page(self.tags[offset:offset + limit], len(self.tags))
+        if method == "GET" and path == "/v1/operators/":
+            return page(self.operators[offset:offset + limit], len(self.operators))
+
+        match = re.fullmatch(r"/v1/(clients|dialogs|requests)/(\d+)", path)
+        if match and method in ("GET", "PUT"):
+            collection, object_id = match.group(1), int(match.group(2))
+            client_id = (object_id - 1) % self.clients_count + 1
+            if collection == "clients" and method == "GET":
+                client = self.client(object_id)
+                return (200, {"data": client}) if client else (404, {"status": "error"})
+            if collection == "dialogs":
+                return 200, {"data": {"id": object_id, "last_message": {"client_id": client_id}}}
+            if collection == "requests" and method == "GET":
+                return 200, {"data": {"id": object_id, "client_id": client_id}}
+
+        if method == "POST" and path in ("/v1/messages", "/v1/tags/assign_to"):
+            return 200, {"status": "success"}
+
+        return 404, {"status": "error"}
+
+    def _make_request_handler_(self):
+        """Создаёт класс обработчика HTTP запросов, связанный с заглушкой."""
+        stub = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _handle_(self, method: str) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+
+                url = urlsplit(self.path)
+                with stub._lock:
+                    stub.calls[f"{method} {url.path}"] += 1
+                    failed = stub.error_rate and stub._random.random() < stub.error_rate
+                    if failed:
+                        stub.server_errors += 1
+
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                if failed:
+                    status, body = 500, {"status": "error"}
+                else:
+                    status, body = stub._route_(method, url.path, parse_qs(url.query))
+
+                content = json.dumps(body).encode()
+                etag = None
+                if stub.etags and method == "GET" and status == 200:
+                    etag = f'"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        status, content = 304, b""
+
+                self.send_response(status)
+                if etag is not None:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):  # noqa: N802
+                self._handle_("GET")
+
+            def do_POST(self):  # noqa: N802
+                self._handle_("POST")
+
+            def do_PUT(self):  # noqa: N802
+                self._handle_("PUT")
+
+            def log_message(self, *args):
+                pass
+
+        return RequestHandler
+
+    def start(self) -> "StubAPI":
+        """Запускает сервер в фоновом потоке."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Останавливает сервер."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        """Запускает сервер при входе в with."""
+        return self.start()
+
+    def __exit__(self, *exc):
+        """Останавливает сервер при выходе из with."""
+        self.stop()
@@ -0,0 +1,120 @@
+import contextlib
+import threading
+from collections import OrderedDict
+
+
+class _Tenant:
+    """Обработчик одного токена API и кол-во вызовов, которые его используют."""
+
+    def __init__(self, handler):
+        """Создаёт запись пула для обработчика."""
+        self.handler = handler
+        self.users = 0
+        self.evicted = False
+
+
+class TenantPool:
+    """
+    Ограниченный LRU пул обработчиков по токенам API.
+
+    Для каждого токена создаётся свой обработчик со своим HTTP-транспортом и кэшами,
+    поэтому вызовы разных токенов из разных потоков не разделяют изменяемое состояние.
+    При превышении размера вытесняется самый давно использованный обработчик,
+    его ресурсы освобождаются после завершения всех использующих его вызовов.
+    """
+
+    def __init__(self, factory, maxsize: int = 32, close=None):
+        """
+        Создаёт пустой пул.
+
+        :param factory: функция (токен), создающая обработчик токена.
+        :param maxsize: максимальное кол-во хранимых обработчиков.
+        :param close: функция (обработчик), освобождающая ресурсы вытесненного обработчика.
+        """
+        self.factory = factory
+        self.maxsize = maxsize
+        self.close = close
+
+        self._tenants = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.created = 0
+        self.reused = 0
+        self.evictions = 0
+
+    @contextlib.contextmanager
+    def lease(self, token: str):
+        """
+        Выдаёт обработчик токена на время блока with.
+
+        :param token: токен API.
+        :return: обработчик токена.
+        """
+        with self._lock:
+            tenant = self._tenants.get(token)
+            if tenant is None:
+                tenant = self._tenants[token] = _Tenant(self.factory(token))
+                self.created += 1
+            else:
+                self.reused += 1
+            self._tenants.move_to_end(token)
+            tenant.users += 1
+            evicted = self._evict_()
+
+        self._close_(evicted)
+        try:
+            yield tenant.handler
+        finally:
+            with self._lock:
+                tenant.users -= 1
+                idle = tenant.evicted and tenant.users == 0
+            if idle:
+                self._close_([tenant])
+
+    def _evict_(self) -> list:
+        """
+        Вытесняет лишние обработчики. Вызывается под блокировкой.
+
+        :return: вытесненные обработчики, которые уже никем не используются.
+        """
+        idle = []
+        while len(self._tenants) > self.maxsize:
+            _, tenant = self._tenants.popitem(last=False)
+            tenant.evicted = True
+            self.evictions += 1
+            if tenant.users == 0:
+                idle.append(tenant)
+        return idle
+
+    def _close_(self, tenants: list) -> None:
+        """Освобождает ресурсы обработчиков."""
+        if self.close is not None:
+            for tenant in tenants:
+                self.close(tenant.handler)
+
+    def clear(self) -> None:
+        """Освобождает ресурсы всех неиспользуемых обработчиков и очищает пул."""
+        with self._lock:
+            tenants = list(self._tenants.values())
+            self._tenants.clear()
+            idle = []
+            for tenant in tenants:
+                tenant.evicted = True
+                if tenant.users == 0:
+                    idle.append(tenant)
+        self._close_(idle)
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику пула.
+
+        :return: словарь с кол-вом созданных и переиспользованных обработчиков,
+         вытеснений и текущим размером пула.
+        """
+        with self._lock:
+            return {
+                "created": self.created,
+                "reused": self.reused,
+                "evictions": self.evictions,
+                "size": len(self._tenants),
+            }
@@ -1,7 +1,38 @@
+import asyncio
+import json
+import os
+import re
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 import responses
 
+import benchmark
+import replay
+from async_handler import AsyncHandler
+from cache import AsyncSingleFlight, TTLCache
+from directory import ClientDirectory
+from hedging import HedgePolicy
 from main import Handler
+from metrics import Metrics
+from mirror import LocalMirror
+from operators import OperatorPool
+from outbox import Outbox
+from pages import PageStore
+from profiles import ClientProfiles
+from recorder import TriggerRecorder
+from scheduler import AdaptiveLimiter, RequestScheduler, TokenBucket
+from server import IngestionServer
+from shared import SharedClientDirectory, SharedOperatorPool, SharedStore, SharedTagCache
+from stub_api import StubAPI
+from tenants import TenantPool
+from transport import DeadlineExceeded, Transport
+from warmstart import WarmState, run_trigger
+from workers import WorkerPool
 
 
 class C2DMock:
@@ -178,3 +209,1213 @@ class TestCase(unittest.TestCase):
         }, self.c2d_mock)
 
         self.assertEqual(f"Failed to attach operator for client with id 726888910", result)
+
+    @responses.activate
+    def test_requests_go_through_shared_transport(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/clients/726888910',
+            'body': """{ "data": { "id": 726888910, "tags": [ { "id": 379158 } ] } }""",
+            'status': 200,
+            'content_type': 'application/json'
+        })
+
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/operators/?limit=200&offset=0',
+            'body': """{ "data": [ {"id": 312866, "opened_dialogs": 1 } ],
+                                "meta": { "total": 1, "limit": 200, "offset": 0 }
+                                }""",
+            'status': 200,
+            'content_type': 'application/json'
+        })
+
+        self.handler.new_request_handler({
+            "client_id": 726888910,
+            "dialog_id": 522372359,
+        }, self.c2d_mock)
+
+        self.assertEqual(5, self.handler.transport.stats()["requests"])
+        for call in responses.calls:
+            self.assertEqual("keep-alive", call.request.headers["Connection"])
+
+    @responses.activate
+    def test_async_handlers_match_sync_results(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/clients/726888910',
+            'body': """{ "data": { "id": 726888910, "tags": [ { "id": 379158 } ] } }""",
+            'status': 200,
+            'content_type': 'application/json'
+        })
+
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/operators/?limit=200&offset=0',
+            'body': """{ "data": [ {"id": 312866, "opened_dialogs": 1 } ],
+                                "meta": { "total": 1, "limit": 200, "offset": 0 }
+                                }""",
+            'status': 200,
+            'content_type': 'application/json'
+        })
+
+        async_handler = AsyncHandler(self.handler)
+        self.addCleanup(async_handler.close)
+
+        result = asyncio.run(async_handler.new_request_handler({
+            "client_id": 726888910,
+            "dialog_id": 522372359,
+        }, self.c2d_mock))
+        self.assertEqual("Attached operator with 312866 for client with id 726888910", result)
+
+        result = asyncio.run(async_handler.manually_handler({
+            'name': 'Павел'
+        }, self.c2d_mock))
+        self.assertEqual("Assigned VIP tag for client with name Павел", result)
+
+    @responses.activate
+    def test_async_new_request_no_vip_tag(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/clients/726888910',
+            'body': """{ "data": { "id": 726888910, "tags": [  ] } }""",
+            'status': 200,
+            'content_type': 'application/json'
+        })
+
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/operators/?limit=200&offset=0',
+            'body': """{ "data": [ {"id": 312866, "opened_dialogs": 1 } ],
+                                "meta": { "total": 1, "limit": 200, "offset": 0 }
+                                }""",
+            'status': 200,
+            'content_type': 'application/json'
+        })
+
+        async_handler = AsyncHandler(self.handler)
+        self.addCleanup(async_handler.close)
+
+        result = asyncio.run(async_handler.new_request_handler({
+            "client_id": 726888910,
+            "dialog_id": 522372359,
+        }, self.c2d_mock))
+
+        self.assertEqual("Failed to attach operator for client with id 726888910", result)
+        self.assertFalse(any(call.request.method == "PUT" for call in responses.calls))
+        self.assertFalse(any("/operators/" in call.request.url for call in responses.calls))
+
+    @responses.activate
+    def test_tag_id_is_cached_until_invalidated(self):
+        self.assertEqual(379158, self.handler.get_tag_id_by_label("VIP"))
+        self.assertEqual(379158, self.handler.get_tag_id_by_label("VIP"))
+        self.assertIsNone(self.handler.get_tag_id_by_label("Нет такого"))
+        self.assertIsNone(self.handler.get_tag_id_by_label("Нет такого"))
+
+        tag_calls = [c for c in responses.calls if "/v1/tags/" in c.request.url]
+        self.assertEqual(2, len(tag_calls))
+        self.assertEqual(2, self.handler.tag_cache.stats()["hits"])
+
+        self.handler.tag_cache.invalidate("VIP")
+        self.handler.get_tag_id_by_label("VIP")
+        tag_calls = [c for c in responses.calls if "/v1/tags/" in c.request.url]
+        self.assertEqual(3, len(tag_calls))
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    def test_ttl_and_lru_eviction(self):
+        now = [0.0]
+        cache = TTLCache(maxsize=2, ttl=10, negative_ttl=1, clock=lambda: now[0])
+
+        cache.set("a", 1)
+        cache.set("b", None)
+        cache.get("a")
+        cache.set("c", 3)  # вытесняет "b", т.к. "a" использовался позже
+
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual("default", cache.get("b", "default"))
+        self.assertEqual(1, cache.stats()["evictions"])
+
+        now[0] = 11
+        self.assertEqual(5, cache.get_or_load("a", lambda: 5))
+
+    def test_concurrent_misses_load_once(self):
+        cache = TTLCache()
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 42
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(cache.get_or_load, "key", loader)]
+            started.wait()
+            futures += [pool.submit(cache.get_or_load, "key", loader) for _ in range(3)]
+            release.set()
+            results = [f.result() for f in futures]
+
+        self.assertEqual([42] * 4, results)
+        self.assertEqual(1, len(calls))
+
+
+class ClientDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.directory = ClientDirectory(
+            max_age=60, normalized_index=True, clock=lambda: self.now[0]
+        )
+        self.handler = Handler(client_directory=self.directory)
+
+    def add_clients_page(self, offset: int, total: int, clients: list):
+        responses.add(**{
+            'method': responses.GET,
+            'url': f'https://api.chat2desk.com/v1/clients/?limit=200&offset={offset}',
+            'json': {"data": clients, "meta": {"total": total, "limit": 200, "offset": offset}},
+            'status': 200,
+        })
+
+    @responses.activate
+    def test_lookup_uses_local_index(self):
+        self.add_clients_page(0, 2, [
+            {"name": "Павел", "id": 726888910},
+            {"name": "elsbv", "id": 740209971},
+        ])
+
+        self.assertEqual(726888910, self.handler.get_user_id_by_username("Павел"))
+        self.assertEqual(740209971, self.handler.get_user_id_by_username("  ELSBV "))
+        self.assertEqual(1, len(responses.calls))
+
+    @responses.activate
+    def test_miss_fetches_only_new_clients(self):
+        self.add_clients_page(0, 1, [{"name": "Павел", "id": 726888910}])
+        self.add_clients_page(1, 2, [{"name": "Новый", "id": 1}])
+        self.add_clients_page(2, 2, [])
+
+        self.directory.sync(self.handler)
+        self.now[0] = 50
+        self.assertEqual(1, self.handler.get_user_id_by_username("Новый"))
+        self.assertIsNone(self.handler.get_user_id_by_username("Нет такого"))
+
+        offsets = [call.request.params["offset"] for call in responses.calls]
+        self.assertEqual(["0", "1", "2"], offsets)
+
+        self.now[0] = 61  # Дозагрузки не откладывают полную синхронизацию
+        self.assertTrue(self.directory.is_stale())
+
+    def test_persists_to_sqlite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "clients.db")
+            directory = ClientDirectory(path, clock=lambda: self.now[0])
+            directory._index_([(5, "Павел")])
+            directory._save_([(5, "Павел")], 0)
+            directory.close()
+
+            directory = ClientDirectory(path, clock=lambda: self.now[0])
+            self.addCleanup(directory.close)
+            self.assertEqual(5, directory.find("Павел"))
+
+
+class ParallelPaginationTestCase(unittest.TestCase):
+    def add_operators_page(self, offset: int, opened_dialogs: int):
+        responses.add(**{
+            'method': responses.GET,
+            'url': f'https://api.chat2desk.com/v1/operators/?limit=200&offset={offset}',
+            'json': {
+                "data": [{"id": offset + 1, "opened_dialogs": opened_dialogs}],
+                "meta": {"total": 1000, "limit": 200, "offset": offset}
+            },
+            'status': 200,
+        })
+
+    @responses.activate
+    def test_returns_first_match_in_collection_order(self):
+        for offset, opened_dialogs in [(0, 9), (200, 9), (400, 1), (600, 1), (800, 9)]:
+            self.add_operators_page(offset, opened_dialogs)
+
+        handler = Handler(page_workers=4)
+        self.assertEqual(401, handler.get_available_operator())
+        handler.close()
+
+    @responses.activate
+    def test_no_match_fetches_every_page_once(self):
+        for offset in range(0, 1000, 200):
+            self.add_operators_page(offset, 9)
+
+        handler = Handler(page_workers=3, page_prefetch=3)
+        self.assertIsNone(handler.get_available_operator())
+        handler.close()
+
+        offsets = sorted(int(call.request.params["offset"]) for call in responses.calls)
+        self.assertEqual([0, 200, 400, 600, 800], offsets)
+
+
+class OperatorPoolTestCase(unittest.TestCase):
+    def test_reserves_least_loaded_within_limit(self):
+        pool = OperatorPool(max_dialogs=5)
+        pool.load([(1, 4), (2, 3), (3, 5)])
+
+        reserved = [pool.reserve(None) for _ in range(4)]
+
+        self.assertEqual([2, 1, 2, None], reserved)
+
+    def test_release_and_assignment_accounting(self):
+        pool = OperatorPool(max_dialogs=2)
+        pool.load([(1, 1)])
+
+        operator_id = pool.reserve(None)
+        self.assertIsNone(pool.reserve(None))
+
+        pool.release(operator_id)
+        self.assertEqual(1, pool.reserve(None))
+
+        pool.assigned(1)  # подтверждение резервирования не меняет загрузку
+        self.assertEqual(2, pool.loads[1])
+
+    def test_resync_keeps_pending_reservations(self):
+        pool = OperatorPool(max_dialogs=2)
+        pool.load([(1, 0), (2, 1)])
+        self.assertEqual(1, pool.reserve(None))
+
+        pool.load([(1, 0), (2, 1)])  # назначение ещё не видно в API
+        self.assertEqual(1, pool.loads[1])
+
+        pool.assigned(1)
+        self.assertEqual(1, pool.loads[1])
+        pool.release(1)  # резервирование уже подтверждено
+        self.assertEqual(1, pool.loads[1])
+
+    @responses.activate
+    def test_failed_assignment_releases_operator(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/operators/?limit=200&offset=0',
+            'json': {"data": [{"id": 312866, "opened_dialogs": 4}],
+                     "meta": {"total": 1, "limit": 200, "offset": 0}},
+            'status': 200,
+        })
+        responses.add(**{
+            'method': responses.PUT,
+            'url': 'https://api.chat2desk.com/v1/dialogs/1',
+            'status': 500,
+        })
+
+        handler = Handler(operator_pool=OperatorPool())
+        operator_id = handler.get_available_operator()
+        self.assertEqual(312866, operator_id)
+        self.assertIsNone(handler.get_available_operator())
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            handler.set_operator_to_dialog(1, operator_id, "OPEN")
+
+        self.assertEqual(312866, handler.get_available_operator())
+        self.assertEqual(1, len(responses.calls) - 1)  # снимок запрошен один раз
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.handler = Handler()
+        self.c2d_mock = C2DMock('')
+
+    @responses.activate
+    def test_new_request_batch_shares_lookups_and_spreads_operators(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/clients/726888910',
+            'body': """{ "data": { "id": 726888910, "tags": [ { "id": 379158 } ] } }""",
+            'status': 200,
+            'content_type': 'application/json'
+        })
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/clients/1',
+            'status': 404,
+        })
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/tags/',
+            'json': {"data": [{"id": 379158, "label": "VIP"}],
+                     "meta": {"total": 1, "limit": 200, "offset": 0}},
+            'status': 200,
+        })
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/operators/?limit=200&offset=0',
+            'json': {"data": [{"id": 10, "opened_dialogs": 1}, {"id": 20, "opened_dialogs": 1}],
+                     "meta": {"total": 2, "limit": 200, "offset": 0}},
+            'status': 200,
+        })
+        responses.add(responses.POST, "https://api.chat2desk.com/v1/messages", json={})
+        for dialog_id in (1, 2):
+            responses.add(responses.PUT, f"https://api.chat2desk.com/v1/dialogs/{dialog_id}",
+                          json={})
+
+        results = self.handler.new_request_batch_handler([
+            {"client_id": 726888910, "dialog_id": 1},
+            {"client_id": 726888910, "dialog_id": 2},
+            {"client_id": 1, "dialog_id": 3},
+            {},
+        ], self.c2d_mock)
+
+        self.assertEqual([
+            "Attached operator with 10 for client with id 726888910",
+            "Attached operator with 20 for client with id 726888910",
+            "Failed to attach operator for client with id 1",
+            "Failed to attach operator for client with id ",
+        ], results)
+
+        urls = [call.request.url for call in responses.calls]
+        self.assertEqual(1, sum("/v1/clients/726888910" in url for url in urls))
+        self.assertEqual(1, sum("/v1/operators/" in url for url in urls))
+        self.assertEqual(1, sum("/v1/tags/" in url for url in urls))
+
+    @responses.activate
+    def test_batch_reports_malformed_items(self):
+        results = self.handler.manually_batch_handler([None, 42], self.c2d_mock)
+        self.assertEqual(["Failed assign VIP tag for client with name "] * 2, results)
+
+        results = self.handler.new_request_batch_handler([None], self.c2d_mock)
+        self.assertEqual(["Failed to attach operator for client with id "], results)
+        self.assertEqual(0, len(responses.calls))
+
+
+class IteratorTestCase(unittest.TestCase):
+    @responses.activate
+    def test_iter_clients_projects_fields_and_stops_early(self):
+        for offset in (0, 200):
+            responses.add(**{
+                'method': responses.GET,
+                'url': f'https://api.chat2desk.com/v1/clients/?limit=200&offset={offset}',
+                'json': {
+                    "data": [{"id": offset + i, "name": f"client{offset + i}", "phone": "7900"}
+                             for i in range(200)],
+                    "meta": {"total": 400, "limit": 200, "offset": offset}
+                },
+                'status': 200,
+            })
+
+        clients = Handler().iter_clients()
+        first = next(clients)
+        self.assertEqual({"id": 0, "name": "client0"}, first)
+
+        for client in clients:
+            if client["id"] == 150:
+                break
+        self.assertEqual(1, len(responses.calls))
+
+        all_ids = [client["id"] for client in Handler().iter_clients(fields=("id",))]
+        self.assertEqual(list(range(400)), all_ids)
+
+    @responses.activate
+    def test_projection_of_sparse_records(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/clients/?limit=200&offset=0',
+            'json': {"data": [{"id": 1, "name": "client1"}, {"id": 2}],
+                     "meta": {"total": 2, "limit": 200, "offset": 0}},
+            'status': 200,
+        })
+        self.assertEqual([{"id": 1, "name": "client1"}, {"id": 2, "name": None}],
+                         list(Handler().iter_clients()))
+
+
+class StubAPITestCase(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubAPI(clients=300, tags=5, operators=3).start()
+        self.addCleanup(self.stub.stop)
+        self.handler = Handler(api_url=self.stub.url)
+        self.addCleanup(self.handler.close)
+        self.c2d_mock = C2DMock('')
+
+    def test_handlers_against_stub(self):
+        self.stub.operators[0]["opened_dialogs"] = 1
+
+        result = self.handler.new_request_handler({"client_id": 2, "dialog_id": 1}, self.c2d_mock)
+        self.assertEqual("Attached operator with 1 for client with id 2", result)
+
+        result = self.handler.new_request_handler({"client_id": 3, "dialog_id": 1}, self.c2d_mock)
+        self.assertEqual("Failed to attach operator for client with id 3", result)
+
+        result = self.handler.manually_handler({"name": "client250"}, self.c2d_mock)
+        self.assertEqual("Assigned VIP tag for client with name client250", result)
+        self.assertEqual(2, self.stub.calls["GET /v1/clients/"])
+
+    def test_benchmark_report(self):
+        result = benchmark.run_scenario(
+            self.stub, lambda h, i: h.get_client_by_id(i + 1), iterations=10, concurrency=2
+        )
+
+        self.assertEqual(10, result["operations"])
+        self.assertEqual(1.0, result["api_calls_per_op"])
+        self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+        self.assertEqual(3, benchmark.percentile([5, 1, 4, 2, 3], 50))
+        self.assertEqual(0.0, result["error_rate"])
+
+        self.stub.error_rate = 1.0
+        result = benchmark.run_scenario(
+            self.stub, lambda h, i: h.get_client_by_id(i + 1), iterations=4, concurrency=2
+        )
+        self.assertEqual(1.0, result["error_rate"])
+        self.assertEqual(1.0, result["api_errors_per_op"])
+
+
+class MetricsTestCase(unittest.TestCase):
+    @responses.activate
+    def test_records_requests_pages_and_handlers(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/clients/726888910',
+            'body': """{ "data": { "id": 726888910, "tags": [  ] } }""",
+            'status': 200,
+            'content_type': 'application/json'
+        })
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/tags/',
+            'json': {"data": [{"id": 379158, "label": "VIP"}],
+                     "meta": {"total": 1, "limit": 200, "offset": 0}},
+            'status': 200,
+        })
+
+        metrics = Metrics()
+        handler = Handler(instrumentation=metrics)
+        handler.new_request_handler({"client_id": 726888910, "dialog_id": 1}, C2DMock(''))
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(1, snapshot["requests_total"]["GET /clients/{id} 200"])
+        self.assertEqual(1, snapshot["pages_per_scan"]["/tags/"]["count"])
+        self.assertEqual(1, snapshot["handler_calls_total"]["new_request_handler failure"])
+
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE chat2desk_api_request_duration_seconds histogram', text)
+        self.assertIn(
+            'chat2desk_api_request_duration_seconds_count{method="GET",endpoint="/tags/"} 1',
+            text
+        )
+        self.assertIn(
+            'chat2desk_handler_calls_total{handler="new_request_handler",outcome="failure"} 1',
+            text
+        )
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.scheduler = RequestScheduler(
+            rate=100, burst=100, sleep=self.sleeps.append, rand=lambda: 1.0
+        )
+        self.handler = Handler(scheduler=self.scheduler)
+
+    @responses.activate
+    def test_retries_throttled_message_after_retry_after(self):
+        responses.add(responses.POST, "https://api.chat2desk.com/v1/messages",
+                      status=429, headers={"Retry-After": "2"})
+        responses.add(responses.POST, "https://api.chat2desk.com/v1/messages", json={})
+
+        self.handler.send_message_to_user(1, "text", False, "system")
+
+        self.assertEqual(2, len(responses.calls))
+        self.assertEqual(2.0, self.sleeps[0])
+        self.assertEqual({"retries": 1, "throttled": 1}, {
+            key: self.scheduler.stats()[key] for key in ("retries", "throttled")
+        })
+
+    @responses.activate
+    def test_server_error_retried_only_for_idempotent_requests(self):
+        responses.add(responses.POST, "https://api.chat2desk.com/v1/messages", status=500)
+        responses.add(responses.PUT, "https://api.chat2desk.com/v1/dialogs/1", status=502)
+        responses.add(responses.PUT, "https://api.chat2desk.com/v1/dialogs/1", json={})
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.handler.send_message_to_user(1, "text", False, "system")
+        self.handler.set_operator_to_dialog(1, 2)
+
+        self.assertEqual(3, len(responses.calls))
+        self.assertEqual([0.5], self.sleeps)
+
+    def test_token_bucket_and_adaptive_limit(self):
+        now = [0.0]
+        bucket = TokenBucket(rate=2, capacity=1, clock=lambda: now[0])
+        self.assertEqual(0.0, bucket.reserve())
+        self.assertEqual(0.5, bucket.reserve())
+
+        limiter = AdaptiveLimiter(initial=4, window=1.0, clock=lambda: now[0])
+        limiter.acquire()
+        limiter.release(latency=0.1, throttled=True)
+        self.assertEqual(2, limiter.limit)
+
+        limiter.acquire()
+        limiter.release(latency=2.0, throttled=False)  # то же окно
+        self.assertEqual(2, limiter.limit)
+        now[0] = 1.0
+        limiter.acquire()
+        limiter.release(latency=2.0, throttled=False)
+        self.assertEqual(1, limiter.limit)
+
+    @responses.activate
+    def test_connect_failures_retried_for_any_method(self):
+        url = "https://api.chat2desk.com/v1/messages"
+        responses.add(responses.POST, url, body=requests.exceptions.ConnectTimeout())
+        responses.add(responses.POST, url, json={})
+        self.handler.send_message_to_user(1, "text", False, "system")
+        self.assertEqual(2, len(responses.calls))
+
+        responses.add(responses.POST, url, body=requests.exceptions.ConnectionError("reset"))
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.handler.send_message_to_user(1, "text", False, "system")
+        self.assertEqual(3, len(responses.calls))
+
+
+class CoalescingTestCase(unittest.TestCase):
+    def test_concurrent_client_lookups_share_one_request(self):
+        handler = Handler()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_get(url, **kwargs):
+            calls.append(url)
+            started.set()
+            release.wait()
+            raise requests.exceptions.ConnectionError("boom")
+
+        handler.transport.get = slow_get
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(handler.get_client_by_id, 1)]
+            started.wait()
+            futures += [pool.submit(handler.get_client_by_id, 1) for _ in range(3)]
+            while handler.flights.stats()["calls"] < 4:
+                time.sleep(0.001)
+            release.set()
+
+        for future in futures:
+            self.assertIsInstance(future.exception(), requests.exceptions.ConnectionError)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(3, handler.coalescing_stats()["coalesced"])
+
+    def test_async_lookups_are_coalesced(self):
+        flights = AsyncSingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 42
+
+        async def main():
+            return await asyncio.gather(*(flights.do("key", fetch) for _ in range(5)))
+
+        self.assertEqual([42] * 5, asyncio.run(main()))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(4, flights.stats()["coalesced"])
+
+
+class OutboxTestCase(unittest.TestCase):
+    @responses.activate
+    def test_writes_are_queued_retried_and_kept_in_order(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/clients/?limit=200&offset=0',
+            'json': {"data": [{"name": "Павел", "id": 726888910}],
+                     "meta": {"total": 1, "limit": 200, "offset": 0}},
+            'status': 200,
+        })
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.chat2desk.com/v1/tags/',
+            'json': {"data": [{"id": 379158, "label": "VIP"}],
+                     "meta": {"total": 1, "limit": 200, "offset": 0}},
+            'status': 200,
+        })
+        responses.add(responses.POST, "https://api.chat2desk.com/v1/messages", status=503)
+        responses.add(responses.POST, "https://api.chat2desk.com/v1/messages", json={})
+        responses.add(responses.POST, "https://api.chat2desk.com/v1/tags/assign_to", json={})
+
+        outbox = Outbox(":memory:", workers=2, backoff=0.01)
+        handler = Handler(outbox=outbox)
+
+        result = handler.manually_handler({'name': 'Павел'}, C2DMock('token'))
+        self.assertEqual("Assigned VIP tag for client with name Павел", result)
+
+        self.assertTrue(outbox.flush(timeout=5))
+        stats = outbox.stats()
+        self.assertEqual((0, 2, 1), (stats["depth"], stats["delivered"], stats["failed_attempts"]))
+        handler.close()
+
+        writes = [(call.request.method, call.request.url.split('?')[0])
+                  for call in responses.calls if call.request.method == "POST"]
+        self.assertEqual([
+            ("POST", "https://api.chat2desk.com/v1/messages"),
+            ("POST", "https://api.chat2desk.com/v1/messages"),
+            ("POST", "https://api.chat2desk.com/v1/tags/assign_to"),
+        ], writes)
+        self.assertEqual("token", responses.calls[-1].request.headers["Authorization"])
+
+    @responses.activate
+    def test_rejected_assignment_is_dead_lettered_and_releases_operator(self):
+        responses.add(responses.PUT, "https://api.chat2desk.com/v1/dialogs/1", status=404)
+
+        outbox = Outbox(":memory:", workers=1, backoff=0.01)
+        handler = Handler(outbox=outbox, operator_pool=OperatorPool())
+        with handler.tenants.lease("token") as tenant:
+            tenant.operator_pool.load([(7, 0)])
+            self.assertEqual(7, tenant.get_available_operator())
+            tenant.set_operator_to_dialog(1, 7, "OPEN")
+
+        self.assertTrue(outbox.flush(timeout=5))
+        stats = outbox.stats()
+        self.assertEqual((1, 1), (stats["dead"], stats["failed_attempts"]))
+        self.assertEqual(0, tenant.operator_pool.loads[7])
+        self.assertEqual("token", responses.calls[0].request.headers["Authorization"])
+        handler.close()
+
+    @responses.activate
+    def test_ambiguous_post_is_not_resent_and_backoff_blocks_only_its_key(self):
+        responses.add(responses.PUT, "https://api.chat2desk.com/v1/dialogs/1", status=503)
+        responses.add(responses.POST, "https://api.chat2desk.com/v1/messages", status=500)
+
+        outbox = Outbox(":memory:", workers=1, backoff=60)
+        handler = Handler(outbox=outbox)
+        self.addCleanup(handler.release_connections)
+        handler.set_operator_to_dialog(1, 2)
+        handler.send_message_to_user(1, "text", False, "system")
+
+        started = time.monotonic()
+        while outbox.stats()["failed_attempts"] < 2 and time.monotonic() - started < 5:
+            time.sleep(0.01)
+        stats = outbox.stats()
+        self.assertEqual((1, 1, 2), (stats["depth"], stats["dead"], stats["failed_attempts"]))
+        self.assertEqual(2, len(responses.calls))
+        self.assertFalse(outbox.close(timeout=0))
+
+    def test_pending_writes_survive_restart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "outbox.db")
+            outbox = Outbox(path)
+            outbox.put("client:1", "send_message_to_user", "token",
+                       client_id=1, text="text", open_dialog=False, type="system")
+            self.assertFalse(outbox.close(timeout=0))
+
+            outbox = Outbox(path)
+            self.assertEqual(1, outbox.depth())
+            outbox.close()
+
+
+class IngestionServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubAPI(clients=30, tags=5, operators=3).start()
+        self.addCleanup(self.stub.stop)
+        self.handler = Handler(api_url=self.stub.url, instrumentation=Metrics())
+        self.addCleanup(self.handler.close)
+
+    def run_server(self, server, scenario):
+        async def main():
+            await server.start()
+            try:
+                await scenario(server)
+            finally:
+                await server.stop(timeout=5)
+        asyncio.run(main())
+
+    def test_triggers_are_validated_queued_and_drained(self):
+        results = []
+        server = IngestionServer(self.handler, port=0, workers=2,
+                                 on_result=lambda path, data, result: results.append(result))
+
+        async def scenario(server):
+            def client():
+                with requests.Session() as session:
+                    post = session.post(f"{server.url}/triggers/manually",
+                                        json={"name": "client10"})
+                    invalid = session.post(f"{server.url}/triggers/new_request",
+                                           json={"client_id": "1"})
+                    health = session.get(f"{server.url}/health")
+                    return post.status_code, invalid.status_code, health.json()["status"]
+            codes = await asyncio.get_running_loop().run_in_executor(None, client)
+            self.assertEqual((202, 400, "ok"), codes)
+
+        self.run_server(server, scenario)
+        self.assertEqual(["Assigned VIP tag for client with name client10"], results)
+        self.assertEqual({"accepted": 1, "rejected": 0, "invalid": 1, "processed": 1,
+                          "failed": 0, "queue_depth": 0}, server.stats())
+        self.assertIn(
+            'chat2desk_handler_calls_total{handler="manually_handler",outcome="success"} 1',
+            server._metrics_text_(),
+        )
+
+    def test_invalid_content_length_returns_400(self):
+        server = IngestionServer(self.handler, port=0, workers=1)
+
+        async def scenario(server):
+            for length in (b"abc", b"-1"):
+                host, port = server._server.sockets[0].getsockname()[:2]
+                reader, writer = await asyncio.open_connection(host, port)
+                writer.write(b"POST /triggers/manually HTTP/1.1\r\nContent-Length: "
+                             + length + b"\r\n\r\n")
+                self.assertEqual(b"HTTP/1.1 400 Bad Request\r\n", await reader.readline())
+                writer.close()
+
+        self.run_server(server, scenario)
+
+    def test_stop_closes_idle_keep_alive_connections(self):
+        server = IngestionServer(self.handler, port=0, workers=1)
+
+        async def main():
+            await server.start()
+            host, port = server._server.sockets[0].getsockname()[:2]
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(b"GET /health HTTP/1.1\r\n\r\n")
+            self.assertEqual(b"HTTP/1.1 200 OK\r\n", await reader.readline())
+
+            await asyncio.wait_for(server.stop(timeout=1), 5)
+            await asyncio.wait_for(reader.read(), 5)  # Сервер закрыл соединение
+            self.assertTrue(reader.at_eof())
+            writer.close()
+
+        asyncio.run(main())
+
+    def test_full_queue_returns_429(self):
+        release = threading.Event()
+
+        class SlowHandler:
+            instrumentation = None
+
+            def new_request_handler(self, input_data, c2d):
+                release.wait(5)
+                return c2d.token
+
+        results = []
+        server = IngestionServer(SlowHandler(), port=0, workers=1, queue_size=1,
+                                 on_result=lambda path, data, result: results.append(result))
+
+        async def scenario(server):
+            def client():
+                codes = [
+                    requests.post(f"{server.url}/triggers/new_request",
+                                  json={"client_id": 1, "dialog_id": 1},
+                                  headers={"Authorization": "token"}).status_code
+                    for _ in range(3)
+                ]
+                release.set()
+                return codes
+            await asyncio.sleep(0)
+            codes = await asyncio.get_running_loop().run_in_executor(None, client)
+            self.assertEqual(429, codes[-1])
+            self.assertEqual([202, 202], codes[:2])
+
+        self.run_server(server, scenario)
+        self.assertEqual(["token", "token"], results)
+
+
+class TenantTestCase(unittest.TestCase):
+    @responses.activate
+    def test_concurrent_tenants_keep_their_tokens(self):
+        def client(request):
+            client_id = int(request.url.rsplit("/", 1)[1])
+            owner = request.headers["Authorization"]
+            return 200, {}, json.dumps({"data": {"id": client_id, "owner": owner, "tags": []}})
+
+        responses.add_callback(responses.GET, re.compile(r".*/clients/\d+"), callback=client)
+        responses.add(responses.GET, "https://api.chat2desk.com/v1/tags/",
+                      json={"data": [], "meta": {"total": 0}})
+        handler = Handler(max_tenants=2)
+        self.addCleanup(handler.close)
+
+        tokens = ["a", "b", "c"]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(
+                lambda i: handler.new_request_handler(
+                    {"client_id": i, "dialog_id": i}, C2DMock(tokens[i % 3])
+                ),
+                range(60),
+            ))
+
+        client_calls = [call for call in responses.calls if "/clients/" in call.request.url]
+        self.assertEqual(60, len(client_calls))
+        for call in client_calls:
+            client_id = int(call.request.url.rsplit("/", 1)[1])
+            self.assertEqual(tokens[client_id % 3], call.request.headers["Authorization"])
+        self.assertEqual("", handler.headers["Authorization"])
+        self.assertLessEqual(handler.tenants.stats()["size"], 2)
+
+    def test_evicted_tenant_is_closed_after_last_lease(self):
+        closed = []
+        pool = TenantPool(lambda token: token.upper(), maxsize=1, close=closed.append)
+
+        with pool.lease("a") as tenant:
+            self.assertEqual("A", tenant)
+            with pool.lease("b"):
+                self.assertEqual([], closed)
+            self.assertEqual([], closed)
+        self.assertEqual(["A"], closed)
+
+        with pool.lease("b"):
+            pass
+        self.assertEqual({"created": 2, "reused": 1, "evictions": 1, "size": 1}, pool.stats())
+
+
+class ClientProfilesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubAPI(clients=50, tags=5, operators=3).start()
+        self.addCleanup(self.stub.stop)
+        self.profiles = ClientProfiles(maxsize=100)
+        self.handler = Handler(api_url=self.stub.url, client_profiles=self.profiles)
+        self.addCleanup(self.handler.close)
+
+    def test_warm_up_answers_vip_checks_without_client_requests(self):
+        self.assertEqual(50, self.profiles.warm_up(self.handler))
+
+        for client_id in range(1, 11):
+            self.handler.new_request_handler(
+                {"client_id": client_id, "dialog_id": 1}, C2DMock('')
+            )
+
+        self.assertEqual(0, sum(
+            count for call, count in self.stub.calls.items()
+            if call.startswith("GET /v1/clients/") and call != "GET /v1/clients/"
+        ))
+        self.assertEqual(1.0, self.profiles.stats()["hit_rate"])
+
+    def test_assigned_tag_is_written_through(self):
+        self.assertEqual(frozenset(), self.handler.get_client_tags(3))
+
+        result = self.handler.manually_handler({"name": "client3"}, C2DMock(''))
+        self.assertEqual("Assigned VIP tag for client with name client3", result)
+
+        self.assertEqual(frozenset({1}), self.handler.get_client_tags(3))
+        self.assertEqual({"hits": 1, "misses": 1}, {
+            key: value for key, value in self.profiles.stats().items()
+            if key in ("hits", "misses")
+        })
+
+
+class SharedStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "shared.sqlite3")
+        self.stub = StubAPI(clients=20, tags=5, operators=3).start()
+        self.addCleanup(self.stub.stop)
+        for operator in self.stub.operators:
+            operator["opened_dialogs"] = 4
+
+    def test_caches_are_shared_between_stores(self):
+        first, second = SharedStore(self.path), SharedStore(self.path)
+        handlers = [
+            Handler(api_url=self.stub.url, tag_cache=SharedTagCache(store),
+                    client_directory=SharedClientDirectory(store),
+                    operator_pool=SharedOperatorPool(store))
+            for store in (first, second)
+        ]
+        for handler in handlers:
+            self.addCleanup(handler.close)
+
+        self.assertEqual(1, handlers[0].get_tag_id_by_label("VIP"))
+        self.assertEqual(12, handlers[0].get_user_id_by_username("client12"))
+        self.assertEqual(1, handlers[1].get_tag_id_by_label("VIP"))
+        self.assertEqual(12, handlers[1].get_user_id_by_username("client12"))
+        self.assertEqual(1, self.stub.calls["GET /v1/tags/"])
+        self.assertEqual(1, self.stub.calls["GET /v1/clients/"])
+
+        reserved = [handler.get_available_operator() for handler in handlers * 2]
+        self.assertEqual([1, 2, 3, None], reserved)
+        handlers[1].release_operator(2)
+        self.assertEqual(2, handlers[0].get_available_operator())
+
+        other = handlers[1].for_token("other")
+        self.addCleanup(other.release_connections)
+        self.assertIsNone(other.tag_cache.store.get_meta("other", "clients_synced_at"))
+
+    def test_resync_keeps_reservations_and_waits_for_first_sync(self):
+        store = SharedStore(self.path)
+        pool = SharedOperatorPool(store)
+        pool.load([(1, 0)])
+        store.claim("", "operators_synced_at", 60, time.time())
+        self.assertEqual(1, pool.reserve(None))
+        pool.load([(1, 0)])  # назначение ещё не видно в API
+        pool.release(1)
+        self.assertEqual((0, 0), store.connect().execute(
+            "SELECT load, reserved FROM operators WHERE id = 1"
+        ).fetchone())
+
+        # Другой процесс начал первую синхронизацию справочника и завершает её,
+        # пока этот ждёт
+        store.claim("", "clients_synced_at", 3600, time.time())
+        claimant = SharedClientDirectory(store)
+        directory = SharedClientDirectory(
+            store, sleep=lambda seconds: claimant._save_([(12, "client12")], 0)
+        )
+        self.assertEqual(12, directory.get_user_id("client12", None))
+
+    def test_failed_sync_releases_claim(self):
+        class FailingHandler:
+            def iter_clients(self, *args, **kwargs):
+                raise requests.exceptions.ConnectionError()
+
+            iter_operators = iter_clients
+
+        store = SharedStore(self.path)
+        for key, call in [
+            ("clients_synced_at", lambda: SharedClientDirectory(store).get_user_id(
+                "client1", FailingHandler())),
+            ("operators_synced_at", lambda: SharedOperatorPool(store).reserve(FailingHandler())),
+        ]:
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                call()
+            self.assertIsNone(store.get_meta("", key))
+
+    def test_worker_processes_never_overbook_operators(self):
+        with WorkerPool(self.path, processes=2, threads=4, api_url=self.stub.url) as pool:
+            futures = [
+                pool.submit("new_request_handler", {"client_id": i * 2, "dialog_id": i},
+                            C2DMock(''))
+                for i in range(1, 9)
+            ]
+            results = [future.result() for future in futures]
+
+        attached = [result for result in results if result.startswith("Attached")]
+        self.assertEqual(3, len(attached))
+        self.assertEqual({"1", "2", "3"}, {result.split()[3] for result in attached})
+
+
+class ReplayTestCase(unittest.TestCase):
+    def test_recorded_triggers_are_replayed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "triggers.jsonl")
+            clock = iter([100.0, 100.2, 100.4])
+            recorder = TriggerRecorder(path, clock=lambda: next(clock))
+
+            with StubAPI(clients=20, tags=5, operators=3) as stub:
+                handler = Handler(api_url=stub.url, recorder=recorder)
+                self.addCleanup(handler.close)
+                handler.manually_handler({"name": "client4"}, C2DMock(''))
+                handler.new_request_handler({"client_id": 2, "dialog_id": 1}, C2DMock(''))
+                handler.new_request_handler({"client_id": 3, "dialog_id": 2}, C2DMock(''))
+                recorder.close()
+
+                records = replay.load(path)
+                self.assertEqual([100.0, 100.2, 100.4], [record["ts"] for record in records])
+                self.assertEqual({"name": "client4"}, records[0]["input"])
+
+                started = time.perf_counter()
+                report = replay.replay(records, handler, speed=2, concurrency=2)
+                self.assertGreaterEqual(time.perf_counter() - started, 0.2)
+
+        self.assertEqual(3, report["operations"])
+        self.assertEqual(0, report["error_rate"])
+        self.assertAlmostEqual(1 / 3, report["failure_rate"])
+        self.assertGreater(report["api_calls_per_op"], 0)
+        self.assertEqual(2, report["handlers"]["new_request_handler"]["operations"])
+
+
+class LocalMirrorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubAPI(clients=20, tags=5, operators=2).start()
+        self.addCleanup(self.stub.stop)
+        self.stub.operators[0]["opened_dialogs"] = 4
+        self.stub.operators[1]["opened_dialogs"] = 0
+        self.now = 1000.0
+        self.mirror = LocalMirror(max_staleness=60, clock=lambda: self.now)
+        self.handler = Handler(api_url=self.stub.url, mirror=self.mirror)
+        self.addCleanup(self.handler.close)
+
+    def test_events_are_served_locally_until_stale(self):
+        self.assertEqual(1, self.handler.get_available_operator())
+        self.handler.release_operator(1)
+        self.mirror.apply({"hook_type": "inbox", "dialog_id": 7, "client_id": 3})
+        self.mirror.apply({"hook_type": "new_request", "request_id": 9, "dialog_id": 7,
+                           "client_id": 3})
+        self.mirror.apply({"hook_type": "dialog_transferred", "dialog_id": 7,
+                           "operator_id": 1})
+        calls = self.stub.total_calls()
+
+        self.assertEqual(3, self.handler.get_client_id_by_dialog_id(7))
+        self.assertEqual({"data": {"id": 9, "client_id": 3, "dialog_id": 7}},
+                         self.handler.get_request_by_id(9))
+        self.assertEqual(2, self.handler.get_available_operator())
+        self.handler.release_operator(2)
+        self.mirror.apply({"hook_type": "close_dialog", "dialog_id": 7})
+        self.assertEqual(1, self.handler.get_available_operator())
+        self.assertEqual(calls, self.stub.total_calls())
+
+        self.now += 61
+        self.assertEqual(7, self.handler.get_client_id_by_dialog_id(7))
+        self.assertEqual(1, self.stub.calls["GET /v1/dialogs/7"])
+
+    def test_operators_are_reserved_and_tenant_events_reach_tenant_mirror(self):
+        self.assertEqual(1, self.handler.get_available_operator())
+        self.assertEqual(2, self.handler.get_available_operator())
+        self.handler.release_operator(1)
+        self.handler.set_operator_to_dialog(5, 2, "OPEN")
+        self.assertEqual({1: 4, 2: 1}, self.mirror.operators)
+        self.assertEqual({1: 0, 2: 0}, self.mirror.reserved)
+
+        server = IngestionServer(self.handler, port=0)
+        event = json.dumps({"hook_type": "inbox", "dialog_id": 7, "client_id": 3}).encode()
+        status, _, _ = server._dispatch_("POST", "/events", {"authorization": "other"}, event)
+        self.assertEqual(200, status)
+        self.assertIsNone(self.mirror.client_id_by_dialog(7))
+        with self.handler.tenants.lease("other") as tenant:
+            self.assertEqual(3, tenant.get_client_id_by_dialog_id(7))
+
+    def test_snapshot_restores_state(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "mirror.json")
+            mirror = LocalMirror(snapshot_path=path, clock=lambda: self.now)
+            mirror.apply({"hook_type": "inbox", "dialog_id": 7, "client_id": 3})
+            mirror.sync(self.handler)
+
+            restored = LocalMirror(snapshot_path=path, clock=lambda: self.now)
+            self.assertEqual(3, restored.client_id_by_dialog(7))
+            self.assertEqual({1: 4, 2: 0}, restored.operators)
+
+
+class HedgingTestCase(unittest.TestCase):
+    @responses.activate
+    def test_slow_read_is_hedged_and_first_response_wins(self):
+        calls = []
+        release = threading.Event()
+
+        def respond(request):
+            calls.append(request.url)
+            if len(calls) == 1:
+                release.wait(5)
+            return 200, {}, json.dumps({"data": {"id": 1, "tags": []}})
+
+        responses.add_callback(responses.GET, "https://api.chat2desk.com/v1/clients/1",
+                               callback=respond)
+        policy = HedgePolicy(percentile=50, min_samples=1)
+        policy.observe("https://api.chat2desk.com/v1/clients/2", 0.01)
+        handler = Handler(Transport(hedging=policy))
+        self.addCleanup(handler.close)
+
+        started = time.perf_counter()
+        self.assertEqual({"data": {"id": 1, "tags": []}}, handler.get_client_by_id(1))
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual({"requests": 1, "hedged": 1, "hedge_wins": 1}, policy.stats())
+
+        release.set()  # Дожидаемся первой попытки, чтобы она не попала в следующий тест
+        while len(responses.calls) < 2:
+            time.sleep(0.01)
+
+    @responses.activate
+    def test_hedge_needs_a_rate_limit_token(self):
+        release = threading.Event()
+
+        def respond(request):
+            release.wait(5)
+            return 200, {}, json.dumps({"data": {"id": 1, "tags": []}})
+
+        responses.add_callback(responses.GET, "https://api.chat2desk.com/v1/clients/1",
+                               callback=respond)
+        policy = HedgePolicy(percentile=50, min_samples=1)
+        policy.observe("https://api.chat2desk.com/v1/clients/2", 0.01)
+        transport = Transport(hedging=policy, scheduler=RequestScheduler(rate=0.01, burst=1))
+        self.addCleanup(transport.close)
+
+        timer = threading.Timer(0.1, release.set)
+        timer.start()
+        self.assertEqual(200, transport.get("https://api.chat2desk.com/v1/clients/1").status_code)
+        timer.join()
+        self.assertEqual(0, policy.stats()["hedged"])
+        self.assertEqual(1, len(responses.calls))
+
+    def test_slot_wait_respects_deadline(self):
+        scheduler = RequestScheduler(initial_concurrency=1)
+        self.assertTrue(scheduler.limiter.acquire())
+        with self.assertRaises(DeadlineExceeded):
+            scheduler.execute("GET", "", lambda: None, deadline=time.monotonic() + 0.05)
+
+    @responses.activate
+    def test_trigger_fails_fast_when_deadline_runs_out(self):
+        responses.add(responses.GET, "https://api.chat2desk.com/v1/clients/1", status=503)
+        responses.add(responses.GET, "https://api.chat2desk.com/v1/tags/", status=503)
+        sleeps = []
+        scheduler = RequestScheduler(backoff_base=5, sleep=sleeps.append, rand=lambda: 1.0)
+        handler = Handler(scheduler=scheduler, trigger_timeout=1.0)
+
+        result = handler.new_request_handler({"client_id": 1, "dialog_id": 1}, C2DMock(''))
+        self.assertEqual("Failed to attach operator for client with id 1", result)
+        self.assertEqual([], sleeps)
+        self.assertEqual(2, len(responses.calls))
+
+        with self.assertRaises(DeadlineExceeded):
+            handler.transport.get("https://api.chat2desk.com/v1/clients/1",
+                                  deadline=time.monotonic() - 1)
+        self.assertEqual(2, len(responses.calls))
+
+
+class WarmStateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubAPI(clients=300, tags=5, operators=3).start()
+        self.addCleanup(self.stub.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "warm.json")
+
+    def run_triggers(self, client_id: int) -> dict:
+        kwargs = {"operator_pool": OperatorPool(), "client_directory": ClientDirectory()}
+        self.stub.calls.clear()
+        run_trigger(self.path, "new_request_handler", {"client_id": client_id, "dialog_id": 1},
+                    C2DMock(''), api_url=self.stub.url, **kwargs)
+        run_trigger(self.path, "manually_handler", {"name": f"client{client_id}"},
+                    C2DMock(''), api_url=self.stub.url, **kwargs)
+        return dict(self.stub.calls)
+
+    def test_next_process_starts_from_snapshot(self):
+        cold = self.run_triggers(2)
+        self.assertIn("GET /v1/tags/", cold)
+        self.assertIn("GET /v1/operators/", cold)
+        self.assertIn("GET /v1/clients/", cold)
+
+        warm = self.run_triggers(4)
+        self.assertNotIn("GET /v1/tags/", warm)
+        self.assertNotIn("GET /v1/operators/", warm)
+        self.assertNotIn("GET /v1/clients/", warm)
+
+        handler = WarmState(self.path).create_handler()
+        self.addCleanup(handler.close)
+        self.assertEqual(self.stub.url, handler.api_url)
+        self.assertEqual(  # Назначения обоих процессов учтены в снимке
+            sum(operator["opened_dialogs"] for operator in self.stub.operators) + 2,
+            sum(handler.operator_pool.loads.values()),
+        )
+        self.assertIsNone(WarmState(self.path).load("other-token"))
+
+
+class PageStoreTestCase(unittest.TestCase):
+    def scan_operators(self, etags: bool) -> tuple[StubAPI, Handler, PageStore]:
+        stub = StubAPI(clients=10, tags=5, operators=450, etags=etags).start()
+        self.addCleanup(stub.stop)
+        store = PageStore()
+        handler = Handler(api_url=stub.url, page_store=store)
+        self.addCleanup(handler.close)
+        self.assertEqual(stub.operators, list(handler.iter_operators()))
+        return stub, handler, store
+
+    def test_unchanged_pages_are_not_downloaded_again(self):
+        stub, handler, store = self.scan_operators(etags=True)
+        self.assertEqual(stub.operators, list(handler.iter_operators()))
+        self.assertEqual({"not_modified": 3, "unchanged": 0, "changed": 3, "size": 3},
+                         store.stats())
+
+        stub.operators[449]["opened_dialogs"] = 100
+        self.assertEqual(100, list(handler.iter_operators())[449]["opened_dialogs"])
+        self.assertEqual(1, store.stats()["changed"] - 3)
+        self.assertEqual(9, stub.calls["GET /v1/operators/"])
+
+    def test_iterators_do_not_expose_stored_pages(self):
+        stub, handler, store = self.scan_operators(etags=True)
+        next(handler.iter_operators(fields=None))["opened_dialogs"] = -1
+        next(handler.iter_operators())["opened_dialogs"] = -1
+        self.assertEqual(stub.operators, list(handler.iter_operators(fields=None)))
+
+    def test_content_hash_is_used_without_validators(self):
+        stub, handler, store = self.scan_operators(etags=False)
+        self.assertEqual(stub.operators, list(handler.iter_operators()))
+        self.assertEqual({"not_modified": 0, "unchanged": 3, "changed": 3, "size": 3},
+                         store.stats())
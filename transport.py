@@ -0,0 +1,360 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """Время, отведённое на обработку триггера, истекло до завершения запроса."""
+
+
+class CountingAdapter(HTTPAdapter):
+    """HTTPAdapter, запоминающий пулы соединений для подсчёта их переиспользования."""
+
+    def __init__(self, *args, **kwargs):
+        """Создаёт адаптер, аргументы передаются в HTTPAdapter."""
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        """
+        Возвращает пул соединений для запроса и запоминает его.
+
+        :return: пул соединений urllib3.
+        """
+        pool = super().get_connection_with_tls_context(request, verify, proxies, cert)
+        with self._pools_lock:
+            self._pools[id(pool)] = pool
+        return pool
+
+    def connection_stats(self) -> tuple[int, int]:
+        """
+        Считает запросы и новые соединения по всем использованным пулам.
+
+        :return: (кол-во запросов через пулы, кол-во открытых соединений).
+        """
+        with self._pools_lock:
+            pools = list(self._pools.values())
+        pool_requests = sum(pool.num_requests for pool in pools)
+        new_connections = sum(pool.num_connections for pool in pools)
+        return pool_requests, new_connections
+
+
+class Transport:
+    """
+    Долгоживущий HTTP-транспорт для запросов к API Chat2Desk.
+
+    Держит одну requests.Session с пулом keep-alive соединений,
+    ограничением соединений на хост и явными таймаутами.
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        pool_block: bool = True,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10.0,
+        instrumentation=None,
+        scheduler=None,
+        hedging=None,
+    ):
+        """
+        Создаёт транспорт.
+
+        :param pool_connections: кол-во хостов, для которых хранятся пулы соединений.
+        :param pool_maxsize: максимальное кол-во соединений к одному хосту.
+        :param pool_block: True, если при исчерпании пула нужно ждать свободное соединение,
+         а не открывать новое сверх лимита.
+        :param connect_timeout: таймаут установки соединения в секундах.
+        :param read_timeout: таймаут чтения ответа в секундах.
+        :param instrumentation: объект, получающий события о запросах (см. metrics.Metrics).
+         None - события не собираются.
+        :param scheduler: планировщик запросов с ограничением частоты и повторами
+         (см. scheduler.RequestScheduler). None - запросы выполняются сразу и без повторов.
+        :param hedging: правило дублирования медленных GET запросов (см. hedging.HedgePolicy).
+         None - запросы не дублируются.
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self._pool_settings = (pool_connections, pool_maxsize, pool_block)
+        self.adapter = CountingAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+
+        self.session = requests.Session()
+        self.session.headers.update(
+            {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+        )
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+        self.instrumentation = instrumentation
+        self.scheduler = scheduler
+        self.hedging = hedging
+        self._hedge_executor = None
+        self._requests = 0
+        self._lock = threading.Lock()
+
+    def request(self, method: str, url: str, deadline: float = None,
+                **kwargs) -> requests.Response:
+        """
+        Выполняет HTTP запрос через общий пул соединений.
+
+        :param method: HTTP метод.
+        :param url: url запроса.
+        :param deadline: момент по time.monotonic, после которого запрос не выполняется,
+         а таймауты попыток не превышают оставшееся до него время. None - без ограничения.
+        :param kwargs: аргументы, передаваемые в requests.Session.request.
+        :return: ответ на запрос.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        if self.scheduler is None:
+            return self._attempt_(method, url, deadline, **kwargs)
+
+        token = (kwargs.get("headers") or {}).get("Authorization", "")
+        return self.scheduler.execute(
+            method,
+            token,
+            lambda: self._attempt_(method, url, deadline, **kwargs),
+            on_retry=lambda: self._on_retry_(method, url),
+            deadline=deadline,
+        )
+
+    def _attempt_(self, method: str, url: str, deadline: float | None,
+                  **kwargs) -> requests.Response:
+        """
+        Выполняет одну попытку запроса с учётом оставшегося времени и дублирования.
+
+        :param method: HTTP метод.
+        :param url: url запроса.
+        :param deadline: момент по time.monotonic или None.
+        :param kwargs: аргументы, передаваемые в requests.Session.request.
+        :return: ответ на запрос.
+        """
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"Deadline exceeded before {method} {url}")
+            timeout = kwargs["timeout"]
+            if isinstance(timeout, tuple):
+                kwargs["timeout"] = tuple(min(part, remaining) for part in timeout)
+            else:
+                kwargs["timeout"] = min(timeout, remaining)
+
+        if method == "GET" and self.hedging is not None:
+            return self._hedged_(method, url, **kwargs)
+        return self._send_(method, url, **kwargs)
+
+    def _hedged_(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Выполняет идемпотентный запрос с дублированием, если ответ задерживается.
+
+        Если ответа нет дольше порога из hedging, отправляется дубликат
+        и возвращается первый успешно полученный ответ. Ответ проигравшей
+        попытки закрывается, когда она завершится. Если задан scheduler, дубликат
+        забирает токен из bucket токена API и не отправляется, если токена нет.
+        :param method: HTTP метод.
+        :param url: url запроса.
+        :param kwargs: аргументы, передаваемые в requests.Session.request.
+        :return: ответ на запрос.
+        """
+        threshold = self.hedging.threshold(url)
+        started = time.perf_counter()
+        if threshold is None:
+            response = self._send_(method, url, **kwargs)
+            self.hedging.observe(url, time.perf_counter() - started)
+            return response
+
+        executor = self._hedge_pool_()
+        first = executor.submit(self._send_, method, url, **kwargs)
+        done, _ = wait([first], timeout=threshold)
+        if done:
+            response = first.result()
+            self.hedging.observe(url, time.perf_counter() - started)
+            return response
+
+        token = (kwargs.get("headers") or {}).get("Authorization", "")
+        if self.scheduler is not None and not self.scheduler.try_acquire(token):
+            response = first.result()
+            self.hedging.observe(url, time.perf_counter() - started)
+            return response
+
+        second = executor.submit(self._send_, method, url, **kwargs)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                for loser in pending:
+                    loser.add_done_callback(_close_response_)
+                self.hedging.on_hedge(future is second)
+                self.hedging.observe(url, time.perf_counter() - started)
+                return future.result()
+        self.hedging.on_hedge(False)
+        raise error
+
+    def _hedge_pool_(self) -> ThreadPoolExecutor:
+        """Возвращает пул потоков для дублированных запросов, создавая его при первом вызове."""
+        with self._lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=self._pool_settings[1] * 2, thread_name_prefix="hedge"
+                )
+            return self._hedge_executor
+
+    def _on_retry_(self, method: str, url: str) -> None:
+        """Передаёт событие о повторе запроса в instrumentation."""
+        if self.instrumentation is not None:
+            self.instrumentation.on_retry(method, url)
+
+    def _send_(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Выполняет одну попытку запроса.
+
+        :param method: HTTP метод.
+        :param url: url запроса.
+        :param kwargs: аргументы, передаваемые в requests.Session.request.
+        :return: ответ на запрос.
+        """
+        with self._lock:
+            self._requests += 1
+
+        if self.instrumentation is None:
+            return self.session.request(method, url, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.instrumentation.on_request(
+                method, url, "error", time.perf_counter() - started, 0, 0
+            )
+            raise
+
+        body = response.request.body
+        self.instrumentation.on_request(
+            method,
+            url,
+            response.status_code,
+            time.perf_counter() - started,
+            len(body) if body else 0,
+            len(response.content),
+        )
+        return response
+
+    def settings(self) -> tuple:
+        """
+        Возвращает настройки пула соединений и таймауты транспорта.
+
+        :return: (pool_connections, pool_maxsize, pool_block, connect_timeout, read_timeout),
+         аргументы, с которыми можно создать такой же транспорт.
+        """
+        return (*self._pool_settings, *self.timeout)
+
+    def clone(self) -> "Transport":
+        """
+        Создаёт транспорт с теми же настройками, но своей сессией и пулом соединений.
+
+        :return: новый транспорт.
+        """
+        return Transport(
+            *self.settings(),
+            instrumentation=self.instrumentation,
+            scheduler=self.scheduler,
+            hedging=self.hedging,
+        )
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Выполняет GET запрос."""
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """Выполняет POST запрос."""
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        """Выполняет PUT запрос."""
+        return self.request("PUT", url, **kwargs)
+
+    def stats(self) -> dict:
+        """
+        Возвращает счётчики использования соединений.
+
+        :return: словарь с общим кол-вом запросов, кол-вом новых
+         и переиспользованных соединений.
+        """
+        pool_requests, new_connections = self.adapter.connection_stats()
+        return {
+            "requests": self._requests,
+            "new_connections": new_connections,
+            "reused_connections": max(pool_requests - new_connections, 0),
+        }
+
+    def close(self) -> None:
+        """Закрывает все соединения пула."""
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False, cancel_futures=True)
+            self._hedge_executor = None
+        self.session.close()
+
+    def __enter__(self):
+        """Возвращает транспорт для использования в with."""
+        return self
+
+    def __exit__(self, *exc):
+        """Закрывает транспорт при выходе из with."""
+        self.close()
+
+
+def _close_response_(future) -> None:
+    """Закрывает ответ завершившейся попытки, который не будет использован."""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class DeadlineTransport:
+    """
+    Транспорт, ограничивающий все запросы одним моментом окончания.
+
+    Оборачивает Transport и передаёт deadline в каждый запрос,
+    поэтому время, отведённое на триггер, делится между всеми его запросами.
+    Остальные атрибуты берутся из обёрнутого транспорта.
+    """
+
+    def __init__(self, transport: Transport, deadline: float):
+        """
+        Создаёт обёртку.
+
+        :param transport: транспорт, выполняющий запросы.
+        :param deadline: момент по time.monotonic, после которого запросы не выполняются.
+        """
+        self.transport = transport
+        self.deadline = deadline
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Выполняет HTTP запрос с ограничением по времени."""
+        return self.transport.request(method, url, deadline=self.deadline, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Выполняет GET запрос."""
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """Выполняет POST запрос."""
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        """Выполняет PUT запрос."""
+        return self.request("PUT", url, **kwargs)
+
+    def __getattr__(self, name: str):
+        """Возвращает атрибут обёрнутого транспорта."""
+        return getattr(self.transport, name)
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import time
+
+from cache import TTLCache
+from directory import ClientDirectory
+from main import Handler
+from operators import OperatorPool
+from transport import Transport
+
+# Версия формата снимка. Снимок другой версии не загружается.
+SNAPSHOT_VERSION = 1
+
+
+def _token_hash_(token: str) -> str:
+    """Возвращает отпечаток токена API, по которому снимок сверяется с аккаунтом."""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+class WarmState:
+    """
+    Снимок прогретого состояния Handler для быстрого запуска.
+
+    Рассчитан на среды, где каждый триггер обрабатывается в новом короткоживущем
+    процессе. Вместо поиска id тегов, загрузки операторов и справочника клиентов
+    по API новый Handler получает их одним чтением локального файла.
+    В снимке хранятся id тегов, загрузка операторов, индекс клиентов по имени,
+    адрес API и настройки транспорта. Время жизни записей и устаревание
+    снимков операторов и клиентов отсчитываются от исходной загрузки,
+    поэтому снимок не продлевает жизнь данных. Токен API не записывается,
+    хранится только его отпечаток, и снимок другого аккаунта не загружается.
+    """
+
+    def __init__(self, path: str, clock=time.time):
+        """
+        Создаёт снимок.
+
+        :param path: путь к файлу снимка.
+        :param clock: функция, возвращающая текущее время в секундах.
+        """
+        self.path = path
+        self.clock = clock
+
+    def load(self, token: str = "") -> dict | None:
+        """
+        Читает снимок.
+
+        :param token: токен API, для которого нужен снимок.
+        :return: снимок или None, если файла нет, он повреждён,
+         другой версии или относится к другому токену.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            return None
+        if snapshot.get("token") != _token_hash_(token):
+            return None
+        return snapshot
+
+    def save(self, handler: Handler) -> None:
+        """
+        Атомарно сохраняет состояние обработчика.
+
+        Сохраняются кэш тегов, пул операторов и справочник клиентов,
+        если они хранятся в памяти (TTLCache, OperatorPool, ClientDirectory).
+        :param handler: обработчик.
+        :return: None.
+        """
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "token": _token_hash_(handler.headers["Authorization"]),
+            "saved_at": self.clock(),
+            "api_url": handler.api_url,
+            "transport": list(handler.transport.settings()),
+            "tags": None,
+            "operators": None,
+            "clients": None,
+        }
+        if isinstance(handler.tag_cache, TTLCache):
+            snapshot["tags"] = handler.tag_cache.dump()
+        if isinstance(handler.operator_pool, OperatorPool):
+            snapshot["operators"] = {
+                "max_dialogs": handler.operator_pool.max_dialogs,
+                "resync_interval": handler.operator_pool.resync_interval,
+                **handler.operator_pool.dump(),
+            }
+        if isinstance(handler.client_directory, ClientDirectory):
+            snapshot["clients"] = handler.client_directory.dump()
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, separators=(",", ":"), ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def create_handler(self, token: str = "", **kwargs) -> Handler:
+        """
+        Создаёт Handler и восстанавливает в нём снимок.
+
+        Адрес API и настройки транспорта из снимка используются, если они не переданы явно.
+        Переданные пул операторов и справочник клиентов заполняются из снимка,
+        а если не переданы, создаются с настройками из снимка.
+        :param token: токен API обработчика.
+        :param kwargs: аргументы Handler.
+        :return: новый обработчик. Если снимка нет, обработчик создаётся без него.
+        """
+        snapshot = self.load(token)
+        if snapshot is None:
+            return Handler(token=token, **kwargs)
+
+        kwargs.setdefault("api_url", snapshot["api_url"])
+        if "transport" not in kwargs:
+            kwargs["transport"] = Transport(*snapshot["transport"])
+        operators = snapshot["operators"]
+        if operators is not None and "operator_pool" not in kwargs:
+            kwargs["operator_pool"] = OperatorPool(
+                operators["max_dialogs"], operators["resync_interval"]
+            )
+        if snapshot["clients"] is not None and "client_directory" not in kwargs:
+            kwargs["client_directory"] = ClientDirectory()
+        handler = Handler(token=token, **kwargs)
+
+        elapsed = max(self.clock() - snapshot["saved_at"], 0.0)
+        if snapshot["tags"] is not None and isinstance(handler.tag_cache, TTLCache):
+            handler.tag_cache.restore(snapshot["tags"], elapsed)
+        if operators is not None and isinstance(handler.operator_pool, OperatorPool):
+            handler.operator_pool.restore(operators, elapsed)
+        if snapshot["clients"] is not None and isinstance(
+            handler.client_directory, ClientDirectory
+        ):
+            handler.client_directory.restore(snapshot["clients"])
+        return handler
+
+
+def run_trigger(path: str, method: str, input_data: dict, c2d, **kwargs):
+    """
+    Обрабатывает один триггер в короткоживущем процессе.
+
+    Создаёт Handler из снимка, обрабатывает триггер, сохраняет обновлённый
+    снимок для следующего процесса и закрывает соединения.
+    :param path: путь к файлу снимка.
+    :param method: "manually_handler" или "new_request_handler".
+    :param input_data: входные данные триггера.
+    :param c2d: объект c2d.
+    :param kwargs: аргументы Handler.
+    :return: результат обработки.
+    """
+    state = WarmState(path)
+    handler = state.create_handler(c2d.token, **kwargs)
+    try:
+        return getattr(handler, method)(input_data, c2d)
+    finally:
+        try:
+            state.save(handler)
+        except OSError as e:
+            print(f"Exception raised while saving warm state: {e}")
+        handler.close()
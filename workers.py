@@ -0,0 +1,238 @@
+import itertools
+import multiprocessing
+import pickle
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from c2d import C2D
+from main import Handler
+from shared import SharedClientDirectory, SharedOperatorPool, SharedStore, SharedTagCache
+from transport import Transport
+
+
+def _create_handler_(store_path: str, options: dict) -> Handler:
+    """
+    Создаёт Handler процесса-обработчика с кэшами в общем хранилище.
+
+    :param store_path: путь к файлу SharedStore.
+    :param options: настройки, см. WorkerPool.
+    :return: Handler процесса.
+    """
+    store = SharedStore(store_path)
+    return Handler(
+        Transport(pool_maxsize=options["threads"]),
+        tag_cache=SharedTagCache(store),
+        client_directory=SharedClientDirectory(store) if options["client_index"] else None,
+        operator_pool=SharedOperatorPool(store, max_dialogs=options["max_dialogs"]),
+        page_workers=options["page_workers"],
+        api_url=options["api_url"],
+    )
+
+
+def _run_(handler: Handler, results, task_id: int, method: str, input_data: dict,
+          token: str) -> None:
+    """
+    Выполняет обработчик триггера и отправляет результат в родительский процесс.
+
+    :param handler: Handler процесса.
+    :param results: очередь результатов.
+    :param task_id: номер триггера в пуле.
+    :param method: название метода Handler.
+    :param input_data: входные данные триггера.
+    :param token: токен API.
+    :return: None.
+    """
+    try:
+        results.put((task_id, True, getattr(handler, method)(input_data, C2D(token))))
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(repr(e))
+        results.put((task_id, False, e))
+
+
+def _serve_(store_path: str, options: dict, tasks, results) -> None:
+    """
+    Цикл процесса-обработчика.
+
+    Берёт триггеры из общей очереди и выполняет их в пуле из options["threads"]
+    потоков. Новый триггер берётся только при свободном потоке, чтобы триггеры
+    не скапливались в одном процессе, пока другие простаивают.
+    :param store_path: путь к файлу SharedStore.
+    :param options: настройки, см. WorkerPool.
+    :param tasks: очередь триггеров, None останавливает процесс.
+    :param results: очередь результатов.
+    :return: None.
+    """
+    handler = _create_handler_(store_path, options)
+    slots = threading.BoundedSemaphore(options["threads"])
+
+    def run(*task):
+        try:
+            _run_(handler, results, *task)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=options["threads"]) as executor:
+        while True:
+            slots.acquire()
+            task = tasks.get()
+            if task is None:
+                break
+            executor.submit(run, *task)
+    handler.close()
+
+
+class WorkerPool:
+    """
+    Пул процессов-обработчиков триггеров.
+
+    Распределяет триггеры по процессам, чтобы разбор JSON и перебор коллекций
+    не упирались в GIL одного процесса. Каждый процесс выполняет до threads
+    триггеров одновременно в своём пуле потоков, поэтому ожидание ответов API
+    не простаивает процесс. Id тегов, справочник клиентов и загрузка
+    операторов хранятся в общем SharedStore, поэтому не загружаются каждым
+    процессом заново, а операторы резервируются атомарно для всех процессов.
+    Повторяет интерфейс обработчиков Handler и может быть передан в IngestionServer.
+    """
+
+    instrumentation = None
+
+    def __init__(
+        self,
+        store_path: str,
+        processes: int = None,
+        threads: int = 8,
+        api_url: str = None,
+        max_dialogs: int = 5,
+        page_workers: int = 1,
+        client_index: bool = True,
+        mp_context: str = "spawn",
+    ):
+        """
+        Создаёт пул и запускает процессы.
+
+        :param store_path: путь к файлу SharedStore.
+        :param processes: кол-во процессов. По умолчанию кол-во ядер.
+        :param threads: кол-во триггеров, одновременно выполняемых одним процессом.
+        :param api_url: базовый url API.
+        :param max_dialogs: кол-во открытых диалогов, при котором оператор считается занятым.
+        :param page_workers: кол-во страниц коллекции, запрашиваемых одновременно.
+        :param client_index: True, если клиенты ищутся по имени в общем справочнике.
+        :param mp_context: способ запуска процессов multiprocessing.
+        """
+        self.store = SharedStore(store_path)
+        options = {
+            "threads": threads,
+            "api_url": api_url,
+            "max_dialogs": max_dialogs,
+            "page_workers": page_workers,
+            "client_index": client_index,
+        }
+        context = multiprocessing.get_context(mp_context)
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.closed = False
+        self.processes = [
+            context.Process(target=_serve_, args=(store_path, options, self.tasks, self.results),
+                            daemon=True)
+            for _ in range(processes or multiprocessing.cpu_count())
+        ]
+        for process in self.processes:
+            process.start()
+        self.collector = threading.Thread(target=self._collect_, daemon=True)
+        self.collector.start()
+
+    def _collect_(self) -> None:
+        """
+        Передаёт результаты процессов в Future отправленных триггеров.
+
+        Если процесс завершился аварийно, ожидающие Future получают исключение,
+        так как неизвестно, какие из триггеров он успел взять.
+        :return: None.
+        """
+        while True:
+            try:
+                item = self.results.get(timeout=0.5)
+            except queue.Empty:
+                if self.closed or all(process.is_alive() for process in self.processes):
+                    continue
+                with self.lock:
+                    futures, self.futures = self.futures, {}
+                    self.closed = True
+                for future in futures.values():
+                    future.set_exception(RuntimeError("Worker process exited unexpectedly"))
+                return
+            if item is None:
+                return
+            task_id, succeeded, value = item
+            with self.lock:
+                future = self.futures.pop(task_id)
+            if succeeded:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def submit(self, method: str, input_data: dict, c2d) -> Future:
+        """
+        Отправляет триггер в пул.
+
+        :param method: "manually_handler" или "new_request_handler".
+        :param input_data: входные данные триггера.
+        :param c2d: объект c2d.
+        :return: Future с результатом обработки.
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("WorkerPool is closed")
+            task_id = next(self.ids)
+            self.futures[task_id] = future
+        self.tasks.put((task_id, method, input_data, c2d.token))
+        return future
+
+    def manually_handler(self, input_data, c2d):
+        """
+        Обрабатывает триггер из внешней системы в одном из процессов.
+
+        :param input_data: Входные данные.
+        :param c2d: Объект c2d.
+        :return: Результат обработки.
+        """
+        return self.submit("manually_handler", input_data, c2d).result()
+
+    def new_request_handler(self, input_data, c2d):
+        """
+        Обрабатывает новое обращение в одном из процессов.
+
+        :param input_data: Входные данные.
+        :param c2d: Объект c2d.
+        :return: Результат обработки.
+        """
+        return self.submit("new_request_handler", input_data, c2d).result()
+
+    def close(self) -> None:
+        """Дожидается обработки отправленных триггеров и останавливает процессы."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.results.put(None)
+        self.collector.join()
+
+    def __enter__(self):
+        """Возвращает пул для использования в with."""
+        return self
+
+    def __exit__(self, *exc):
+        """Останавливает пул при выходе из with."""
+        self.close()